@@ -1,6 +1,7 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
+
+from app.engine import configure_engine
 
 # Create flask app
 app = Flask(__name__)
@@ -8,13 +9,15 @@ app = Flask(__name__)
 app.config.from_object('config')
 # Create database app
 db = SQLAlchemy(app)
-# Create login app
-lm = LoginManager()
-lm.init_app(app)
-lm.login_view = 'login'
-# Defer our logic to the view file
-from app import views, models, db, app
+# Apply the backend specific engine settings
+configure_engine(app)
+
 
-# Simple startup script for the application
-if __name__ == '__main__':
-    app.run()
+# Build the web application by registering the views blueprint, which brings in the login manager, request metrics,
+# forms and caches, and return it. Importing the package only sets up the app config and the database, so scripts and
+# workers that need nothing but the models (import app.models) start without the web stack. Safe to call repeatedly.
+def create_app():
+    if 'main' not in app.blueprints:
+        from app.views import main
+        app.register_blueprint(main)
+    return app
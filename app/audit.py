@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, and_, or_, func
+
+from app import app, db
+from app.models import Request, AccessEvent, AccessSnapshot, access_snapshot_grants
+
+# Events that start and end a grant, the only ones point-in-time membership depends on
+MEMBERSHIP_EVENTS = ('GRANTED', 'REVOKED', 'EXPIRED')
+# Snapshot rows written per executemany
+SNAPSHOT_BATCH_SIZE = 5000
+
+
+# Get the latest AccessSnapshot taken at or before the given time, or None
+def snapshot_before(at):
+    return AccessSnapshot.query.filter(AccessSnapshot.taken_at <= at).order_by(AccessSnapshot.taken_at.desc()).first()
+
+
+# Replay the membership events matching the conditions that occurred after the snapshot and up to at, on top of the
+# snapshot's {request_id: (user_id, role_id)} grants
+def _replay(grants, snapshot, at, *conditions):
+    events = AccessEvent.__table__
+    conditions = list(conditions) + [events.c.kind.in_(MEMBERSHIP_EVENTS), events.c.occurred_at <= at]
+    if snapshot is not None:
+        conditions.append(events.c.occurred_at > snapshot.taken_at)
+    for request_id, kind, user_id, role_id in db.session.execute(
+            select([events.c.request_id, events.c.kind, events.c.user_id, events.c.role_id])
+            .where(and_(*conditions)).order_by(events.c.occurred_at, events.c.id)):
+        if kind == 'GRANTED':
+            grants[request_id] = (user_id, role_id)
+        else:
+            grants.pop(request_id, None)
+    return grants
+
+
+# Get the {request_id: (user_id, role_id)} grants of a snapshot matching the conditions
+def _snapshot_grants(snapshot, *conditions):
+    if snapshot is None:
+        return {}
+    table = access_snapshot_grants
+    return {request_id: (user_id, role_id) for request_id, user_id, role_id in db.session.execute(
+        select([table.c.request_id, table.c.user_id, table.c.role_id])
+        .where(and_(table.c.snapshot_id == snapshot.id, *conditions)))}
+
+
+# Get the ids of the Users directly granted the Role at the given time. Reads the grants of the Role from the latest
+# snapshot before then and replays only the Role's events since, both through (role, time) indexes.
+def holders_at(role_id, at):
+    snapshot = snapshot_before(at)
+    grants = _snapshot_grants(snapshot, access_snapshot_grants.c.role_id == role_id)
+    _replay(grants, snapshot, at, AccessEvent.role_id == role_id)
+    return sorted({user_id for user_id, _ in grants.values()})
+
+
+# Get the ids of the Roles directly granted to the User at the given time
+def roles_at(user_id, at):
+    snapshot = snapshot_before(at)
+    grants = _snapshot_grants(snapshot, access_snapshot_grants.c.user_id == user_id)
+    _replay(grants, snapshot, at, AccessEvent.user_id == user_id)
+    return sorted({role_id for _, role_id in grants.values()})
+
+
+# Build the statement selecting the events that occurred after since and up to until, optionally for one Role or
+# User, in the order they happened. Suitable for app.export.stream_rows.
+def changes_statement(since, until, role_id=None, user_id=None):
+    events = AccessEvent.__table__
+    conditions = [events.c.occurred_at > since, events.c.occurred_at <= until]
+    if role_id is not None:
+        conditions.append(events.c.role_id == role_id)
+    if user_id is not None:
+        conditions.append(events.c.user_id == user_id)
+    return select([events.c.id.label('event_id'), events.c.occurred_at, events.c.kind, events.c.request_id,
+                   events.c.user_id, events.c.role_id, events.c.actor_id]) \
+        .where(and_(*conditions)).order_by(events.c.occurred_at, events.c.id)
+
+
+# Count the membership events recorded since the latest snapshot
+def events_since_snapshot():
+    latest = db.session.execute(select([func.max(AccessSnapshot.taken_at)])).scalar()
+    query = select([func.count()]).select_from(AccessEvent.__table__) \
+        .where(AccessEvent.kind.in_(MEMBERSHIP_EVENTS))
+    if latest is not None:
+        query = query.where(AccessEvent.occurred_at > latest)
+    return db.session.execute(query).scalar()
+
+
+# Take a snapshot of every grant as of now less lag seconds, which leaves transactions that were still open at that
+# time room to commit their events first. The first snapshot is read from the Requests effective now, later ones are
+# the previous snapshot with the events in between replayed. Grant starts and expiries are logged at their valid_from
+# and valid_until once a grant sweep gets to them, so later snapshots are never taken past the time the sweeps have
+# reached, nor at all while time bound grants wait for a first sweep. Returns the new AccessSnapshot, or None if the
+# latest one is not older than that time.
+def take_snapshot(now=None, lag=None):
+    lag = app.config.get('AUDIT_SNAPSHOT_LAG', 60) if lag is None else lag
+    now = now or datetime.utcnow()
+    previous = AccessSnapshot.query.order_by(AccessSnapshot.taken_at.desc()).first()
+    taken_at = now - timedelta(seconds=lag) if previous is not None else now
+    if previous is not None:
+        swept_until = Request.swept_until()
+        if swept_until is not None:
+            taken_at = min(taken_at, swept_until)
+        elif db.session.query(Request.query.filter(Request.status == 'APPROVED', or_(
+                Request.valid_from.isnot(None), Request.valid_until.isnot(None))).exists()).scalar():
+            return None
+    if previous is not None and previous.taken_at >= taken_at:
+        return None
+    if previous is None:
+        grants = {request_id: (user_id, role_id) for request_id, user_id, role_id in db.session.execute(
+            select([Request.id, Request.requested_for_id, Request.role_id]).where(Request.effective(taken_at)))}
+    else:
+        grants = _replay(_snapshot_grants(previous), previous, taken_at)
+    snapshot = AccessSnapshot(taken_at=taken_at, grant_count=len(grants))
+    db.session.add(snapshot)
+    db.session.flush()
+    rows = [{"snapshot_id": snapshot.id, "request_id": request_id, "user_id": user_id, "role_id": role_id}
+            for request_id, (user_id, role_id) in sorted(grants.items())]
+    for start in range(0, len(rows), SNAPSHOT_BATCH_SIZE):
+        db.session.execute(access_snapshot_grants.insert(), rows[start:start + SNAPSHOT_BATCH_SIZE])
+    db.session.commit()
+    return snapshot
+
+
+# Take a snapshot if there is none yet or at least AUDIT_SNAPSHOT_EVENTS membership events were recorded since the
+# latest one, which bounds the number of events a point-in-time query replays. Returns the new snapshot or None.
+def snapshot_if_due():
+    if AccessSnapshot.query.first() is None or \
+            events_since_snapshot() >= app.config.get('AUDIT_SNAPSHOT_EVENTS', 100000):
+        return take_snapshot()
+    return None
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+# Thread safe least recently used cache whose entries also expire ttl seconds after they were stored.
+# Keeps hit, miss and eviction counts so the cache can be sized from real traffic.
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    # Get the value stored under key, or default if it is missing or expired
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    # Store a value under key, evicting the least recently used entry if the cache is full
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Drop the entries stored under the given keys
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    # Drop every entry
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Get hit, miss and eviction counts along with the current size and hit ratio
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_ratio": float(self.hits) / lookups if lookups else 0.0}
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,261 @@
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from app import db
+from app.identity import identity_cache
+from app.models import User, Role, role_parents, role_approvers, role_closure, mark_role_graph_changed
+from app.provisioning import chunks
+
+# Catalog file formats
+FORMATS = ('csv', 'json', 'yaml')
+# Separator between the parent names and approver ids in a CSV cell, which Role names may therefore not contain
+CSV_LIST_SEPARATOR = ';'
+# Longest Role name and description the columns can hold
+MAX_LENGTH = 255
+
+
+# Raised when a catalog cannot be imported. Lists every problem found.
+class CatalogError(ValueError):
+    def __init__(self, errors):
+        super(CatalogError, self).__init__('; '.join(errors))
+        self.errors = errors
+
+
+# Load the yaml module, which is only needed for YAML catalogs
+def _yaml():
+    try:
+        import yaml
+    except ImportError:
+        raise CatalogError(['YAML catalogs need the PyYAML package'])
+    return yaml
+
+
+# Parse a catalog into a list of {name, desc, parents, approvers} entries, where parents is a list of Role names and
+# approvers a list of User ids. CSV catalogs have name, desc, parents and approvers columns with lists separated by
+# semicolons. JSON and YAML catalogs are a list of entries, optionally under a "roles" key.
+def parse_catalog(stream, catalog_format):
+    if catalog_format == 'csv':
+        entries = [{"name": row.get("name"), "desc": row.get("desc"),
+                    "parents": [name for name in (row.get("parents") or '').split(CSV_LIST_SEPARATOR) if name],
+                    "approvers": [user for user in (row.get("approvers") or '').split(CSV_LIST_SEPARATOR) if user]}
+                   for row in csv.DictReader(stream)]
+    elif catalog_format in ('json', 'yaml'):
+        parser = json if catalog_format == 'json' else _yaml()
+        try:
+            data = parser.load(stream) if catalog_format == 'json' else parser.safe_load(stream)
+        except (ValueError, getattr(parser, 'YAMLError', ValueError)) as error:
+            raise CatalogError(['The catalog is not valid ' + catalog_format.upper() + ': ' + str(error)])
+        entries = data.get("roles") if isinstance(data, dict) else data
+        if not isinstance(entries, list):
+            raise CatalogError(['The catalog must be a list of roles'])
+    else:
+        raise CatalogError(['Unknown catalog format: ' + str(catalog_format)])
+    return entries
+
+
+# Check whether a catalog value is a User id: an integer or, as CSV catalogs have them, a string of digits
+def _is_id(value):
+    if isinstance(value, str):
+        return value.strip().isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Check a parsed catalog without touching the database. Every field is type checked, since JSON and YAML catalogs can
+# hold any value. Returns the entries normalized and ordered so that every Role comes after its parents from the
+# catalog, or raises CatalogError listing every problem found.
+def validate_catalog(entries):
+    errors = []
+    roles = {}
+    for number, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str) or not entry["name"].strip():
+            errors.append('Entry ' + str(number) + ' has no name')
+            continue
+        name = entry["name"].strip()
+        if CSV_LIST_SEPARATOR in name:
+            # CSV catalogs list parents separated by it, so such a name would not survive an export and import
+            errors.append('Role ' + name + ' has a name containing ' + CSV_LIST_SEPARATOR)
+            continue
+        if name in roles:
+            errors.append('Role ' + name + ' is listed more than once')
+            continue
+        desc = entry.get("desc")
+        if desc is None:
+            desc = ''
+        elif not isinstance(desc, str):
+            errors.append('Role ' + name + ' has a description that is not text')
+            desc = ''
+        approvers = entry.get("approvers")
+        if approvers is None:
+            approvers = []
+        elif not isinstance(approvers, list):
+            errors.append('Role ' + name + ' has approvers that are not a list')
+            approvers = []
+        elif not all(_is_id(user) for user in approvers):
+            errors.append('Role ' + name + ' has an approver that is not a user id')
+            approvers = []
+        parents = entry.get("parents")
+        if parents is None:
+            parents = []
+        elif not isinstance(parents, list):
+            errors.append('Role ' + name + ' has parents that are not a list')
+            parents = []
+        elif not all(isinstance(parent, str) and parent.strip() for parent in parents):
+            errors.append('Role ' + name + ' has a parent that is not a role name')
+            parents = []
+        elif any(CSV_LIST_SEPARATOR in parent for parent in parents):
+            errors.append('Role ' + name + ' has a parent name containing ' + CSV_LIST_SEPARATOR)
+            parents = []
+        if len(name) > MAX_LENGTH or len(desc) > MAX_LENGTH:
+            errors.append('Role ' + name + ' has a name or description over ' + str(MAX_LENGTH) + ' characters')
+        roles[name] = {"name": name, "position": number, "desc": desc,
+                       "approvers": sorted({int(user) for user in approvers}),
+                       "parents": sorted({parent.strip() for parent in parents})}
+
+    # Order the Roles parents first with a depth first walk, which also finds every cycle among them
+    ordered = []
+    done = set()
+    for start in sorted(roles):
+        if start in done:
+            continue
+        visiting = {start}
+        stack = [(start, iter(roles[start]["parents"]))]
+        while stack:
+            name, parents = stack[-1]
+            parent = next(parents, None)
+            if parent is None:
+                stack.pop()
+                visiting.discard(name)
+                done.add(name)
+                ordered.append(roles[name])
+            elif parent in visiting:
+                errors.append('Role ' + name + ' inherits from itself through ' + parent)
+            elif parent in roles and parent not in done:
+                visiting.add(parent)
+                stack.append((parent, iter(roles[parent]["parents"])))
+    if errors:
+        raise CatalogError(errors)
+    return ordered
+
+
+# Create every Role of a catalog with its parents and approvers in one transaction. The catalog is validated in memory
+# first, then every Role name and User id it mentions is resolved with a few set based queries, and the Roles,
+# parents, approvers and role_closure rows are written with one executemany each. Parents may be other Roles of the
+# catalog or existing Roles. Returns the number of rows written to each table, or raises CatalogError.
+def import_catalog(entries):
+    roles = validate_catalog(entries)
+    names = [role["name"] for role in roles]
+    parent_names = sorted({parent for role in roles for parent in role["parents"]} - set(names))
+    approver_ids = sorted({user for role in roles for user in role["approvers"]})
+
+    # Resolve every name and id against the database
+    existing = set()
+    for chunk in chunks(names):
+        existing.update(name for name, in db.session.execute(select([Role.name]).where(Role.name.in_(chunk))))
+    parent_ids = {}
+    for chunk in chunks(parent_names):
+        parent_ids.update(db.session.execute(select([Role.name, Role.id]).where(Role.name.in_(chunk))).fetchall())
+    users = set()
+    for chunk in chunks(approver_ids):
+        users.update(user_id for user_id, in db.session.execute(select([User.id]).where(User.id.in_(chunk))))
+    errors = ['Role ' + name + ' already exists' for name in sorted(existing)] + \
+             ['Parent role ' + name + ' does not exist' for name in parent_names if name not in parent_ids] + \
+             ['Approver ' + str(user) + ' does not exist' for user in approver_ids if user not in users]
+    if errors:
+        raise CatalogError(errors)
+
+    # Insert the Roles in catalog order, so an exported catalog keeps its order when imported again, and read back
+    # their ids
+    db.session.execute(Role.__table__.insert(), [{"name": role["name"], "desc": role["desc"]}
+                                                 for role in sorted(roles, key=lambda role: role["position"])])
+    ids = dict(parent_ids)
+    for chunk in chunks(names):
+        ids.update(db.session.execute(select([Role.name, Role.id]).where(Role.name.in_(chunk))).fetchall())
+    parents = [{"role_id": ids[role["name"]], "parent_id": ids[parent]}
+               for role in roles for parent in role["parents"]]
+    approvers = [{"role_id": ids[role["name"]], "user_id": user} for role in roles for user in role["approvers"]]
+
+    # Work out the closure of the new Roles, parents first, starting from the ancestors of the existing parents
+    ancestors = {}
+    existing_parents = sorted(parent_ids.values())
+    for chunk in chunks(existing_parents):
+        for ancestor_id, descendant_id, depth in db.session.execute(
+                select([role_closure.c.ancestor_id, role_closure.c.descendant_id, role_closure.c.depth])
+                .where(role_closure.c.descendant_id.in_(chunk))):
+            ancestors.setdefault(descendant_id, {})[ancestor_id] = depth
+    closure = []
+    for role in roles:
+        role_id = ids[role["name"]]
+        paths = {role_id: 0}
+        for parent in role["parents"]:
+            for ancestor_id, depth in ancestors[ids[parent]].items():
+                paths[ancestor_id] = min(depth + 1, paths.get(ancestor_id, depth + 1))
+        ancestors[role_id] = paths
+        closure.extend({"ancestor_id": ancestor_id, "descendant_id": role_id, "depth": depth}
+                       for ancestor_id, depth in paths.items())
+
+    for table, rows in ((role_parents, parents), (role_approvers, approvers), (role_closure, closure)):
+        if rows:
+            db.session.execute(table.insert(), rows)
+    mark_role_graph_changed()
+    db.session.commit()
+    # The approvers now approve new Roles
+    identity_cache.invalidate(*approver_ids)
+    return {"roles": len(roles), "parents": len(parents), "approvers": len(approvers), "closure": len(closure)}
+
+
+# Yield every Role in id order as a {name, desc, parents, approvers} entry. The Roles, parents and approvers are read
+# with three streamed queries ordered by Role id and merged, so memory stays flat however big the catalog is.
+def stream_catalog():
+    parents = role_parents.join(Role.__table__, Role.id == role_parents.c.parent_id)
+    queries = [select([Role.id, Role.name, Role.desc]).order_by(Role.id),
+               select([role_parents.c.role_id, Role.name]).select_from(parents)
+               .order_by(role_parents.c.role_id, Role.name),
+               select([role_approvers.c.role_id, role_approvers.c.user_id])
+               .order_by(role_approvers.c.role_id, role_approvers.c.user_id)]
+    connection = db.engine.connect().execution_options(stream_results=True)
+    try:
+        roles, parent_rows, approver_rows = [iter(connection.execute(query)) for query in queries]
+        parent = next(parent_rows, None)
+        approver = next(approver_rows, None)
+        for role_id, name, desc in roles:
+            entry = {"name": name, "desc": desc or '', "parents": [], "approvers": []}
+            while parent is not None and parent[0] <= role_id:
+                if parent[0] == role_id:
+                    entry["parents"].append(parent[1])
+                parent = next(parent_rows, None)
+            while approver is not None and approver[0] <= role_id:
+                if approver[0] == role_id:
+                    entry["approvers"].append(approver[1])
+                approver = next(approver_rows, None)
+            yield entry
+    finally:
+        connection.close()
+
+
+# Encode a stream of catalog entries in the given format, yielding one string per Role
+def encode_catalog(entries, catalog_format):
+    if catalog_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["name", "desc", "parents", "approvers"])
+        for entry in entries:
+            writer.writerow([entry["name"], entry["desc"], CSV_LIST_SEPARATOR.join(entry["parents"]),
+                             CSV_LIST_SEPARATOR.join(str(user) for user in entry["approvers"])])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    elif catalog_format == 'json':
+        separator = '[\n'
+        for entry in entries:
+            yield separator + json.dumps(entry)
+            separator = ',\n'
+        yield '[]\n' if separator == '[\n' else '\n]\n'
+    elif catalog_format == 'yaml':
+        yaml = _yaml()
+        for entry in entries:
+            yield yaml.safe_dump([entry], default_flow_style=False)
+    else:
+        raise CatalogError(['Unknown catalog format: ' + str(catalog_format)])
@@ -0,0 +1,36 @@
+import time
+
+from app.entitlements import EntitlementIndex
+from app.models import ConflictRule
+
+
+# Scan every User's effectively held Roles for conflict rule violations. The held Roles come from a freshly built
+# EntitlementIndex unless one is given, and each rule is turned into a bitset of the index's bit positions so testing
+# a User against a rule is a single AND of two ints. Users holding none of the Roles in any rule are skipped with one
+# AND. Returns a list of {user_id, rule, role_ids} violations and the seconds the scan took.
+def scan_conflicts(index=None):
+    start = time.time()
+    if index is None:
+        index = EntitlementIndex()
+        index.rebuild()
+    # items() brings the index up to date, so read it before building the rule masks from its bit positions
+    users = index.items()
+    rules = []
+    covered = 0
+    for rule_id, (name, max_roles, role_ids) in sorted(ConflictRule.load().items()):
+        mask = index.mask(role_ids)
+        rules.append((name, max_roles, mask))
+        covered |= mask
+    violations = []
+    for user_id, bits in users:
+        if not bits & covered:
+            continue
+        for name, max_roles, mask in rules:
+            held = bits & mask
+            # Clearing the lowest bit max_roles times leaves something only if more than max_roles bits are set
+            remaining = held
+            for _ in range(max_roles):
+                remaining &= remaining - 1
+            if remaining:
+                violations.append({"user_id": user_id, "rule": name, "role_ids": index.role_ids(held)})
+    return violations, time.time() - start
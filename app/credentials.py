@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from sqlalchemy_utils import Password
+
+from app import app, db
+from app.models import User
+
+
+# Raised when the verification pool is saturated and a login attempt cannot be admitted
+class CredentialServiceBusy(Exception):
+    pass
+
+
+# Verifies passwords on a bounded pool of worker threads so a burst of logins cannot pin every request thread in
+# PBKDF2. At most workers hashes run at once and at most queue_size more may wait for a worker; anything beyond that
+# is refused immediately instead of queueing. The hashing cost is stored in each hash, and a hash made under an older
+# policy is replaced after a successful login.
+class CredentialService(object):
+    def __init__(self, context, workers=4, queue_size=32, timeout=10, samples=1000):
+        self.context = context
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=samples)
+        self.in_flight = 0
+        self.verified = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    # Check the password against the given User's stored hash. Returns True if it matches. If the stored hash does not
+    # meet the current policy it is replaced on the User, to be saved with the next commit. A verification that times
+    # out is cancelled if it is still queued; one already hashing keeps its slot until it finishes, so the pool never
+    # holds more work than it admitted.
+    def verify(self, user, password):
+        if not self._slots.acquire(False):
+            with self._lock:
+                self.rejected += 1
+            raise CredentialServiceBusy()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            future = self._pool.submit(self._verify, password, user.password.hash)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        try:
+            valid, new_hash = future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self._lock:
+                self.rejected += 1
+            raise CredentialServiceBusy()
+        if valid and new_hash is not None:
+            user.password = Password(new_hash.encode('utf8'))
+            with self._lock:
+                self.rehashed += 1
+        return valid
+
+    # Give back the slot of a verification once it finished or was cancelled
+    def _release(self, future):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    # Hash the password on a worker thread and time it
+    def _verify(self, password, stored_hash):
+        start = time.time()
+        result = self.context.verify_and_update(password, stored_hash)
+        with self._lock:
+            self.verified += 1
+            self._latencies.append((time.time() - start) * 1000)
+        return result
+
+    # Verification counts and hashing latency in milliseconds over the most recent samples
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {"workers": self.workers, "in_flight": self.in_flight, "verified": self.verified,
+                     "rejected": self.rejected, "rehashed": self.rehashed, "samples": len(latencies)}
+        for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            stats[name] = latencies[int(fraction * (len(latencies) - 1))] if latencies else 0.0
+        stats["max_ms"] = latencies[-1] if latencies else 0.0
+        return stats
+
+
+# Process wide verification service using the hashing policy of the User password column
+credential_service = CredentialService(User.password.type.context, app.config.get('PASSWORD_WORKERS', 4),
+                                       app.config.get('PASSWORD_QUEUE_SIZE', 32),
+                                       app.config.get('PASSWORD_TIMEOUT', 10))
@@ -0,0 +1,63 @@
+import sqlite3
+
+from sqlalchemy import event, inspect, DateTime
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+# Pool settings passed through to Flask-SQLAlchemy for server databases
+POOL_SETTINGS = ('POOL_SIZE', 'MAX_OVERFLOW', 'POOL_RECYCLE', 'POOL_TIMEOUT')
+
+
+# Apply the per backend engine settings from the config. Must run before the engine is first used.
+# SQLite connections get the configured PRAGMAs (WAL, synchronous, mmap and busy timeout) as they are opened, while
+# server databases such as PostgreSQL and MySQL get the configured connection pool settings.
+def configure_engine(app):
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        pragmas = app.config.get('SQLITE_PRAGMAS', {})
+
+        @event.listens_for(Engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            if isinstance(dbapi_connection, sqlite3.Connection):
+                cursor = dbapi_connection.cursor()
+                for name, value in pragmas.items():
+                    cursor.execute('PRAGMA ' + name + ' = ' + str(value))
+                cursor.close()
+    else:
+        for setting in POOL_SETTINGS:
+            if app.config.get('DATABASE_' + setting) is not None:
+                app.config['SQLALCHEMY_' + setting] = app.config['DATABASE_' + setting]
+
+
+# Create the indexes declared on the models that are missing from an existing database. Returns their names.
+def create_missing_indexes(engine, metadata):
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    created = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+
+# The current UTC time in SQL, for comparing against the UTC timestamps the models store
+class utc_now(FunctionElement):
+    type = DateTime()
+    name = 'utc_now'
+
+
+@compiles(utc_now)
+def compile_utc_now(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
+# SQLite's CURRENT_TIMESTAMP has whole seconds and compares as text against the fractional timestamps stored by
+# SQLAlchemy, so include the milliseconds there
+@compiles(utc_now, 'sqlite')
+def compile_sqlite_utc_now(element, compiler, **kw):
+    return "STRFTIME('%Y-%m-%d %H:%M:%f', 'now')"
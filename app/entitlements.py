@@ -0,0 +1,233 @@
+import threading
+import time
+
+from sqlalchemy import event, select, case
+from sqlalchemy.orm import Session
+
+from app import app, db
+from app.models import Request, role_closure, entitlement_version, bump_entitlement_version
+
+
+# In-memory answer to "does User U hold Role R, directly or through inheritance?". Each Role is given a dense bit
+# position, and each User maps to a bitset, kept as a Python int, with the bit of every Role they effectively hold set:
+# the Roles of their effective Requests and all of their descendant Roles. The index is built in bulk from the database
+# and then kept current from the Requests and Role graph changes committed by this process. The entitlement version is
+# read from the database at most once every version_ttl seconds, and a version this process did not apply means another
+# process or script committed a change, so the index is rebuilt. Changes of other processes are therefore seen within
+# version_ttl seconds. The index is also rebuilt after max_age seconds, as validity windows pass.
+class EntitlementIndex(object):
+    def __init__(self, max_age=300, version_ttl=1):
+        self.max_age = max_age
+        self.version_ttl = version_ttl
+        self.built_at = None
+        self.build_seconds = None
+        self.version = None
+        # Latest entitlement version read from the database, and when it was read
+        self.seen_version = None
+        self.seen_at = None
+        self.checks = 0
+        self.deltas = 0
+        self.rebuilds = 0
+        self._lock = threading.Lock()
+        # Held while rebuilding, so concurrent checks of a stale index wait for one rebuild instead of each running one
+        self._build_lock = threading.Lock()
+        # Role id -> bit position, and bit position -> Role id
+        self._positions = {}
+        self._roles = []
+        # Role id -> bitset of the Role and its descendants
+        self._role_bits = {}
+        # User id -> set of Role ids granted by effective Requests
+        self._grants = {}
+        # User id -> bitset of effectively held Role ids
+        self._bits = {}
+
+    # Load the entitlement version, every effective Request and the Role closure and swap in freshly built bitsets.
+    # The version is read first, so a change committed during the build makes the next check rebuild again.
+    def rebuild(self, connection=None):
+        start = time.time()
+        connection = connection or db.session
+        version = entitlement_version(connection)
+        closure = connection.execute(select([role_closure.c.ancestor_id, role_closure.c.descendant_id])).fetchall()
+        positions, roles, role_bits = self._layout(closure)
+        grants = {}
+        for user_id, role_id in connection.execute(select([Request.requested_for_id, Request.role_id])
+                                                   .where(Request.effective())):
+            grants.setdefault(user_id, set()).add(role_id)
+        bits = {user_id: self._combine(positions, roles, role_bits, role_ids) for user_id, role_ids in grants.items()}
+        with self._lock:
+            self._positions, self._roles, self._role_bits = positions, roles, role_bits
+            self._grants, self._bits = grants, bits
+            self.version = version
+            self.built_at = time.time()
+            self.seen_version, self.seen_at = version, self.built_at
+            self.build_seconds = self.built_at - start
+            self.rebuilds += 1
+
+    # Rebuild the index if it was never built, is older than max_age or is behind the committed entitlement version
+    def ensure_current(self):
+        version = self._committed_version()
+        if self._stale(version):
+            with self._build_lock:
+                # Another thread may have rebuilt the index while this one waited
+                if self._stale(version):
+                    self.rebuild()
+
+    # Get the committed entitlement version, reusing the one last read for version_ttl seconds
+    def _committed_version(self):
+        if self.seen_at is not None and time.time() - self.seen_at < self.version_ttl:
+            return self.seen_version
+        with self._lock:
+            if self.seen_at is None or time.time() - self.seen_at >= self.version_ttl:
+                self.seen_version, self.seen_at = entitlement_version(), time.time()
+            return self.seen_version
+
+    def _stale(self, version):
+        return self.built_at is None or time.time() - self.built_at > self.max_age or self.version < version
+
+    # Check whether the User effectively holds the Role
+    def check(self, user_id, role_id):
+        return self.check_many([(user_id, role_id)])[0]
+
+    # Check many (user_id, role_id) pairs at once. Returns a list of booleans in the same order.
+    def check_many(self, pairs):
+        self.ensure_current()
+        bits = self._bits
+        positions = self._positions
+        results = [role_id in positions and bool(bits.get(user_id, 0) >> positions[role_id] & 1)
+                   for user_id, role_id in pairs]
+        self.checks += len(results)
+        return results
+
+    # Get the ids of the Roles the User effectively holds
+    def roles_of(self, user_id):
+        self.ensure_current()
+        return self.role_ids(self._bits.get(user_id, 0))
+
+    # Build the bitset of the given Role ids in this index's bit positions. Roles the index does not know are skipped,
+    # since nobody holds them.
+    def mask(self, role_ids):
+        positions = self._positions
+        bits = 0
+        for role_id in role_ids:
+            if role_id in positions:
+                bits |= 1 << positions[role_id]
+        return bits
+
+    # Get the sorted ids of the Roles set in a bitset of this index
+    def role_ids(self, bits):
+        roles = self._roles
+        ids = []
+        while bits:
+            low = bits & -bits
+            ids.append(roles[low.bit_length() - 1])
+            bits ^= low
+        return sorted(ids)
+
+    # Iterate over every (user_id, bitset) pair in the index. Use mask and role_ids to translate Role ids.
+    def items(self):
+        self.ensure_current()
+        return list(self._bits.items())
+
+    # Apply committed (user_id, role_id, effective) Request rows and, if the Role graph changed, the new Role closure.
+    # version is the entitlement version the commit moved to. The index only takes it if it was current just before,
+    # otherwise another process committed in between and the next check rebuilds.
+    def apply(self, requests, closure=None, version=None):
+        with self._lock:
+            if self.built_at is None:
+                return
+            if version is not None and self.version is not None and version == self.version + 1:
+                self.version = version
+                if self.seen_version is not None and self.seen_version < version:
+                    self.seen_version = version
+            changed = set()
+            for user_id, role_id, effective in requests:
+                if effective:
+                    self._grants.setdefault(user_id, set()).add(role_id)
+                else:
+                    self._grants.get(user_id, set()).discard(role_id)
+                changed.add(user_id)
+            if closure is not None:
+                # Every User may be affected, so build new maps and swap them in
+                positions, roles, role_bits = self._layout(closure)
+                bits = {user_id: self._combine(positions, roles, role_bits, role_ids)
+                        for user_id, role_ids in self._grants.items()}
+                self._positions, self._roles, self._role_bits, self._bits = positions, roles, role_bits, bits
+            else:
+                # Replacing single entries is atomic, so concurrent checks see either the old or the new bitset
+                for user_id in changed:
+                    self._bits[user_id] = self._combine(self._positions, self._roles, self._role_bits,
+                                                        self._grants.get(user_id, ()))
+            self.deltas += 1
+
+    # Size and activity of the index
+    def stats(self):
+        return {"users": len(self._bits), "roles": len(self._role_bits), "checks": self.checks,
+                "deltas": self.deltas, "rebuilds": self.rebuilds, "version": self.version,
+                "built_at": self.built_at, "build_seconds": self.build_seconds}
+
+    # Give every Role of the closure a bit position, in Role id order, and build the {role_id: bitset} of each Role
+    # and its descendants. Returns the positions, the Role id of each position and the bitsets.
+    @staticmethod
+    def _layout(closure):
+        roles = sorted({role_id for pair in closure for role_id in pair})
+        positions = {role_id: position for position, role_id in enumerate(roles)}
+        role_bits = {}
+        for ancestor_id, descendant_id in closure:
+            role_bits[ancestor_id] = role_bits.get(ancestor_id, 0) | (1 << positions[descendant_id])
+        return positions, roles, role_bits
+
+    # Combine the bitsets of the given Roles. A Role created since the layout was built gets the next free position.
+    @staticmethod
+    def _combine(positions, roles, role_bits, role_ids):
+        bits = 0
+        for role_id in role_ids:
+            if role_id not in positions:
+                positions[role_id] = len(roles)
+                roles.append(role_id)
+            bits |= role_bits.get(role_id, 1 << positions[role_id])
+        return bits
+
+
+# Process wide entitlement index
+entitlement_index = EntitlementIndex(app.config.get('ENTITLEMENT_MAX_AGE', 300),
+                                     app.config.get('ENTITLEMENT_VERSION_TTL', 1000) / 1000.0)
+
+
+# Build the index before the first request is served
+@app.before_first_request
+def build_entitlement_index():
+    entitlement_index.ensure_current()
+
+
+# Read the final state of the changed Requests and Role graph while the transaction is still open
+@event.listens_for(Session, 'before_commit')
+def load_entitlement_changes(session):
+    if entitlement_index.built_at is None:
+        return
+    # Commit flushes after this event, so flush now to see every pending change
+    session.flush()
+    request_ids = sorted(session.info.get('changed_requests', ()))
+    rows = []
+    for start in range(0, len(request_ids), 500):
+        rows.extend(session.execute(select([Request.requested_for_id, Request.role_id,
+                                            case([(Request.effective(), True)], else_=False)])
+                                    .where(Request.id.in_(request_ids[start:start + 500]))).fetchall())
+    closure = None
+    if session.info.get('role_graph_changed'):
+        closure = session.execute(select([role_closure.c.ancestor_id, role_closure.c.descendant_id])).fetchall()
+    if rows or closure is not None:
+        session.info['entitlement_changes'] = (rows, closure, bump_entitlement_version(session))
+
+
+# Apply the changes to the index once they are committed
+@event.listens_for(Session, 'after_commit')
+def apply_entitlement_changes(session):
+    changes = session.info.pop('entitlement_changes', None)
+    if changes is not None:
+        entitlement_index.apply(*changes)
+
+
+# Forget the changes of a rolled back transaction
+@event.listens_for(Session, 'after_rollback')
+def discard_entitlement_changes(session):
+    session.info.pop('entitlement_changes', None)
@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import select, and_
+
+from app import db
+from app.models import User, Role, Request, request_approvers, role_closure
+
+# Rows fetched from the server side cursor at a time
+CHUNK_SIZE = 1000
+# Date formats accepted by the date filters
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S')
+
+
+# Parse a date filter value. Raises ValueError if it is not a date.
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError("Dates must be formatted YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS: " + value)
+
+
+# Build the statement selecting one kind of export:
+#   requests    every Request with its Role and Users
+#   grants      effective Requests, the data behind User.active_roles and role membership
+#   decisions   every request_approvers decision with its Request
+# Filters are optional: Request status, Role id (with its descendant Roles when descendants is True) and the range of
+# Request creation dates, since inclusive and until exclusive. Rows are ordered by Request id.
+def export_statement(kind, status=None, role_id=None, descendants=False, since=None, until=None):
+    requests = Request.__table__
+    roles = Role.__table__
+    requested_for = User.__table__.alias('requested_for')
+    requested_by = User.__table__.alias('requested_by')
+    conditions = []
+    if kind == 'grants':
+        conditions.append(Request.effective())
+    if status is not None:
+        conditions.append(requests.c.status == status)
+    if role_id is not None:
+        if descendants:
+            conditions.append(requests.c.role_id.in_(select([role_closure.c.descendant_id])
+                                                     .where(role_closure.c.ancestor_id == role_id)))
+        else:
+            conditions.append(requests.c.role_id == role_id)
+    if since is not None:
+        conditions.append(requests.c.created_at >= since)
+    if until is not None:
+        conditions.append(requests.c.created_at < until)
+
+    if kind in ('requests', 'grants'):
+        columns = [requests.c.id.label('request_id'), requests.c.status, requests.c.role_id,
+                   roles.c.name.label('role_name'), requests.c.requested_for_id,
+                   requested_for.c.name.label('requested_for_name'), requests.c.requested_by_id,
+                   requested_by.c.name.label('requested_by_name'), requests.c.comment, requests.c.created_at,
+                   requests.c.valid_from, requests.c.valid_until]
+        joins = requests.join(roles, roles.c.id == requests.c.role_id) \
+            .join(requested_for, requested_for.c.id == requests.c.requested_for_id) \
+            .join(requested_by, requested_by.c.id == requests.c.requested_by_id)
+        order = [requests.c.id]
+    elif kind == 'decisions':
+        approvers = User.__table__.alias('approver')
+        columns = [requests.c.id.label('request_id'), requests.c.status.label('request_status'), requests.c.role_id,
+                   roles.c.name.label('role_name'), requests.c.requested_for_id, request_approvers.c.user_id,
+                   approvers.c.name.label('approver_name'), request_approvers.c.approval_status,
+                   requests.c.created_at]
+        joins = requests.join(request_approvers, request_approvers.c.request_id == requests.c.id) \
+            .join(roles, roles.c.id == requests.c.role_id) \
+            .join(approvers, approvers.c.id == request_approvers.c.user_id)
+        order = [requests.c.id, request_approvers.c.user_id]
+    else:
+        raise ValueError("Unknown export: " + str(kind))
+    return select(columns).select_from(joins).where(and_(*conditions)).order_by(*order)
+
+
+# Execute a statement on its own connection with a server side cursor and yield its column names and then each row.
+# Only CHUNK_SIZE rows are held in memory at a time.
+def stream_rows(statement, chunk_size=CHUNK_SIZE):
+    connection = db.engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(statement)
+        yield result.keys()
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        connection.close()
+
+
+# Format a value for export
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+# Encode streamed rows as CSV with a header row, yielding one string per chunk of rows
+def to_csv(rows, chunk_size=CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for count, row in enumerate(rows):
+        writer.writerow([_value(value) for value in row])
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# Encode streamed rows as newline delimited JSON objects, yielding one string per chunk of rows
+def to_ndjson(rows, chunk_size=CHUNK_SIZE):
+    rows = iter(rows)
+    keys = list(next(rows))
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(keys, [_value(value) for value in row]))))
+        if len(lines) == chunk_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+# Supported export formats as (encoder, mimetype)
+FORMATS = {'csv': (to_csv, 'text/csv'), 'ndjson': (to_ndjson, 'application/x-ndjson')}
@@ -1,9 +1,10 @@
 from flask_login import login_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, BooleanField, SubmitField, PasswordField, SelectField, TextAreaField, \
-    SelectMultipleField
-from wtforms.validators import InputRequired, ValidationError
+    SelectMultipleField, DateTimeField
+from wtforms.validators import InputRequired, Optional, ValidationError
 from app.models import *
+from app.credentials import credential_service, CredentialServiceBusy
 
 
 # Create a new type of select field that supports dynamic choices added by the browser
@@ -32,9 +33,15 @@ def validate_login(form, field):
         user_id = int(user_id)
         # Find a user within the database with matching user ID
         user = User.query.get(user_id)
-        # Validate login information
-        if user is not None and user.password == password:
-            # User ID and password match, log the user in
+        # Validate login information on the verification pool
+        try:
+            valid = user is not None and credential_service.verify(user, password)
+        except CredentialServiceBusy:
+            # Throw this if too many logins are already being verified
+            raise ValidationError('Too many sign in attempts at the moment. Please try again.')
+        if valid:
+            # User ID and password match, save any upgraded hash and log the user in
+            db.session.commit()
             login_user(user, remember=remember_me)
         else:
             # Throw this if the login information entered is incorrect
@@ -44,6 +51,25 @@ def validate_login(form, field):
         raise ValidationError('User ID formatted incorrectly.')
 
 
+# Verify that none of the selected Roles would break a separation of duties rule for any of the selected Users. The
+# result is kept as form.conflicts, so the assignment does not check the same pairs again.
+def validate_assignment_conflicts(form, field):
+    conflicts = ConflictRule.find_conflicts([(user, role) for user in form.users.data for role in form.roles.data])
+    form.conflicts = conflicts
+    if conflicts:
+        # Throw this if any assignment would give a User a toxic combination of Roles
+        raise ValidationError('These assignments break separation of duties rules: ' +
+                              '; '.join(str(user) + ' ' + Role.query.get(role).name + ' (' + ', '.join(rules) + ')'
+                                        for (user, role), rules in sorted(conflicts.items())))
+
+
+# Verify that a time bound grant ends after it starts
+def validate_validity_window(form, field):
+    if form.valid_from.data is not None and field.data is not None and field.data <= form.valid_from.data:
+        # Throw this if the grant would never be effective
+        raise ValidationError('Access must end after it starts.')
+
+
 # Verify that the Role name does not already exist
 def validate_role_name(form, field):
     # Get the Role represented by the given name
@@ -59,6 +85,9 @@ def validate_role_inheritance(form, field):
     if any(x in parents for x in children):
         # Throw this if a Role is in both the Parent and Children dropdown
         raise ValidationError('Unable to add a Role as both a parent and child.')
+    if Role.would_cycle(parents, children):
+        # Throw this if one of the Children already inherits from one of the Parents
+        raise ValidationError('Unable to add a Role as a child of its own descendant.')
 
 
 # Login form
@@ -109,5 +138,9 @@ class AssignAccessForm(FlaskForm):
                                        validators=[InputRequired()])
     # Comment text area
     comment = TextAreaField(label='Comment', id='TXT_Comment')
+    # Optional first and last day of access, in UTC
+    valid_from = DateTimeField(label='Access From', id='TXT_ValidFrom', format='%Y-%m-%d', validators=[Optional()])
+    valid_until = DateTimeField(label='Access Until', id='TXT_ValidUntil', format='%Y-%m-%d',
+                                validators=[Optional(), validate_validity_window])
     # Submit button button
-    submit = SubmitField(label='Assign', id='BTN_Submit')
+    submit = SubmitField(label='Assign', id='BTN_Submit', validators=[validate_assignment_conflicts])
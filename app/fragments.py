@@ -0,0 +1,176 @@
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import g, request, make_response
+from jinja2 import nodes
+from jinja2.ext import Extension
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, attributes
+
+from app import app
+from app.cache import LRUCache
+from app.models import User, Role, Request
+
+# Version keys covering whole tables. ROLES changes with any Role name, description or inheritance change, USERS with
+# any User name or manager change and REQUESTS with any Request change. Single entities are versioned under
+# ('role', id), ('user', id) and ('grants', user_id) for the Requests made for a User.
+ROLES = 'roles'
+USERS = 'users'
+REQUESTS = 'requests'
+# Identifies this process in ETags, since its version counters mean nothing to another process
+PROCESS_TOKEN = '%d-%f' % (os.getpid(), time.time())
+
+
+# Per entity version counters, bumped when a transaction changing the entity commits. Rendered fragments and ETags are
+# stamped with the versions they were built from, so a bump makes them unreachable instead of having to find and
+# delete them. The counters only see the commits of this process, so stamps also carry a time bucket of ttl seconds
+# that bounds how long a change made by another process can go unseen.
+class VersionCounters(object):
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.started_at = datetime.utcnow()
+        self._lock = threading.Lock()
+        # key -> (version, datetime of the last bump)
+        self._versions = {}
+
+    # Get the versions of the given keys, along with the current time bucket
+    def stamp(self, keys):
+        versions = self._versions
+        return tuple(versions.get(key, (0,))[0] for key in keys) + (int(time.time() // self.ttl),)
+
+    # Get the time of the last change to any of the given keys, or the start of the time bucket if that is later
+    def last_modified(self, keys):
+        bucket = datetime.utcfromtimestamp(time.time() // self.ttl * self.ttl)
+        return max([bucket, self.started_at] + [self._versions[key][1] for key in keys if key in self._versions])
+
+    # Bump the versions of the given keys
+    def bump(self, keys):
+        now = datetime.utcnow()
+        with self._lock:
+            for key in keys:
+                self._versions[key] = (self._versions.get(key, (0,))[0] + 1, now)
+
+    def __len__(self):
+        return len(self._versions)
+
+
+# Process wide version counters and rendered fragment cache
+versions = VersionCounters(app.config.get('FRAGMENT_CACHE_TTL', 60))
+fragment_cache = LRUCache(app.config.get('FRAGMENT_CACHE_SIZE', 2048), app.config.get('FRAGMENT_CACHE_TTL', 60))
+# Conditional GETs answered with 304 Not Modified and with a full response
+conditional_stats = {"not_modified": 0, "modified": 0}
+
+
+# Build the fragment cache key of a page from its name, its own arguments and the versions it depends on
+def fragment_key(name, parts, keys):
+    return (name,) + tuple(parts) + versions.stamp(keys)
+
+
+# Jinja extension adding {% cache key %}...{% endcache %}. The body is rendered once per key and then served from
+# fragment_cache, so the queries it runs are skipped too. A missing or None key renders the body every time.
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [key]), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        if not key:
+            return caller()
+        value = fragment_cache.get(key)
+        if value is None:
+            value = caller()
+            fragment_cache.set(key, value)
+        return value
+
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+
+# Answer GET requests for a page with 304 Not Modified, without running the view, when the client's ETag or
+# Last-Modified date still matches the versions the page depends on. dependencies maps the view arguments to the
+# version keys, or to None for pages that should not be cached. The logged in User is part of the ETag because the
+# page chrome shows their name.
+def conditional(dependencies):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            keys = dependencies(**kwargs)
+            if keys is None or request.method != 'GET':
+                return view(**kwargs)
+            etag = hashlib.sha1(repr((PROCESS_TOKEN, request.path, g.user.id, g.user.name, versions.stamp(keys)))
+                                .encode('utf-8')).hexdigest()
+            last_modified = versions.last_modified(keys).replace(microsecond=0)
+            if 'If-None-Match' in request.headers:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = request.if_modified_since is not None and request.if_modified_since >= last_modified
+            if not_modified:
+                conditional_stats["not_modified"] += 1
+                response = app.response_class(status=304)
+            else:
+                conditional_stats["modified"] += 1
+                response = make_response(view(**kwargs))
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Browsers must check back every time, and shared caches must not keep a page rendered for one User
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+# Remember the version keys touched by the Roles, Users and Requests written through the ORM by a flush
+@event.listens_for(Session, 'after_flush')
+def collect_fragment_changes(session, flush_context):
+    keys = session.info.setdefault('fragment_changes', set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Role):
+            keys.add(('role', instance.id))
+            if instance in session.new or instance in session.deleted or \
+                    any(attributes.get_history(instance, name).has_changes() for name in ('name', 'desc')):
+                keys.add(ROLES)
+        elif isinstance(instance, User):
+            if instance in session.new or instance in session.deleted or \
+                    any(attributes.get_history(instance, name).has_changes() for name in ('name', 'manager_id')):
+                keys.update((('user', instance.id), USERS))
+        elif isinstance(instance, Request):
+            keys.update((('grants', instance.requested_for_id), REQUESTS))
+
+
+# Add the version keys of the Requests and Role graph changed by Core statements while the transaction is still open
+@event.listens_for(Session, 'before_commit')
+def load_fragment_changes(session):
+    # Commit flushes after this event, so flush now to see every pending change
+    session.flush()
+    request_ids = sorted(session.info.get('changed_requests', ()))
+    keys = session.info.setdefault('fragment_changes', set())
+    if request_ids:
+        keys.add(REQUESTS)
+        for start in range(0, len(request_ids), 500):
+            keys.update(('grants', user_id) for user_id, in session.execute(
+                select([Request.requested_for_id]).where(Request.id.in_(request_ids[start:start + 500])).distinct()))
+    if session.info.get('role_graph_changed'):
+        keys.add(ROLES)
+
+
+# Bump the versions once the changes are committed
+@event.listens_for(Session, 'after_commit')
+def bump_fragment_versions(session):
+    keys = session.info.pop('fragment_changes', None)
+    if keys:
+        versions.bump(keys)
+
+
+# Forget the changes of a rolled back transaction
+@event.listens_for(Session, 'after_rollback')
+def discard_fragment_changes(session):
+    session.info.pop('fragment_changes', None)
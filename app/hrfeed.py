@@ -0,0 +1,268 @@
+import csv
+import hashlib
+import json
+import os
+import time
+
+from sqlalchemy import select, bindparam
+from sqlalchemy_utils import Password
+
+from app import app, db
+from app.identity import identity_cache
+from app.models import User, Request
+from app.provisioning import chunks
+
+# HR feed file formats
+FORMATS = ('csv', 'ndjson')
+# Columns of a feed row. active is optional and defaults to true.
+COLUMNS = ('id', 'name', 'manager_id', 'active')
+# Spellings of the active column
+ACTIVE_VALUES = {'1', 'true', 't', 'yes', 'y', 'active', 'a'}
+INACTIVE_VALUES = {'0', 'false', 'f', 'no', 'n', 'inactive', 'i', 'terminated'}
+# Longest User name the column can hold
+MAX_NAME_LENGTH = 64
+# Rejected rows listed in a sync report. The rest are only counted.
+MAX_REPORTED_REJECTIONS = 100
+
+
+# Raised when a feed cannot be read at all, as opposed to the single rows that are rejected
+class FeedError(ValueError):
+    pass
+
+
+# Fingerprint the synced fields of a User, so a feed row and a users row can be compared by one short digest. Only the
+# name can contain the separator, and it comes first, so the encoding is unambiguous.
+def fingerprint(name, manager_id, active):
+    fields = '%s\x1f%s\x1f%d' % (name, manager_id, bool(active))
+    return hashlib.blake2b(fields.encode('utf-8'), digest_size=8).digest()
+
+
+# Parse a feed stream lazily into (line number, entry) pairs, where entry is a dict of the feed columns or, for a line
+# that is not valid, the error message. CSV feeds need a header with at least the id, name and manager_id columns,
+# NDJSON feeds have one object per line with the same keys.
+def parse_feed(stream, feed_format):
+    if feed_format == 'csv':
+        reader = csv.DictReader(stream)
+        missing = [column for column in COLUMNS[:3] if column not in (reader.fieldnames or [])]
+        if missing:
+            raise FeedError('The feed has no ' + ', '.join(missing) + ' column')
+        for row in reader:
+            yield reader.line_num, row
+    elif feed_format == 'ndjson':
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as error:
+                entry = 'Not valid JSON: ' + str(error)
+            yield number, entry if isinstance(entry, (dict, str)) else 'Not a JSON object'
+    else:
+        raise FeedError('Unknown feed format: ' + str(feed_format))
+
+
+# Parse an id or manager_id value, which must be an integer or a string of digits. Returns None if it is not.
+def parse_id(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+
+# Normalize a parsed feed entry into (id, name, manager_id, active). Raises ValueError naming the problem.
+def normalize(entry):
+    if isinstance(entry, str):
+        raise ValueError(entry)
+    user_id = parse_id(entry.get('id'))
+    if user_id is None:
+        raise ValueError('No valid id')
+    name = entry.get('name')
+    if not isinstance(name, str) or not name.strip() or len(name.strip()) > MAX_NAME_LENGTH:
+        raise ValueError('The name must be text of 1 to ' + str(MAX_NAME_LENGTH) + ' characters')
+    name = name.strip()
+    manager_id = entry.get('manager_id')
+    if manager_id is not None and manager_id != '':
+        manager_id = parse_id(manager_id)
+        if manager_id is None:
+            raise ValueError('No valid manager_id')
+    else:
+        manager_id = None
+    if manager_id == user_id:
+        raise ValueError('The user is their own manager')
+    active = entry.get('active')
+    if active is None or active == '':
+        active = True
+    elif not isinstance(active, bool):
+        if str(active).strip().lower() in ACTIVE_VALUES:
+            active = True
+        elif str(active).strip().lower() in INACTIVE_VALUES:
+            active = False
+        else:
+            raise ValueError('No valid active flag')
+    return user_id, name, manager_id, active
+
+
+# Read the {id: (fingerprint, active)} of every User with a streamed query, without loading any User objects
+def current_fingerprints():
+    connection = db.engine.connect().execution_options(stream_results=True)
+    try:
+        rows = connection.execute(select([User.id, User.name, User.manager_id, User.active_flag]))
+        return {user_id: (fingerprint(name, manager_id, active), bool(active))
+                for user_id, name, manager_id, active in rows}
+    finally:
+        connection.close()
+
+
+# Work out what a feed changes. Returns a dict with:
+#   inserts       {id: (id, name, manager_id, active)} of the Users to create
+#   updates       {id: row} of the Users whose name, manager or active flag changed
+#   deactivate    ids of the active Users missing from the feed, when deactivate_missing is True
+#   deactivated   ids of the Users the updates deactivate
+#   unchanged     number of rows matching their User
+#   rejected      (line, id, reason) of the rows that cannot be applied, including rows whose manager is neither an
+#                 existing User nor another row of the feed
+#   unidentified  True if a rejected row has no valid id. deactivate is then left empty, since that User may be
+#                 missing from the feed only because their row was rejected.
+# A User whose row is rejected still counts as listed in the feed, so a bad row never deactivates its User.
+def diff_feed(entries, deactivate_missing=False):
+    current = current_fingerprints()
+    seen = set()
+    inserts = {}
+    updates = {}
+    rejected = []
+    lines = {}
+    unchanged = 0
+    unidentified = False
+    for line, entry in entries:
+        try:
+            row = normalize(entry)
+        except ValueError as error:
+            user_id = parse_id(entry.get('id')) if isinstance(entry, dict) else None
+            if user_id is None:
+                unidentified = True
+            else:
+                seen.add(user_id)
+            rejected.append((line, user_id, str(error)))
+            continue
+        user_id = row[0]
+        if user_id in seen:
+            rejected.append((line, user_id, 'The user is listed more than once'))
+            continue
+        seen.add(user_id)
+        lines[user_id] = line
+        existing = current.get(user_id)
+        if existing is None:
+            inserts[user_id] = row
+        elif existing[0] != fingerprint(*row[1:]):
+            updates[user_id] = row
+        else:
+            unchanged += 1
+
+    # Reject rows with an unknown manager until none are left, since rejecting a new hire can orphan their reports
+    while True:
+        orphans = [row for row in list(inserts.values()) + list(updates.values())
+                   if row[2] is not None and row[2] not in current and row[2] not in inserts]
+        if not orphans:
+            break
+        for row in orphans:
+            inserts.pop(row[0], None)
+            updates.pop(row[0], None)
+            rejected.append((lines[row[0]], row[0], 'Manager ' + str(row[2]) + ' does not exist'))
+
+    deactivated = sorted(user_id for user_id, row in updates.items() if current[user_id][1] and not row[3])
+    deactivate = sorted(user_id for user_id, (_, active) in current.items()
+                        if active and user_id not in seen) if deactivate_missing and not unidentified else []
+    return {"inserts": inserts, "updates": updates, "deactivate": deactivate, "deactivated": deactivated,
+            "unchanged": unchanged, "rejected": sorted(rejected, key=lambda rejection: rejection[0]),
+            "unidentified": unidentified}
+
+
+# Order new Users into levels that can be inserted one after the other without breaking the manager_id foreign key:
+# each level only has Users whose manager already exists or is in an earlier level. New Users whose managers form a
+# cycle are returned separately, to be inserted without a manager and given one once they all exist.
+def insert_levels(inserts):
+    levels = []
+    remaining = dict(inserts)
+    while remaining:
+        level = [row for row in remaining.values() if row[2] is None or row[2] not in remaining]
+        if not level:
+            break
+        levels.append(sorted(level))
+        for row in level:
+            del remaining[row[0]]
+    return levels, sorted(remaining.values())
+
+
+# Apply a feed diff in batches of batch_size (HR_FEED_BATCH_SIZE by default), each written with one executemany and
+# committed on its own, so the write lock is never held for long and a failed run can simply be run again. New Users
+# are inserted managers first, then the changed Users are updated and finally the missing Users deactivated. The grants
+# and open Requests of the Users a batch deactivates are revoked in committed batches first, and whatever was granted
+# in between is revoked in the same transaction as the deactivation. New Users get the HR_FEED_PASSWORD password,
+# hashed once for the whole run, or an unusable random one if it is not set. Returns the number of Users inserted,
+# updated and deactivated and of grants revoked.
+def apply_diff(diff, batch_size=None):
+    batch_size = batch_size or app.config.get('HR_FEED_BATCH_SIZE', 500)
+    users = User.__table__
+    if diff["inserts"]:
+        secret = app.config.get('HR_FEED_PASSWORD') or os.urandom(32).hex()
+        password = Password(User.password.type.context.hash(secret).encode('utf8'))
+    counts = {"inserted": 0, "updated": 0, "deactivated": 0, "revoked": 0}
+
+    levels, cycles = insert_levels(diff["inserts"])
+    # Users in a cycle are created without a manager, and the update below sets it
+    updates = dict(diff["updates"])
+    updates.update((row[0], row) for row in cycles)
+    for level in levels + [[(user_id, name, None, active) for user_id, name, _, active in cycles]]:
+        for batch in chunks(level, batch_size):
+            db.session.execute(users.insert(), [{"id": user_id, "name": name, "manager_id": manager_id,
+                                                 "active_flag": active, "password": password}
+                                                for user_id, name, manager_id, active in batch])
+            db.session.commit()
+            counts["inserted"] += len(batch)
+
+    deactivated = set(diff["deactivated"])
+    statement = users.update().where(users.c.id == bindparam('user_id')) \
+        .values(name=bindparam('new_name'), manager_id=bindparam('new_manager_id'),
+                active_flag=bindparam('new_active'))
+    for batch in chunks(sorted(updates.values()), batch_size):
+        revoke = [row[0] for row in batch if row[0] in deactivated]
+        if revoke:
+            counts["revoked"] += Request.revoke(Request.requested_for_id.in_(revoke), batch_size)
+        db.session.execute(statement, [{"user_id": user_id, "new_name": name, "new_manager_id": manager_id,
+                                        "new_active": active} for user_id, name, manager_id, active in batch])
+        if revoke:
+            counts["revoked"] += Request.revoke(Request.requested_for_id.in_(revoke), batch_size, commit=False)
+        db.session.commit()
+        identity_cache.invalidate(*[row[0] for row in batch])
+        counts["updated"] += len([row for row in batch if row[0] in diff["updates"]])
+
+    for batch in chunks(diff["deactivate"], batch_size):
+        counts["revoked"] += Request.revoke(Request.requested_for_id.in_(batch), batch_size)
+        db.session.execute(users.update().where(users.c.id.in_(batch)).values(active_flag=False))
+        counts["revoked"] += Request.revoke(Request.requested_for_id.in_(batch), batch_size, commit=False)
+        db.session.commit()
+        identity_cache.invalidate(*batch)
+    counts["deactivated"] = len(deactivated) + len(diff["deactivate"])
+    return counts
+
+
+# Sync the users table with a parsed HR feed: diff the feed against the current Users by fingerprint and apply only
+# the differences. With deactivate_missing=True the feed is taken to list every employee, so active Users missing from
+# it are deactivated, unless a rejected row has no valid id, which the report flags with missing_skipped. With
+# dry_run=True nothing is written. Returns a report of the counts, the seconds taken and the first
+# MAX_REPORTED_REJECTIONS rejected rows.
+def sync_feed(entries, deactivate_missing=False, dry_run=False, batch_size=None):
+    started = time.time()
+    diff = diff_feed(entries, deactivate_missing)
+    if dry_run:
+        counts = {"inserted": len(diff["inserts"]), "updated": len(diff["updates"]),
+                  "deactivated": len(diff["deactivated"]) + len(diff["deactivate"]), "revoked": 0}
+    else:
+        counts = apply_diff(diff, batch_size)
+    counts.update(unchanged=diff["unchanged"], rejected=len(diff["rejected"]),
+                  rejections=[{"line": line, "id": user_id, "reason": reason}
+                              for line, user_id, reason in diff["rejected"][:MAX_REPORTED_REJECTIONS]],
+                  missing_skipped=deactivate_missing and diff["unidentified"],
+                  seconds=round(time.time() - started, 3), dry_run=dry_run)
+    return counts
@@ -0,0 +1,121 @@
+from collections import namedtuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app import app, db
+from app.cache import LRUCache
+from app.models import User, Role, role_approvers
+
+# Immutable copy of the User fields needed to authenticate a request and render the page chrome
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'name', 'active_flag', 'manager_id', 'approver_for'])
+
+# Process wide cache of UserSnapshots keyed by User id
+identity_cache = LRUCache(app.config.get('IDENTITY_CACHE_SIZE', 10000), app.config.get('IDENTITY_CACHE_TTL', 300))
+
+
+# Get the UserSnapshot for the given id from the cache, loading it from the database on a miss
+def get_snapshot(user_id):
+    snapshot = identity_cache.get(user_id)
+    if snapshot is None:
+        row = db.session.execute(select([User.id, User.name, User.active_flag, User.manager_id])
+                                 .where(User.id == user_id)).first()
+        if row is None:
+            return None
+        approver_for = frozenset(role_id for role_id, in db.session.execute(
+            select([role_approvers.c.role_id]).where(role_approvers.c.user_id == user_id)))
+        snapshot = UserSnapshot(row[0], row[1], row[2], row[3], approver_for)
+        identity_cache.set(user_id, snapshot)
+    return snapshot
+
+
+# The logged in User as seen by Flask-Login and the templates. Answers from its UserSnapshot and only loads the full
+# User from the database when something beyond the snapshot (relationships, update methods) is used.
+class CurrentUser(object):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self._user = None
+
+    @property
+    def id(self):
+        return self.snapshot.id
+
+    @property
+    def name(self):
+        return self.snapshot.name
+
+    @property
+    def active_flag(self):
+        return self.snapshot.active_flag
+
+    @property
+    def manager_id(self):
+        return self.snapshot.manager_id
+
+    # Ids of the Roles this User approves
+    @property
+    def approver_for_ids(self):
+        return self.snapshot.approver_for
+
+    # Return True unless the user should not be allowed to authenticate
+    @property
+    def is_authenticated(self):
+        return True
+
+    # Return True for users unless they are inactive
+    @property
+    def is_active(self):
+        return self.snapshot.active_flag
+
+    # Return True only for fake users that are not supposed to log in to the system
+    @property
+    def is_anonymous(self):
+        return False
+
+    # Return a unique identifier for the user, in unicode format
+    def get_id(self):
+        return str(self.snapshot.id)
+
+    # The full User, loaded on first use
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = User.query.get(self.snapshot.id)
+        return self._user
+
+    # Defer everything else to the full User
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __repr__(self):
+        return str(self.snapshot.id) + " : " + self.snapshot.name + " : " + str(self.snapshot.manager_id)
+
+
+# Remember which Users were changed by a flush. Any Role change may alter approver sets, so it clears everything.
+@event.listens_for(Session, 'after_flush')
+def collect_identity_changes(session, flush_context):
+    changed = session.info.setdefault('identity_changes', set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, User):
+            changed.add(instance.id)
+        elif isinstance(instance, Role):
+            changed.add(None)
+
+
+# Drop the snapshots of changed Users once their changes are committed
+@event.listens_for(Session, 'after_commit')
+def invalidate_identity_changes(session):
+    changed = session.info.pop('identity_changes', None)
+    if changed:
+        if None in changed:
+            identity_cache.clear()
+        else:
+            identity_cache.invalidate(*changed)
+
+
+# Forget the changes of a rolled back transaction
+@event.listens_for(Session, 'after_rollback')
+def discard_identity_changes(session):
+    session.info.pop('identity_changes', None)
@@ -0,0 +1,158 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Literal values and parameter lists stripped from SQL before it is logged
+SQL_LITERALS = [(re.compile(r"'(?:[^']|'')*'"), "?"),
+                (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+                (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?, ...)"),
+                (re.compile(r"\s+"), " ")]
+
+
+# Replace the literals in a SQL statement with placeholders so similar statements group together
+def normalize_sql(statement):
+    for pattern, replacement in SQL_LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+# Format one Prometheus text exposition metric family. samples is a list of (name suffix, labels dict, value).
+def format_metric(name, kind, description, samples):
+    lines = ["# HELP " + name + " " + description, "# TYPE " + name + " " + kind]
+    for suffix, labels, value in samples:
+        label_text = ",".join('%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key in sorted(labels))
+        lines.append(name + suffix + ("{" + label_text + "}" if label_text else "") + " " + repr(float(value)))
+    return "\n".join(lines) + "\n"
+
+
+# Per endpoint request latency, query count and database time, plus a bounded log of slow statements
+class Metrics(object):
+    def __init__(self, sample_rate=1.0, slow_query_ms=100, slow_query_log_size=100):
+        self.sample_rate = sample_rate
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = deque(maxlen=slow_query_log_size)
+        self._lock = threading.Lock()
+        # (endpoint, method, status) -> count
+        self._requests = {}
+        # endpoint -> [bucket counts..., +Inf count, sum of seconds]
+        self._latency = {}
+        # endpoint -> [queries, database seconds, slow queries]
+        self._database = {}
+
+    # Record a finished request
+    def observe_request(self, endpoint, method, status, seconds, queries, database_seconds, slow):
+        with self._lock:
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            latency = self._latency.get(endpoint)
+            if latency is None:
+                latency = self._latency[endpoint] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    latency[index] += 1
+                    break
+            else:
+                latency[len(LATENCY_BUCKETS)] += 1
+            latency[-1] += seconds
+            database = self._database.setdefault(endpoint, [0, 0.0, 0])
+            database[0] += queries
+            database[1] += database_seconds
+            database[2] += slow
+
+    # Record a statement that took at least slow_query_ms
+    def observe_slow_query(self, endpoint, statement, seconds):
+        self.slow_queries.append({"time": time.time(), "endpoint": endpoint, "ms": seconds * 1000,
+                                  "sql": normalize_sql(statement)})
+
+    # The collected metrics in the Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            requests = sorted(self._requests.items())
+            latency = sorted((endpoint, list(values)) for endpoint, values in self._latency.items())
+            database = sorted((endpoint, list(values)) for endpoint, values in self._database.items())
+        histogram = []
+        for endpoint, values in latency:
+            cumulative = 0
+            for index, bound in enumerate(LATENCY_BUCKETS + ("+Inf",)):
+                cumulative += values[index]
+                histogram.append(("_bucket", {"endpoint": endpoint, "le": bound}, cumulative))
+            histogram.append(("_sum", {"endpoint": endpoint}, values[-1]))
+            histogram.append(("_count", {"endpoint": endpoint}, cumulative))
+        return "".join([
+            format_metric("ups_http_requests_total", "counter", "Sampled requests by endpoint, method and status.",
+                          [("", {"endpoint": key[0], "method": key[1], "status": key[2]}, count)
+                           for key, count in requests]),
+            format_metric("ups_http_request_duration_seconds", "histogram", "Sampled request latency by endpoint.",
+                          histogram),
+            format_metric("ups_db_queries_total", "counter", "SQL statements issued by sampled requests.",
+                          [("", {"endpoint": endpoint}, values[0]) for endpoint, values in database]),
+            format_metric("ups_db_duration_seconds_total", "counter", "Time sampled requests spent in SQL.",
+                          [("", {"endpoint": endpoint}, values[1]) for endpoint, values in database]),
+            format_metric("ups_db_slow_queries_total", "counter", "Statements slower than the slow query threshold.",
+                          [("", {"endpoint": endpoint}, values[2]) for endpoint, values in database]),
+            format_metric("ups_metrics_sample_rate", "gauge", "Fraction of requests that are instrumented.",
+                          [("", {}, self.sample_rate)]),
+        ])
+
+
+# Instrument every request and SQL statement of the app. A sampled fraction of requests (METRICS_SAMPLE_RATE) is
+# timed, has its statements counted and timed, and gets a Server-Timing header when METRICS_SERVER_TIMING is set.
+def configure_metrics(app):
+    metrics = Metrics(app.config.get('METRICS_SAMPLE_RATE', 1.0), app.config.get('SLOW_QUERY_MS', 100),
+                      app.config.get('SLOW_QUERY_LOG_SIZE', 100))
+    server_timing = app.config.get('METRICS_SERVER_TIMING', False)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_sampled = metrics.sample_rate >= 1 or random.random() < metrics.sample_rate
+        if g.metrics_sampled:
+            g.metrics_start = time.time()
+            g.metrics_queries = 0
+            g.metrics_database = 0.0
+            g.metrics_slow = 0
+
+    @app.after_request
+    def finish_request_metrics(response):
+        if g.get('metrics_sampled'):
+            seconds = time.time() - g.metrics_start
+            metrics.observe_request(request.endpoint or 'unknown', request.method, response.status_code, seconds,
+                                    g.metrics_queries, g.metrics_database, g.metrics_slow)
+            if server_timing:
+                response.headers['Server-Timing'] = 'db;dur=%.2f;desc="%d queries", total;dur=%.2f' % (
+                    g.metrics_database * 1000, g.metrics_queries, seconds * 1000)
+        return response
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query_metrics(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and g.get('metrics_sampled'):
+            conn.info.setdefault('metrics_query_start', []).append(time.time())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def finish_query_metrics(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_query_start')
+        if starts and has_request_context() and g.get('metrics_sampled'):
+            seconds = time.time() - starts.pop()
+            g.metrics_queries += 1
+            g.metrics_database += seconds
+            if seconds * 1000 >= metrics.slow_query_ms:
+                g.metrics_slow += 1
+                metrics.observe_slow_query(request.endpoint or 'unknown', statement, seconds)
+
+    # Discard the start time of a failed statement so the next one is timed from its own start
+    @event.listens_for(Engine, 'handle_error')
+    def discard_query_metrics(exception_context):
+        connection = exception_context.connection
+        starts = connection.info.get('metrics_query_start') if connection is not None else None
+        if starts:
+            starts.pop()
+
+    return metrics
@@ -0,0 +1,260 @@
+import json
+import time
+from datetime import datetime
+
+from sqlalchemy import Table, Column, String, Integer, Text, DateTime, select, and_, or_, func, inspect
+from sqlalchemy.schema import CreateColumn
+
+from app import app, db
+from app.models import Request
+
+# Progress of each online migration. position is the JSON list of the last key walked, NULL before the first chunk.
+migration_checkpoints = Table(
+    'migration_checkpoints',
+    db.metadata,
+    Column('name', String(100), primary_key=True),
+    Column('state', String(16), nullable=False),
+    Column('position', Text),
+    Column('rows_done', Integer, nullable=False, default=0),
+    Column('started_at', DateTime, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+    Column('finished_at', DateTime)
+)
+
+
+# Build the condition selecting the rows whose key, in the order of the columns, is after lower and at most upper.
+# Either bound may be None for an open range. Composite keys are expanded into OR/AND comparisons, which every backend
+# can serve from the key's index.
+def key_range(columns, lower=None, upper=None):
+    conditions = []
+    if lower is not None:
+        conditions.append(_after(columns, lower))
+    if upper is not None:
+        conditions.append(_through(columns, upper))
+    return and_(*conditions)
+
+
+def _after(columns, values):
+    if len(columns) == 1:
+        return columns[0] > values[0]
+    return or_(columns[0] > values[0], and_(columns[0] == values[0], _after(columns[1:], values[1:])))
+
+
+def _through(columns, values):
+    if len(columns) == 1:
+        return columns[0] <= values[0]
+    return or_(columns[0] < values[0], and_(columns[0] == values[0], _through(columns[1:], values[1:])))
+
+
+# A change applied to a live database. prepare runs first, in one transaction, then apply is called for consecutive
+# chunks of the table in key order, each in its own transaction, and finish runs last. A migration without a table has
+# no chunks. Subclasses override the steps they need; every step must be safe to run again after an interruption.
+class Migration(object):
+    def __init__(self, name, table=None, key=None):
+        self.name = name
+        self.table = table
+        self.key = key or (list(table.primary_key.columns) if table is not None else [])
+
+    def prepare(self, connection):
+        pass
+
+    # Process the rows whose key is after lower (None for the first chunk) and at most upper
+    def apply(self, connection, lower, upper):
+        pass
+
+    def finish(self, connection):
+        pass
+
+    # Count the rows to walk, for progress reporting
+    def count(self, connection):
+        return connection.execute(select([func.count()]).select_from(self.table)).scalar()
+
+
+# Update the rows of a table chunk by chunk, setting columns to the given values or SQL expressions, optionally only
+# where a condition holds
+class Backfill(Migration):
+    def __init__(self, name, table, values, where=None, key=None):
+        super(Backfill, self).__init__(name, table, key)
+        self.values = values
+        self.where = where
+
+    def apply(self, connection, lower, upper):
+        condition = key_range(self.key, lower, upper)
+        if self.where is not None:
+            condition = and_(condition, self.where)
+        connection.execute(self.table.update().where(condition).values(**self.values))
+
+
+# Add a column declared on a model to an existing table, then optionally backfill it. The column must be nullable or
+# have a server_default, which lets SQLite add it and PostgreSQL and MySQL add it without rewriting the table.
+class AddColumn(Backfill):
+    def __init__(self, name, column, values=None, where=None):
+        super(AddColumn, self).__init__(name, column.table, values or {}, where)
+        self.column = column
+
+    def prepare(self, connection):
+        if self.column.name not in {column['name'] for column in inspect(connection).get_columns(self.table.name)}:
+            connection.execute('ALTER TABLE ' + connection.dialect.identifier_preparer.format_table(self.table) +
+                               ' ADD COLUMN ' + str(CreateColumn(self.column).compile(dialect=connection.dialect)))
+
+    def apply(self, connection, lower, upper):
+        if self.values:
+            super(AddColumn, self).apply(connection, lower, upper)
+
+
+# Create an index declared on a model if it is missing. PostgreSQL builds it CONCURRENTLY, outside of a transaction,
+# and MySQL builds InnoDB indexes online. SQLite holds the write lock while it builds the index.
+class AddIndex(Migration):
+    def __init__(self, name, index):
+        super(AddIndex, self).__init__(name)
+        self.index = index
+
+    def finish(self, connection):
+        if self.index.name in {index['name'] for index in inspect(connection).get_indexes(self.index.table.name)}:
+            return
+        if connection.dialect.name == 'postgresql':
+            self.index.dialect_kwargs['postgresql_concurrently'] = True
+            try:
+                self.index.create(connection.execution_options(isolation_level='AUTOCOMMIT'))
+            finally:
+                del self.index.dialect_kwargs['postgresql_concurrently']
+        else:
+            self.index.create(connection)
+
+
+# The online migrations of this app, by name, in the order they are run
+MIGRATIONS = [
+    # Fill in the approver counters of Requests created before the counters existed
+    Backfill('recount_approvals', Request.__table__, Request.approval_counters()),
+]
+
+
+# Runs migrations in keyset ordered chunks, committing the chunk and the checkpoint after it together, so an
+# interrupted run resumes after the last committed chunk. Each chunk first takes its locks: the database write lock on
+# SQLite, by updating the checkpoint, and the row locks of the chunk's keys on server databases, by selecting them FOR
+# UPDATE. The time that takes is the lock wait, and the time the whole chunk transaction takes is its latency. When
+# either is over its limit the chunk size is halved and the runner pauses for as long as the chunk took, otherwise the
+# chunk size grows by a quarter, so the runner backs off while the app is busy and speeds up while it is idle.
+class MigrationRunner(object):
+    def __init__(self, engine, chunk_size=None, min_chunk_size=None, max_chunk_size=None, target_latency=None,
+                 max_lock_wait=None, pause=None, report_interval=5):
+        config = app.config
+        self.engine = engine
+        self.chunk_size = chunk_size or config.get('MIGRATION_CHUNK_SIZE', 1000)
+        self.min_chunk_size = min_chunk_size or config.get('MIGRATION_MIN_CHUNK_SIZE', 100)
+        self.max_chunk_size = max_chunk_size or config.get('MIGRATION_MAX_CHUNK_SIZE', 20000)
+        self.target_latency = target_latency or config.get('MIGRATION_TARGET_LATENCY', 0.2)
+        self.max_lock_wait = max_lock_wait or config.get('MIGRATION_MAX_LOCK_WAIT', 0.05)
+        self.pause = config.get('MIGRATION_PAUSE', 0) if pause is None else pause
+        self.report_interval = report_interval
+        migration_checkpoints.create(engine, checkfirst=True)
+
+    # Get the checkpoint row of a migration, or None if it never started
+    def checkpoint(self, name):
+        with self.engine.connect() as connection:
+            return connection.execute(migration_checkpoints.select()
+                                      .where(migration_checkpoints.c.name == name)).first()
+
+    # Forget the progress of a migration, so the next run starts over
+    def reset(self, name):
+        with self.engine.begin() as connection:
+            connection.execute(migration_checkpoints.delete().where(migration_checkpoints.c.name == name))
+
+    # Run a migration to completion, or for at most max_chunks chunks, resuming from its checkpoint. progress is called
+    # with the status every report_interval seconds and once at the end. Returns the final status.
+    def run(self, migration, progress=None, max_chunks=None):
+        checkpoint = self.checkpoint(migration.name)
+        if checkpoint is not None and checkpoint.state == 'DONE':
+            return self._status(migration, checkpoint.state, checkpoint.rows_done, None, 0, 0, 0, 0, 0)
+        now = datetime.utcnow()
+        with self.engine.begin() as connection:
+            if checkpoint is None:
+                connection.execute(migration_checkpoints.insert().values(
+                    name=migration.name, state='RUNNING', rows_done=0, started_at=now, updated_at=now))
+            migration.prepare(connection)
+        position = json.loads(checkpoint.position) if checkpoint is not None and checkpoint.position else None
+        rows_done = checkpoint.rows_done if checkpoint is not None else 0
+
+        total = None
+        started = time.time()
+        reported = started
+        walked = chunks = 0
+        lock_wait = latency = 0
+        with self.engine.connect() as connection:
+            if migration.table is not None:
+                total = migration.count(connection)
+            while migration.table is not None and (max_chunks is None or chunks < max_chunks):
+                chunk_started = time.time()
+                with connection.begin():
+                    if connection.dialect.name == 'sqlite':
+                        self._touch(connection, migration.name)
+                    keys = [tuple(row) for row in connection.execute(
+                        select(migration.key).where(key_range(migration.key, position))
+                        .order_by(*migration.key).limit(self.chunk_size).with_for_update())]
+                    lock_wait = time.time() - chunk_started
+                    if not keys:
+                        break
+                    migration.apply(connection, position, keys[-1])
+                    position = list(keys[-1])
+                    rows_done += len(keys)
+                    self._touch(connection, migration.name, position, rows_done)
+                latency = time.time() - chunk_started
+                walked += len(keys)
+                chunks += 1
+                self._throttle(lock_wait, latency)
+                if progress is not None and time.time() - reported >= self.report_interval:
+                    reported = time.time()
+                    progress(self._status(migration, 'RUNNING', rows_done, total, walked, time.time() - started,
+                                          lock_wait, latency, chunks))
+
+        state = 'RUNNING'
+        if max_chunks is None or chunks < max_chunks:
+            with self.engine.connect() as connection:
+                migration.finish(connection)
+            with self.engine.begin() as connection:
+                connection.execute(migration_checkpoints.update()
+                                   .where(migration_checkpoints.c.name == migration.name)
+                                   .values(state='DONE', updated_at=datetime.utcnow(),
+                                           finished_at=datetime.utcnow()))
+            state = 'DONE'
+        status = self._status(migration, state, rows_done, total, walked, time.time() - started, lock_wait,
+                              latency, chunks)
+        if progress is not None:
+            progress(status)
+        return status
+
+    # Record the position and rows done of a migration, or only take the write lock when position is None
+    def _touch(self, connection, name, position=None, rows_done=None):
+        values = {"updated_at": datetime.utcnow()}
+        if position is not None:
+            values.update(position=json.dumps(position), rows_done=rows_done)
+        connection.execute(migration_checkpoints.update().where(migration_checkpoints.c.name == name).values(**values))
+
+    # Adapt the chunk size to the lock wait and latency of the last chunk, pausing to let the app catch up
+    def _throttle(self, lock_wait, latency):
+        if lock_wait > self.max_lock_wait or latency > self.target_latency:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+            time.sleep(max(self.pause, latency))
+        else:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size + max(1, self.chunk_size // 4))
+            if self.pause:
+                time.sleep(self.pause)
+
+    # Describe the progress of a run. The rate counts the rows walked by this run, and the ETA assumes it holds.
+    def _status(self, migration, state, rows_done, total, walked, elapsed, lock_wait, latency, chunks):
+        rate = walked / elapsed if elapsed > 0 else 0
+        remaining = max(total - rows_done, 0) if total is not None else 0
+        return {"name": migration.name, "state": state, "rows_done": rows_done, "total": total,
+                "percent": round(100.0 * rows_done / total, 1) if total else 100.0, "chunks": chunks,
+                "chunk_size": self.chunk_size, "rows_per_second": round(rate, 1),
+                "eta_seconds": round(remaining / rate, 1) if rate and state != 'DONE' else 0,
+                "lock_wait_ms": round(lock_wait * 1000, 1), "latency_ms": round(latency * 1000, 1)}
+
+
+# Format a run status as a progress line
+def format_status(status):
+    line = '%(name)s: %(state)s %(rows_done)d' % status
+    if status["total"] is not None:
+        line += '/%(total)d rows (%(percent).1f%%)' % status
+    return line + (', %(rows_per_second).0f rows/s, chunk %(chunk_size)d, lock wait %(lock_wait_ms).1f ms, '
+                   'latency %(latency_ms).1f ms, ETA %(eta_seconds).0f s' % status)
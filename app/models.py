@@ -1,18 +1,42 @@
-from sqlalchemy import ForeignKey, Column, Integer, String, Enum, Boolean, Table, or_, and_, desc
-from sqlalchemy.orm import relationship, backref
+from datetime import datetime
+
+from sqlalchemy import ForeignKey, Column, Integer, String, Enum, Boolean, DateTime, Table, Index, or_, and_, desc, \
+    select, literal, exists, event, bindparam, case, func
+from sqlalchemy.orm import relationship, backref, joinedload, Session, attributes
 from sqlalchemy_utils import PasswordType
+from flask import g, has_request_context
+
+from app import app, db
+from app.engine import utc_now
+from app.search import register_search_index, matches, id_prefix
 
-from app import db
+# Requests decided per statement by a batch of approval decisions. Keeps the IN lists under SQLite's variable limit.
+DECISION_BATCH_SIZE = 400
+# Deepest manager hierarchy walked by the org chart queries. Stops a manager cycle from recursing forever.
+MAX_ORG_DEPTH = 64
+# Request statuses that no longer grant or ask for access, so the same Role may be requested again
+CLOSED_STATUSES = ('REJECTED', 'REVOKED', 'EXPIRED')
+# Access events that change the state of a Request, as opposed to the decision of a single approver
+TRANSITION_EVENTS = ('REQUESTED', 'APPROVED', 'GRANTED', 'REJECTED', 'REVOKED', 'EXPIRED')
 
 
 # USER OBJECT ===
 class User(db.Model):
     # Model metadata
     __tablename__ = 'users'
+    __table_args__ = (
+        # Serves subordinates and the manager tree
+        Index('ix_users_manager_id', 'manager_id'),
+    )
 
     # Model information
     id = Column(Integer, primary_key=True, autoincrement=False)
-    password = Column(PasswordType(schemes=['pbkdf2_sha512']), nullable=False)
+    # Hashes are upgraded on login whenever their rounds differ from PASSWORD_ROUNDS
+    password = Column(PasswordType(schemes=['pbkdf2_sha512'],
+                                   pbkdf2_sha512__default_rounds=app.config.get('PASSWORD_ROUNDS', 25000),
+                                   pbkdf2_sha512__min_rounds=app.config.get('PASSWORD_ROUNDS', 25000),
+                                   pbkdf2_sha512__max_rounds=app.config.get('PASSWORD_ROUNDS', 25000)),
+                      nullable=False)
     name = Column(String(64), index=True, nullable=False)
     manager_id = Column(Integer, ForeignKey("users.id"))
     active_flag = Column(Boolean, default=True, nullable=False)
@@ -44,34 +68,172 @@ class User(db.Model):
     def get_id(self):
         return str(self.id)
 
-    # Search for a User with the given query. Searches the id and name fields
+    # Search for a User with the given query. Numeric queries are matched as an id prefix, anything else is matched
+    # against the name search index and ranked by relevance. If a limit is given only that many Users are looked up.
     @staticmethod
-    def search(query):
-        return User.query.filter(or_(User.id.contains(query), User.name.contains(query)))
+    def search(query, limit=None):
+        query = (query or '').strip()
+        if query.isdigit():
+            results = User.query.filter(id_prefix(User.id, query)).order_by(User.id)
+        else:
+            hits = matches(User.name, query, limit)
+            results = User.query.join(hits, User.id == hits.c.id).order_by(hits.c.rank, User.id)
+        return results.limit(limit) if limit is not None else results
+
+    # Eagerly load the Manager shown alongside each User, so listing Users needs a single query
+    @staticmethod
+    def with_manager(query):
+        return query.options(joinedload('manager'))
+
+    # Get the Users reporting to this User. With transitive=True this is everyone below this User in the manager tree,
+    # found in a single recursive query and ordered by level. With with_depth=True each row is a (User, depth) pair,
+    # where direct reports have depth 1.
+    def reports(self, transitive=False, with_depth=False):
+        users = User.__table__
+        org = select([users.c.id, literal(1).label('depth')]).where(users.c.manager_id == self.id) \
+            .cte('org', recursive=True)
+        if transitive:
+            below = users.alias('below')
+            org = org.union_all(select([below.c.id, org.c.depth + 1])
+                                .where(and_(below.c.manager_id == org.c.id, org.c.depth < MAX_ORG_DEPTH)))
+        query = User.query.join(org, User.id == org.c.id)
+        if with_depth:
+            query = query.add_columns(org.c.depth)
+        return query.order_by(org.c.depth, User.id)
+
+    # Get this User's managers in a single recursive query, from their direct manager up to the top of the tree. If
+    # levels is given only that many managers are returned.
+    def management_chain(self, levels=None):
+        users = User.__table__
+        levels = min(levels or MAX_ORG_DEPTH, MAX_ORG_DEPTH)
+        chain = select([users.c.id, users.c.manager_id, literal(1).label('depth')]) \
+            .where(users.c.id == self.manager_id).cte('chain', recursive=True)
+        above = users.alias('above')
+        chain = chain.union_all(select([above.c.id, above.c.manager_id, chain.c.depth + 1])
+                                .where(and_(above.c.id == chain.c.manager_id, chain.c.depth < levels)))
+        return User.query.join(chain, User.id == chain.c.id).order_by(chain.c.depth)
+
+    # Get the manager of this User's manager, or None if there is no such User
+    def skip_level_manager(self):
+        return self.management_chain(2).offset(1).first()
+
+    # Get every Role this User effectively holds. Holding a Role grants all of its descendant Roles as well.
+    def effective_roles(self):
+        return Role.query.join(role_closure, Role.id == role_closure.c.descendant_id) \
+            .join(Request, Request.role_id == role_closure.c.ancestor_id) \
+            .filter(Request.requested_for_id == self.id, Request.effective()) \
+            .distinct()
 
-    # Update this User's approval status for the given Request
+    # Check whether this User effectively holds the given Role, either directly or through an ancestor Role
+    def has_role(self, role):
+        role_id = role.id if isinstance(role, Role) else role
+        return db.session.query(exists().where(and_(Request.requested_for_id == self.id,
+                                                    Request.effective(),
+                                                    role_closure.c.ancestor_id == Request.role_id,
+                                                    role_closure.c.descendant_id == role_id))).scalar()
+
+    # Record this User's decision on the given Request. Only a PENDING approval can be decided, so repeated or
+    # concurrent clicks by the same approver are applied once. The Request's approver counters are adjusted in a single
+    # UPDATE that also decides the new Request status from them: one rejection rejects the Request and the last
+    # outstanding approval approves it. Returns True if the decision was applied.
     def update_approval(self, request_id, updated_status="PENDING"):
-        db.session.execute(request_approvers.update().
-                           where(and_(request_approvers.columns.request_id == request_id,
-                                      request_approvers.columns.user_id == self.id)).
-                           values(approval_status=updated_status))
-        if updated_status == "REJECTED":
-            # If a single Approver rejects a Request, set the Request status to REJECTED
-            Request.query.get(request_id).update_status(updated_status)
-        elif updated_status == "APPROVED":
-            # Get number of Approvers who have approved this Request
-            approved = len(list(db.session.execute(request_approvers.select().where(
-                and_(request_approvers.columns.request_id == request_id,
-                     request_approvers.columns.user_id == self.id,
-                     request_approvers.columns.approval_status == updated_status)))))
-            # Get total number of Approvers for this Request
-            total = len(list(db.session.execute(request_approvers.select().
-                                                where(and_(request_approvers.columns.request_id == request_id,
-                                                           request_approvers.columns.user_id == self.id)))))
-            if approved == total:
-                # If all Approvers approve a Request, set the Request status to APPROVED
-                Request.query.get(request_id).update_status(updated_status)
+        if updated_status not in ("APPROVED", "REJECTED"):
+            return False
+        decided = db.session.execute(request_approvers.update().
+                                     where(and_(request_approvers.c.request_id == request_id,
+                                                request_approvers.c.user_id == self.id,
+                                                request_approvers.c.approval_status == "PENDING")).
+                                     values(approval_status=updated_status)).rowcount == 1
+        if decided:
+            db.session.execute(Request.record_decision(request_id, updated_status))
+            InboxItem.record_decision(request_id, self.id, updated_status)
+            mark_changed_requests([request_id])
+            mark_decisions(self.id, {request_id: updated_status})
         db.session.commit()
+        return decided
+
+    # Revoke every grant held by this User and reject their open Requests, committing in batches. Returns the number
+    # of grants revoked.
+    def revoke_grants(self, batch_size=None):
+        return Request.revoke(Request.requested_for_id == self.id, batch_size)
+
+    # Deactivate this User. Their grants and open Requests are first revoked in committed batches, then the
+    # deactivation commits along with the revocation of anything granted in between. Returns the number of grants
+    # revoked.
+    def deactivate(self, batch_size=None):
+        revoked = self.revoke_grants(batch_size)
+        self.active_flag = False
+        db.session.commit()
+        return revoked
+
+    # Record a batch of this User's decisions, given as (request_id, decision) pairs, in one transaction. The approver
+    # rows, Request counters and statuses, and inbox items of the whole batch are each updated with one set-based
+    # statement per DECISION_BATCH_SIZE Requests. Returns the outcome of every pair in order, one of APPLIED, INVALID
+    # (not an APPROVED or REJECTED decision), NOT_APPROVER, ALREADY_DECIDED or DUPLICATE, along with the Request status.
+    def update_approvals(self, decisions):
+        decisions = [(int(request_id), decision) for request_id, decision in decisions]
+        requested = set(request_id for request_id, decision in decisions)
+        for attempt in range(3):
+            # Lock this User's approver rows so the pending set cannot change before it is updated
+            current = {}
+            ids = sorted(requested)
+            for start in range(0, len(ids), DECISION_BATCH_SIZE):
+                current.update(db.session.execute(
+                    select([request_approvers.c.request_id, request_approvers.c.approval_status])
+                    .where(and_(request_approvers.c.user_id == self.id,
+                                request_approvers.c.request_id.in_(ids[start:start + DECISION_BATCH_SIZE])))
+                    .with_for_update()).fetchall())
+            outcomes = []
+            applied = {}
+            for request_id, decision in decisions:
+                if decision not in ("APPROVED", "REJECTED"):
+                    outcome = "INVALID"
+                elif request_id not in current:
+                    outcome = "NOT_APPROVER"
+                elif request_id in applied:
+                    outcome = "DUPLICATE"
+                elif current[request_id] != "PENDING":
+                    outcome = "ALREADY_DECIDED"
+                else:
+                    outcome = "APPLIED"
+                    applied[request_id] = decision
+                outcomes.append((request_id, decision, outcome))
+            if self._apply_decisions(applied):
+                break
+            # A concurrent decision changed the pending set between the read and the update, so try again
+            db.session.rollback()
+        else:
+            raise RuntimeError("Approval decisions kept conflicting with concurrent updates")
+        statuses = {}
+        for start in range(0, len(ids), DECISION_BATCH_SIZE):
+            statuses.update(db.session.execute(select([Request.id, Request.status])
+                                               .where(Request.id.in_(ids[start:start + DECISION_BATCH_SIZE])))
+                            .fetchall())
+        db.session.commit()
+        return [{"request_id": request_id, "decision": decision, "outcome": outcome,
+                 "status": statuses.get(request_id)} for request_id, decision, outcome in outcomes]
+
+    # Write the given {request_id: decision} map of pending decisions. Returns False without committing if any of the
+    # approver rows was no longer pending.
+    def _apply_decisions(self, decisions):
+        ids = sorted(decisions)
+        for start in range(0, len(ids), DECISION_BATCH_SIZE):
+            batch = ids[start:start + DECISION_BATCH_SIZE]
+            rejected = [request_id for request_id in batch if decisions[request_id] == "REJECTED"]
+            status = case([(request_approvers.c.request_id.in_(rejected), "REJECTED")], else_="APPROVED") \
+                if rejected else "APPROVED"
+            updated = db.session.execute(request_approvers.update()
+                                         .where(and_(request_approvers.c.user_id == self.id,
+                                                     request_approvers.c.request_id.in_(batch),
+                                                     request_approvers.c.approval_status == "PENDING"))
+                                         .values(approval_status=status)).rowcount
+            if updated != len(batch):
+                return False
+            db.session.execute(Request.record_decisions(batch, rejected))
+            InboxItem.record_decisions(batch, rejected, self.id)
+            mark_changed_requests(batch)
+            mark_decisions(self.id, {request_id: decisions[request_id] for request_id in batch})
+        return True
 
     # To_String method
     def __repr__(self):
@@ -83,7 +245,9 @@ role_parents = Table(
     'role_parents',
     db.metadata,
     Column('role_id', Integer, ForeignKey('roles.id'), primary_key=True),
-    Column('parent_id', Integer, ForeignKey('roles.id'), primary_key=True)
+    Column('parent_id', Integer, ForeignKey('roles.id'), primary_key=True),
+    # The primary key serves parent lookups, this index serves child lookups
+    Index('ix_role_parents_parent', 'parent_id', 'role_id')
 )
 
 # ROLE APPROVER MANY-TO-MANY MAPPING TABLE ===
@@ -91,7 +255,22 @@ role_approvers = Table(
     'role_approvers',
     db.metadata,
     Column('role_id', Integer, ForeignKey('roles.id'), primary_key=True),
-    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True)
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    # Serves the Roles a User approves
+    Index('ix_role_approvers_user', 'user_id', 'role_id')
+)
+
+# ROLE CLOSURE TABLE ===
+# Materialized transitive closure of role_parents. Holds one row for every (ancestor, descendant) pair reachable
+# through role_parents, including a depth 0 row for every Role, where depth is the length of the shortest path.
+role_closure = Table(
+    'role_closure',
+    db.metadata,
+    Column('ancestor_id', Integer, ForeignKey('roles.id'), primary_key=True),
+    Column('descendant_id', Integer, ForeignKey('roles.id'), primary_key=True),
+    Column('depth', Integer, nullable=False),
+    # The primary key serves descendant lookups, this index serves ancestor lookups
+    Index('ix_role_closure_descendant', 'descendant_id', 'ancestor_id')
 )
 
 
@@ -115,7 +294,7 @@ class Role(db.Model):
         if isinstance(parent, int):
             parent = Role.query.get(parent)
         if isinstance(parent, Role):
-            self.parents.append(parent)
+            Role.link(parent, self)
         else:
             raise TypeError("Invalid parent: " + str(parent))
 
@@ -129,7 +308,7 @@ class Role(db.Model):
         if isinstance(child, int):
             child = Role.query.get(child)
         if isinstance(child, Role):
-            self.children.append(child)
+            Role.link(self, child)
         else:
             raise TypeError("Invalid child: " + str(child))
 
@@ -138,6 +317,80 @@ class Role(db.Model):
         for child in children:
             self.add_child(child)
 
+    # Add a parent to child edge to the Role hierarchy and extend the closure table with every new path it creates.
+    # Raises a ValueError if the edge would make the hierarchy cyclic.
+    @staticmethod
+    def link(parent, child):
+        # Both Roles need ids (and their depth 0 closure rows) before the closure can be extended
+        for role in (parent, child):
+            if role.id is None:
+                db.session.add(role)
+        db.session.flush()
+        if Role.would_cycle([parent.id], [child.id]):
+            raise ValueError("Adding " + parent.name + " as a parent of " + child.name + " would create a cycle")
+        child.parents.append(parent)
+        # Every ancestor of the parent becomes an ancestor of every descendant of the child
+        ancestors = db.session.execute(select([role_closure.c.ancestor_id, role_closure.c.depth])
+                                       .where(role_closure.c.descendant_id == parent.id)).fetchall()
+        descendants = db.session.execute(select([role_closure.c.descendant_id, role_closure.c.depth])
+                                         .where(role_closure.c.ancestor_id == child.id)).fetchall()
+        paths = {(ancestor_id, descendant_id): ancestor_depth + descendant_depth + 1
+                 for ancestor_id, ancestor_depth in ancestors
+                 for descendant_id, descendant_depth in descendants}
+        existing = dict(((row[0], row[1]), row[2]) for row in db.session.execute(
+            select([role_closure.c.ancestor_id, role_closure.c.descendant_id, role_closure.c.depth])
+            .where(and_(role_closure.c.ancestor_id.in_({ancestor_id for ancestor_id, _ in ancestors}),
+                        role_closure.c.descendant_id.in_({descendant_id for descendant_id, _ in descendants})))))
+        new_paths = [{"ancestor_id": ancestor_id, "descendant_id": descendant_id, "depth": depth}
+                     for (ancestor_id, descendant_id), depth in paths.items()
+                     if (ancestor_id, descendant_id) not in existing]
+        shorter_paths = [{"a": ancestor_id, "d": descendant_id, "new_depth": depth}
+                         for (ancestor_id, descendant_id), depth in paths.items()
+                         if depth < existing.get((ancestor_id, descendant_id), depth)]
+        if new_paths:
+            db.session.execute(role_closure.insert(), new_paths)
+        if shorter_paths:
+            db.session.execute(role_closure.update()
+                               .where(and_(role_closure.c.ancestor_id == bindparam('a'),
+                                           role_closure.c.descendant_id == bindparam('d')))
+                               .values(depth=bindparam('new_depth')), shorter_paths)
+        mark_role_graph_changed()
+
+    # Check whether making any of the given parents an ancestor of any of the given children would create a cycle
+    @staticmethod
+    def would_cycle(parent_ids, child_ids):
+        parent_ids = set(parent_ids)
+        child_ids = set(child_ids)
+        if not parent_ids or not child_ids:
+            return False
+        return db.session.query(exists().where(and_(role_closure.c.ancestor_id.in_(child_ids),
+                                                    role_closure.c.descendant_id.in_(parent_ids)))).scalar()
+
+    # Get every Role this Role transitively inherits from, nearest first
+    def ancestors(self):
+        return Role.query.join(role_closure, Role.id == role_closure.c.ancestor_id) \
+            .filter(role_closure.c.descendant_id == self.id, role_closure.c.depth > 0) \
+            .order_by(role_closure.c.depth, Role.id)
+
+    # Get every Role that transitively inherits from this Role, nearest first
+    def descendants(self):
+        return Role.query.join(role_closure, Role.id == role_closure.c.descendant_id) \
+            .filter(role_closure.c.ancestor_id == self.id, role_closure.c.depth > 0) \
+            .order_by(role_closure.c.depth, Role.id)
+
+    # Get every User that effectively holds this Role, either directly or through an ancestor Role
+    def effective_holders(self):
+        return User.query.join(Request, Request.requested_for_id == User.id) \
+            .join(role_closure, role_closure.c.ancestor_id == Request.role_id) \
+            .filter(role_closure.c.descendant_id == self.id, Request.effective()) \
+            .distinct()
+
+    # Retire this Role by revoking every grant of it and of its descendant Roles and rejecting their open Requests,
+    # committing in batches. Returns the number of grants revoked.
+    def revoke_grants(self, batch_size=None):
+        return Request.revoke(Request.role_id.in_(select([role_closure.c.descendant_id])
+                                                  .where(role_closure.c.ancestor_id == self.id)), batch_size)
+
     # Add a User as an Approver to this Role. This automatically adds to the approver_for set via the relationship
     def add_approver(self, approver):
         if isinstance(approver, int):
@@ -157,10 +410,13 @@ class Role(db.Model):
     def get_by_name(name):
         return Role.query.filter_by(name=name).first()
 
-    # Search for a Role with the given query. Searches the name field
+    # Search for a Role with the given query. Searches the name search index and ranks by relevance.
+    # If a limit is given only that many Roles are looked up.
     @staticmethod
-    def search(query):
-        return Role.query.filter(Role.name.contains(query))
+    def search(query, limit=None):
+        hits = matches(Role.name, (query or '').strip(), limit)
+        results = Role.query.join(hits, Role.id == hits.c.id).order_by(hits.c.rank, Role.id)
+        return results.limit(limit) if limit is not None else results
 
     # To_String method
     def __repr__(self):
@@ -173,7 +429,9 @@ request_approvers = Table(
     db.metadata,
     Column('request_id', Integer, ForeignKey('requests.id'), primary_key=True),
     Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
-    Column('approval_status', Enum("PENDING", "REJECTED", "APPROVED"), nullable=False, default="PENDING")
+    Column('approval_status', Enum("PENDING", "REJECTED", "APPROVED"), nullable=False, default="PENDING"),
+    # Serves the Requests awaiting a given approver
+    Index('ix_request_approvers_user_status', 'user_id', 'approval_status', 'request_id')
 )
 
 
@@ -181,6 +439,21 @@ request_approvers = Table(
 class Request(db.Model):
     # Modal metadata
     __tablename__ = 'requests'
+    __table_args__ = (
+        # Serves get_active_request, active_roles and requests_for
+        Index('ix_requests_for_role_status', 'requested_for_id', 'role_id', 'status'),
+        # Serves requests_by, which is sorted newest first
+        Index('ix_requests_by', 'requested_by_id', 'id'),
+        # Serves the Requests and grants of a Role
+        Index('ix_requests_role_status', 'role_id', 'status'),
+        # Serves browsing and sweeping Requests by status
+        Index('ix_requests_status', 'status', 'id'),
+        # Serves exporting Requests made in a date range
+        Index('ix_requests_created_at', 'created_at'),
+        # Serve the grant sweeper, which looks for grants starting or ending since its last run
+        Index('ix_requests_status_valid_until', 'status', 'valid_until'),
+        Index('ix_requests_status_valid_from', 'status', 'valid_from'),
+    )
 
     # Model information
     id = Column(Integer, primary_key=True)
@@ -188,15 +461,35 @@ class Request(db.Model):
     requested_for_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     requested_by_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     comment = Column(String(255))
-    status = Column(Enum("PENDING", "REJECTED", "APPROVED", "REVOKED"))
+    status = Column(Enum("PENDING", "REJECTED", "APPROVED", "REVOKED", "EXPIRED"))
+    # Approver decision counters, kept in step with request_approvers so the status can be decided without a count
+    pending_count = Column(Integer, nullable=False, default=0, server_default='0')
+    approved_count = Column(Integer, nullable=False, default=0, server_default='0')
+    rejected_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # When the Request was made, in UTC
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.current_timestamp())
+    # When an APPROVED Request starts and stops granting its Role, in UTC. Either end may be left open.
+    valid_from = Column(DateTime)
+    valid_until = Column(DateTime)
 
     # Method for creating new Request objects
-    def __init__(self, role_id, requested_for_id, requested_by_id, comment=None, status="PENDING"):
+    def __init__(self, role_id, requested_for_id, requested_by_id, comment=None, status="PENDING", valid_from=None,
+                 valid_until=None):
         self.role_id = role_id
         self.requested_for_id = requested_for_id
         self.requested_by_id = requested_by_id
         self.comment = comment
         self.status = status
+        self.valid_from = valid_from
+        self.valid_until = valid_until
+        self.pending_count = 0
+        self.approved_count = 0
+        self.rejected_count = 0
+        # Refuse Requests that would break a separation of duties rule
+        conflicts = ConflictRule.find_conflicts([(requested_for_id, role_id)])
+        if conflicts:
+            raise ValueError("Granting this Role would violate the conflict rules: " +
+                             ", ".join(conflicts[(requested_for_id, role_id)]))
         # Get Role approvers
         new_request_approvers = set(Role.query.get(role_id).approvers.all())
         # Get requested_for User manager if not None and add to approvers set
@@ -211,7 +504,12 @@ class Request(db.Model):
     def get_active_request(role_id, user_id):
         return Request.query.filter(Request.role_id == role_id,
                                     Request.requested_for_id == user_id,
-                                    Request.status != 'REJECTED').first()
+                                    Request.status.notin_(CLOSED_STATUSES)).first()
+
+    # Eagerly load the Role and Users shown alongside each Request, so listing Requests needs a single query
+    @staticmethod
+    def with_details(query):
+        return query.options(joinedload('requested_role'), joinedload('requested_for'), joinedload('requested_by'))
 
     # Search for a Request with the given query. Searches requested_for name and ID as well as requested_role name
     @staticmethod
@@ -228,6 +526,8 @@ class Request(db.Model):
             approver = User.query.get(approver)
         if isinstance(approver, User):
             self.approvers.append(approver)
+            self.inbox_items.append(InboxItem(approver.id))
+            self.pending_count = (self.pending_count or 0) + 1
         else:
             raise TypeError("Invalid approver: " + str(approver))
 
@@ -240,13 +540,403 @@ class Request(db.Model):
     def update_status(self, updated_status="PENDING"):
         self.status = updated_status
 
+    # Build the UPDATE that moves one approver of a Request from pending to the given decision. The new status is
+    # computed from the counters inside the same statement, so concurrent decisions can never be lost or miscounted.
+    @staticmethod
+    def record_decision(request_id, decision):
+        return Request.record_decisions([request_id], [request_id] if decision == "REJECTED" else [])
+
+    # Build the UPDATE that moves one approver of each of the given Requests from pending to a decision: a rejection
+    # for those in rejected_ids and an approval for the rest. The status is assigned first because some backends
+    # evaluate SET clauses using already updated values.
+    @staticmethod
+    def record_decisions(request_ids, rejected_ids):
+        table = Request.__table__
+        rejected = table.c.id.in_(rejected_ids) if rejected_ids else literal(False)
+        status = case([(table.c.status != "PENDING", table.c.status),
+                       (rejected, "REJECTED"),
+                       (table.c.rejected_count > 0, "REJECTED"),
+                       (table.c.pending_count <= 1, "APPROVED")],
+                      else_=table.c.status)
+        return table.update(preserve_parameter_order=True).where(table.c.id.in_(request_ids)).values([
+            (table.c.status, status),
+            (table.c.pending_count, table.c.pending_count - 1),
+            (table.c.approved_count, table.c.approved_count + case([(rejected, 0)], else_=1)),
+            (table.c.rejected_count, table.c.rejected_count + case([(rejected, 1)], else_=0))])
+
+    # Revoke the APPROVED Requests matching the given condition and reject the PENDING ones, closing their approvers'
+    # pending inbox items, so an offboarded User or a retired Role is left with no grant and no open Request. The
+    # affected Requests are found and moved by id in keyset ordered batches of batch_size (REVOKE_BATCH_SIZE by
+    # default), and each batch is committed on its own so a large revoke never holds the write lock for long. With
+    # commit=False the batches join the current transaction. Returns the number of grants revoked.
+    @staticmethod
+    def revoke(condition, batch_size=None, commit=True):
+        batch_size = batch_size or app.config.get('REVOKE_BATCH_SIZE', 1000)
+        table = Request.__table__
+        inbox = InboxItem.__table__
+        open_statuses = ('APPROVED', 'PENDING')
+        revoked = 0
+        last_id = 0
+        while True:
+            ids = [request_id for request_id, in db.session.execute(
+                select([table.c.id]).where(and_(table.c.status.in_(open_statuses), table.c.id > last_id, condition))
+                .order_by(table.c.id).limit(batch_size))]
+            if not ids:
+                break
+            revoked += db.session.execute(table.update()
+                                          .where(and_(table.c.id.in_(ids), table.c.status == 'APPROVED'))
+                                          .values(status='REVOKED')).rowcount
+            db.session.execute(table.update()
+                               .where(and_(table.c.id.in_(ids), table.c.status == 'PENDING'))
+                               .values(status='REJECTED'))
+            db.session.execute(inbox.update()
+                               .where(and_(inbox.c.request_id.in_(ids), inbox.c.status == 'PENDING'))
+                               .values(status='CLOSED'))
+            mark_changed_requests(ids)
+            last_id = ids[-1]
+            if commit:
+                db.session.commit()
+        return revoked
+
+    # SQL condition that holds for the Requests granting their Role right now: APPROVED and inside their validity
+    # window. The database clock is used unless now is given.
+    @staticmethod
+    def effective(now=None):
+        now = now if now is not None else utc_now()
+        return and_(Request.status == 'APPROVED',
+                    or_(Request.valid_from == None, Request.valid_from <= now),
+                    or_(Request.valid_until == None, Request.valid_until > now))
+
+    # Expire the APPROVED grants whose valid_until is not after now. The grants are found through the (status,
+    # valid_until) index in batches of batch_size (REVOKE_BATCH_SIZE by default), each expired and committed on its
+    # own, so a sweep with nothing to expire costs one index probe. Returns the ids of the expired Requests.
+    @staticmethod
+    def expire_grants(now, batch_size=None):
+        batch_size = batch_size or app.config.get('REVOKE_BATCH_SIZE', 1000)
+        table = Request.__table__
+        expired = []
+        while True:
+            ids = [request_id for request_id, in db.session.execute(
+                select([table.c.id]).where(and_(table.c.status == 'APPROVED', table.c.valid_until <= now))
+                .order_by(table.c.valid_until, table.c.id).limit(batch_size))]
+            if not ids:
+                break
+            db.session.execute(table.update().where(and_(table.c.id.in_(ids), table.c.status == 'APPROVED'))
+                               .values(status='EXPIRED'))
+            mark_changed_requests(ids)
+            db.session.commit()
+            expired.extend(ids)
+        return expired
+
+    # Get the ids of the APPROVED grants whose valid_from falls after the sweep watermark in grant_sweeps and not after
+    # now, that is the grants that started since the last sweep of any process, and move the watermark to now in the
+    # same transaction. The first sweep takes every valid_from up to now. The grants need no write, but are noted as
+    # changed so the commit listeners see them, and the event log skips grants already logged as GRANTED, so sweeps
+    # that overlap are harmless. Sweeps run expire_grants with the same now first, so the watermark covers both.
+    @staticmethod
+    def start_grants(now):
+        table = Request.__table__
+        since = Request.swept_until(lock=True)
+        if since is not None and since >= now:
+            db.session.commit()
+            return []
+        conditions = [table.c.status == 'APPROVED', table.c.valid_from <= now]
+        if since is not None:
+            conditions.append(table.c.valid_from > since)
+        ids = [request_id for request_id, in db.session.execute(select([table.c.id]).where(and_(*conditions)))]
+        mark_changed_requests(ids)
+        if since is None:
+            db.session.execute(grant_sweeps.insert().values(id=1, swept_until=now))
+        else:
+            db.session.execute(grant_sweeps.update().where(grant_sweeps.c.id == 1).values(swept_until=now))
+        db.session.commit()
+        return ids
+
+    # Get the time up to which the grant sweeps have run, or None before the first sweep
+    @staticmethod
+    def swept_until(lock=False):
+        query = select([grant_sweeps.c.swept_until]).where(grant_sweeps.c.id == 1)
+        return db.session.execute(query.with_for_update() if lock else query).scalar()
+
+    # Get the approver counter columns mapped to the correlated subqueries counting them from request_approvers
+    @staticmethod
+    def approval_counters():
+        table = Request.__table__
+
+        def counter(approval_status):
+            return select([func.count()]).where(and_(request_approvers.c.request_id == table.c.id,
+                                                     request_approvers.c.approval_status == approval_status)) \
+                .as_scalar()
+        return {"pending_count": counter("PENDING"), "approved_count": counter("APPROVED"),
+                "rejected_count": counter("REJECTED")}
+
+    # Recompute the approver counters of every Request from request_approvers in one statement. Large databases can
+    # use the recount_approvals online migration instead, which does the same in checkpointed chunks.
+    @staticmethod
+    def recount_approvals():
+        db.session.execute(Request.__table__.update().values(**Request.approval_counters()))
+
     # To_String method
     def __repr__(self):
         return str(self.id) + " : " + str(self.role_id) + " : " + str(self.requested_for_id) + " : " + self.status
 
 
+# APPROVAL INBOX OBJECT ===
+# Denormalized per approver view of request_approvers joined with the Request status. An item is PENDING while the
+# approver still has to act on an open Request, APPROVED or REJECTED once they have, and CLOSED if the Request was
+# resolved without them. The primary key lets a User's pending items be read with a single index range scan.
+class InboxItem(db.Model):
+    # Model metadata
+    __tablename__ = 'approval_inbox'
+
+    # Model information
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True, autoincrement=False)
+    status = Column(Enum("PENDING", "APPROVED", "REJECTED", "CLOSED"), primary_key=True)
+    request_id = Column(Integer, ForeignKey("requests.id"), primary_key=True, autoincrement=False)
+
+    # Method for creating new InboxItem objects
+    def __init__(self, user_id, status="PENDING"):
+        self.user_id = user_id
+        self.status = status
+
+    # Get the newest pending Requests awaiting the given User along with the total number pending. The window count
+    # is computed over the same index range as the items, so both come back from one statement.
+    @staticmethod
+    def pending(user_id, limit=5):
+        total = func.count().over().label('total')
+        rows = Request.with_details(db.session.query(Request, total)
+                                    .join(InboxItem, InboxItem.request_id == Request.id)
+                                    .filter(InboxItem.user_id == user_id, InboxItem.status == 'PENDING')
+                                    .order_by(desc(InboxItem.request_id))
+                                    .limit(limit)).all()
+        return [row[0] for row in rows], rows[0][1] if rows else 0
+
+    # Move an approver's item out of PENDING after their decision, and close every other pending item of the Request
+    # if the decision resolved it
+    @staticmethod
+    def record_decision(request_id, user_id, decision):
+        InboxItem.record_decisions([request_id], [request_id] if decision == 'REJECTED' else [], user_id)
+
+    # Move an approver's items for the given Requests out of PENDING, rejecting those in rejected_ids and approving the
+    # rest, then close every other pending item of the Requests the decisions resolved
+    @staticmethod
+    def record_decisions(request_ids, rejected_ids, user_id):
+        table = InboxItem.__table__
+        status = case([(table.c.request_id.in_(rejected_ids), 'REJECTED')], else_='APPROVED') \
+            if rejected_ids else 'APPROVED'
+        db.session.execute(table.update()
+                           .where(and_(table.c.request_id.in_(request_ids), table.c.user_id == user_id,
+                                       table.c.status == 'PENDING'))
+                           .values(status=status))
+        resolved = exists().where(and_(Request.id == table.c.request_id, Request.status != 'PENDING'))
+        db.session.execute(table.update()
+                           .where(and_(table.c.request_id.in_(request_ids), table.c.status == 'PENDING', resolved))
+                           .values(status='CLOSED'))
+
+    # Recompute the whole inbox from request_approvers. Used to backfill existing databases.
+    @staticmethod
+    def rebuild():
+        table = InboxItem.__table__
+        status = case([(request_approvers.c.approval_status != 'PENDING', request_approvers.c.approval_status),
+                       (Request.status != 'PENDING', 'CLOSED')],
+                      else_='PENDING')
+        db.session.execute(table.delete())
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'status', 'request_id'],
+            select([request_approvers.c.user_id, status, request_approvers.c.request_id])
+            .select_from(request_approvers.join(Request.__table__, Request.id == request_approvers.c.request_id))))
+
+    # To_String method
+    def __repr__(self):
+        return str(self.user_id) + " : " + self.status + " : " + str(self.request_id)
+
+
+# CONFLICT RULE ROLE MANY-TO-MANY MAPPING TABLE ===
+conflict_rule_roles = Table(
+    'conflict_rule_roles',
+    db.metadata,
+    Column('rule_id', Integer, ForeignKey('conflict_rules.id'), primary_key=True),
+    Column('role_id', Integer, ForeignKey('roles.id'), primary_key=True),
+    # Serves finding the rules that mention a Role
+    Index('ix_conflict_rule_roles_role', 'role_id', 'rule_id')
+)
+
+
+# CONFLICT RULE OBJECT ===
+# A separation of duties rule over a set of Roles. A User violates the rule when they effectively hold more than
+# max_roles of its Roles, so a rule over a pair of Roles with max_roles 1 forbids holding both.
+class ConflictRule(db.Model):
+    # Model metadata
+    __tablename__ = 'conflict_rules'
+
+    # Model information
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64), index=True, unique=True, nullable=False)
+    max_roles = Column(Integer, nullable=False, default=1)
+
+    # Method for creating new ConflictRule objects
+    def __init__(self, name, roles, max_roles=1):
+        self.name = name
+        self.max_roles = max_roles
+        self.roles = list(roles)
+
+    # Load every rule as a {rule_id: (name, max_roles, frozenset of Role ids)} dict
+    @staticmethod
+    def load():
+        role_ids = {}
+        for rule_id, role_id in db.session.execute(select([conflict_rule_roles.c.rule_id,
+                                                           conflict_rule_roles.c.role_id])):
+            role_ids.setdefault(rule_id, set()).add(role_id)
+        return {rule_id: (name, max_roles, frozenset(role_ids.get(rule_id, ())))
+                for rule_id, name, max_roles in db.session.execute(select([ConflictRule.id, ConflictRule.name,
+                                                                           ConflictRule.max_roles]))}
+
+    # Find the (user_id, role_id) pairs that would violate a rule if granted. Each User is taken to hold the
+    # descendants of their PENDING and APPROVED Requests, plus the Roles of earlier pairs in the list that do not
+    # conflict. Returns a {(user_id, role_id): [rule names]} dict of the conflicting pairs. Uses a fixed number of
+    # queries however many pairs are checked.
+    @staticmethod
+    def find_conflicts(pairs):
+        pairs = list(pairs)
+        rules = ConflictRule.load()
+        if not rules or not pairs:
+            return {}
+        rules_by_role = {}
+        for rule_id, (name, max_roles, role_ids) in rules.items():
+            for role_id in role_ids:
+                rules_by_role.setdefault(role_id, []).append(rule_id)
+        user_ids = sorted({user_id for user_id, _ in pairs})
+        role_ids = sorted({role_id for _, role_id in pairs})
+        # Roles effectively held or requested by each User
+        held = {}
+        for start in range(0, len(user_ids), DECISION_BATCH_SIZE):
+            for user_id, role_id in db.session.execute(
+                    select([Request.requested_for_id, role_closure.c.descendant_id])
+                    .select_from(Request.__table__.join(role_closure, role_closure.c.ancestor_id == Request.role_id))
+                    .where(and_(Request.requested_for_id.in_(user_ids[start:start + DECISION_BATCH_SIZE]),
+                                Request.status.in_(['PENDING', 'APPROVED'])))):
+                held.setdefault(user_id, set()).add(role_id)
+        # Roles granted by each requested Role
+        granted = {}
+        for start in range(0, len(role_ids), DECISION_BATCH_SIZE):
+            for role_id, descendant_id in db.session.execute(
+                    select([role_closure.c.ancestor_id, role_closure.c.descendant_id])
+                    .where(role_closure.c.ancestor_id.in_(role_ids[start:start + DECISION_BATCH_SIZE]))):
+                granted.setdefault(role_id, set()).add(descendant_id)
+
+        conflicts = {}
+        for user_id, role_id in pairs:
+            new_roles = granted.get(role_id, {role_id})
+            user_roles = held.setdefault(user_id, set())
+            violated = [rules[rule_id][0] for rule_id in sorted({rule_id for new_role in new_roles
+                                                                  for rule_id in rules_by_role.get(new_role, ())})
+                        if len(rules[rule_id][2] & (user_roles | new_roles)) > rules[rule_id][1]]
+            if violated:
+                conflicts[(user_id, role_id)] = violated
+            else:
+                user_roles.update(new_roles)
+        return conflicts
+
+    # To_String method
+    def __repr__(self):
+        return self.name + " : " + str(self.max_roles)
+
+
+# ACCESS EVENT OBJECT ===
+# Append-only log of what happened to Requests and when. Transition events record a Request being REQUESTED, APPROVED,
+# REJECTED, REVOKED or EXPIRED, and GRANTED when an APPROVED Request starts granting its Role, which is at approval
+# unless its valid_from is later. APPROVAL and REJECTION events record the decision of a single approver. Events are
+# written by the same transaction as the change they record and are never updated or deleted. User and Role ids are
+# plain columns, so the log outlives the Users and Roles it mentions.
+class AccessEvent(db.Model):
+    # Model metadata
+    __tablename__ = 'access_events'
+    __table_args__ = (
+        # Serve "what changed between T1 and T2" over the whole log, one Role or one User
+        Index('ix_access_events_occurred_at', 'occurred_at'),
+        Index('ix_access_events_role_occurred_at', 'role_id', 'occurred_at'),
+        Index('ix_access_events_user_occurred_at', 'user_id', 'occurred_at'),
+        # Serves finding the last recorded transition of a Request
+        Index('ix_access_events_request', 'request_id', 'id'),
+    )
+
+    # Model information
+    id = Column(Integer, primary_key=True)
+    occurred_at = Column(DateTime, nullable=False)
+    kind = Column(Enum("REQUESTED", "APPROVAL", "REJECTION", "APPROVED", "GRANTED", "REJECTED", "REVOKED", "EXPIRED"),
+                  nullable=False)
+    request_id = Column(Integer, nullable=False)
+    # The User the Request is for and the Role requested
+    user_id = Column(Integer, nullable=False)
+    role_id = Column(Integer, nullable=False)
+    # The logged in User who made the change, None for changes made by the system such as grant expiry
+    actor_id = Column(Integer)
+
+    # To_String method
+    def __repr__(self):
+        return str(self.occurred_at) + " : " + self.kind + " : " + str(self.request_id) + " : " + str(self.actor_id)
+
+
+# Snapshot of every Request granting its Role as of taken_at, used as the starting point of point-in-time queries so
+# only the events after it need to be replayed. Snapshots are built from the previous snapshot and the events in
+# between, or from the Requests table for the first one.
+class AccessSnapshot(db.Model):
+    # Model metadata
+    __tablename__ = 'access_snapshots'
+
+    # Model information
+    id = Column(Integer, primary_key=True)
+    taken_at = Column(DateTime, index=True, unique=True, nullable=False)
+    grant_count = Column(Integer, nullable=False, default=0)
+
+    # To_String method
+    def __repr__(self):
+        return str(self.id) + " : " + str(self.taken_at) + " : " + str(self.grant_count)
+
+
+# ACCESS SNAPSHOT GRANTS TABLE ===
+# The grants held at each AccessSnapshot
+access_snapshot_grants = Table(
+    'access_snapshot_grants',
+    db.metadata,
+    Column('snapshot_id', Integer, ForeignKey('access_snapshots.id'), primary_key=True),
+    Column('request_id', Integer, primary_key=True),
+    Column('user_id', Integer, nullable=False),
+    Column('role_id', Integer, nullable=False),
+    Index('ix_access_snapshot_grants_role', 'snapshot_id', 'role_id'),
+    Index('ix_access_snapshot_grants_user', 'snapshot_id', 'user_id')
+)
+
+
+# GRANT SWEEPS TABLE ===
+# A single row holding the time up to which the grant sweeps of every process and scripts/db_expire_grants.py have
+# expired the grants past their valid_until and noted the grants past their valid_from
+grant_sweeps = Table(
+    'grant_sweeps',
+    db.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('swept_until', DateTime, nullable=False)
+)
+
+
+# ENTITLEMENT VERSION TABLE ===
+# A single row counting the committed transactions that changed a Request or the Role graph, which lets every process
+# tell whether its in-memory entitlement index is still current with one primary key read
+entitlement_versions = Table(
+    'entitlement_versions',
+    db.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('version', Integer, nullable=False)
+)
+
+
 # OBJECT RELATIONSHIPS ===
 
+# Define relationship between a ConflictRule and the Roles it covers
+ConflictRule.roles = relationship('Role', secondary=conflict_rule_roles,
+                                  backref=backref('conflict_rules', lazy='dynamic'))
+# Define relationship between a Request and the Inbox Items of its Approvers
+Request.inbox_items = relationship('InboxItem', backref='request', lazy='dynamic')
 # Define relationship between a Role and Requests for this Role
 Role.requests = relationship('Request', backref='requested_role', lazy='dynamic')
 # Define relationship between a Role and its Parents
@@ -296,6 +986,194 @@ User.requests_by = relationship('Request', backref='requested_by',
                                 lazy='dynamic', foreign_keys=[Request.requested_by_id], order_by=desc(Request.id))
 # Define relationship between a User and their Active Roles
 User.active_roles = relationship('Request', lazy='dynamic',
-                                 primaryjoin=and_(User.id == Request.requested_for_id, Request.status == 'APPROVED'))
+                                 primaryjoin=and_(User.id == Request.requested_for_id, Request.effective()))
 # Define relationship between a User and their Manager. Note: Must be declared outside of the class.
 User.manager = relationship('User', backref='subordinates', remote_side=User.id, post_update=True)
+
+# ROLE CLOSURE MAINTENANCE ===
+
+# Give every new Role its depth 0 closure row
+@event.listens_for(Role, 'after_insert')
+def add_role_closure_self(mapper, connection, target):
+    connection.execute(role_closure.insert(), ancestor_id=target.id, descendant_id=target.id, depth=0)
+
+
+# Deleting a Role can break paths that ran through it, so recompute the closure when any Role is deleted
+@event.listens_for(Session, 'after_flush')
+def rebuild_closure_after_delete(session, flush_context):
+    if any(isinstance(instance, Role) for instance in session.deleted):
+        rebuild_role_closure(session.connection())
+        mark_role_graph_changed(session)
+
+
+# Revoke the grants of Users deactivated by a flush, in the same transaction as the deactivation, so a deactivated
+# User can never keep a grant. User.deactivate revokes in committed batches first, leaving this only the grants made
+# in between, so deactivate Users through it rather than by setting active_flag.
+@event.listens_for(Session, 'after_flush')
+def revoke_deactivated_users(session, flush_context):
+    deactivated = [instance.id for instance in session.dirty
+                   if isinstance(instance, User) and not instance.active_flag and
+                   attributes.get_history(instance, 'active_flag').deleted]
+    if deactivated:
+        Request.revoke(Request.requested_for_id.in_(deactivated), commit=False)
+
+
+# Remember the Requests written through the ORM by a flush
+@event.listens_for(Session, 'after_flush')
+def collect_changed_requests(session, flush_context):
+    request_ids = [instance.id for instance in list(session.new) + list(session.dirty) if isinstance(instance, Request)]
+    if request_ids:
+        mark_changed_requests(request_ids, session)
+
+
+# Note that the status of the given Requests was changed by a Core statement in the session's transaction, so
+# listeners such as the entitlement index can apply the changes once they are committed
+def mark_changed_requests(request_ids, session=None):
+    (session or db.session).info.setdefault('changed_requests', set()).update(request_ids)
+
+
+# Note the given {request_id: decision} map of decisions made by an approver in the session's transaction
+def mark_decisions(user_id, decisions, session=None):
+    (session or db.session).info.setdefault('approver_decisions', []).extend(
+        (request_id, user_id, decision) for request_id, decision in sorted(decisions.items()))
+
+
+# Note that the Role inheritance graph was changed in the session's transaction
+def mark_role_graph_changed(session=None):
+    (session or db.session).info['role_graph_changed'] = True
+
+
+# Get the committed entitlement version, 0 before the first change
+def entitlement_version(connection=None):
+    connection = connection or db.session
+    return connection.execute(select([entitlement_versions.c.version])
+                              .where(entitlement_versions.c.id == 1)).scalar() or 0
+
+
+# Bump the entitlement version in a transaction that changed Requests or the Role graph, once per transaction, so the
+# entitlement indexes of every process see the change. Returns the new version, or None if nothing changed.
+@event.listens_for(Session, 'before_commit')
+def bump_entitlement_version(session):
+    if 'entitlement_version' in session.info:
+        return session.info['entitlement_version']
+    # Commit flushes after this event, so flush now to see every pending change
+    session.flush()
+    if not session.info.get('changed_requests') and not session.info.get('role_graph_changed'):
+        return None
+    table = entitlement_versions
+    if session.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1)).rowcount == 0:
+        session.execute(table.insert().values(id=1, version=1))
+    session.info['entitlement_version'] = entitlement_version(session)
+    return session.info['entitlement_version']
+
+
+# Write the AccessEvents of the Requests changed in the transaction just before it commits. Each changed Request is
+# compared against its last recorded transition, so every write path that notes its changes is logged once. Grants
+# started or expired by the grant sweeper are logged at their valid_from and valid_until rather than at the sweep.
+@event.listens_for(Session, 'before_commit')
+def record_access_events(session):
+    # Commit flushes after this event, so flush now to see every pending change
+    session.flush()
+    request_ids = sorted(session.info.get('changed_requests', ()))
+    decisions = session.info.pop('approver_decisions', [])
+    if not request_ids:
+        return
+    now = datetime.utcnow()
+    user = g.get('user') if has_request_context() else None
+    actor_id = getattr(user, 'id', None)
+    events = AccessEvent.__table__
+    requests = {}
+    recorded = {}
+    for start in range(0, len(request_ids), DECISION_BATCH_SIZE):
+        batch = request_ids[start:start + DECISION_BATCH_SIZE]
+        for row in session.execute(select([Request.id, Request.status, Request.requested_for_id, Request.role_id,
+                                           case([(Request.effective(now), True)], else_=False),
+                                           Request.valid_from, Request.valid_until])
+                                   .where(Request.id.in_(batch))):
+            requests[row[0]] = row
+        last = select([func.max(events.c.id)]).where(and_(events.c.request_id.in_(batch),
+                                                          events.c.kind.in_(TRANSITION_EVENTS))) \
+            .group_by(events.c.request_id)
+        recorded.update((request_id, (kind, occurred_at)) for request_id, kind, occurred_at in session.execute(
+            select([events.c.request_id, events.c.kind, events.c.occurred_at]).where(events.c.id.in_(last))))
+
+    rows = []
+    # A Request decided in this transaction was moved by its approver
+    deciders = {}
+    for request_id, user_id, decision in decisions:
+        deciders[request_id] = user_id
+        if request_id in requests:
+            rows.append({"occurred_at": now, "request_id": request_id, "user_id": requests[request_id][2],
+                         "role_id": requests[request_id][3], "actor_id": user_id,
+                         "kind": "APPROVAL" if decision == "APPROVED" else "REJECTION"})
+    for request_id in request_ids:
+        if request_id not in requests:
+            continue
+        _, status, user_id, role_id, effective, valid_from, valid_until = requests[request_id]
+        last, last_at = recorded.get(request_id, (None, None))
+        # A grant approved in an earlier transaction started at its valid_from, or when it was approved if that is
+        # later, and a time bound grant ended at its valid_until, however late the sweep noticed either
+        started_at = max(valid_from, last_at) if last == 'APPROVED' and valid_from is not None else now
+        kinds = []
+        if status == 'PENDING':
+            if last is None:
+                kinds.append(('REQUESTED', now))
+        elif status == 'APPROVED':
+            if last not in ('APPROVED', 'GRANTED'):
+                kinds.append(('APPROVED', now))
+            if effective and last != 'GRANTED':
+                kinds.append(('GRANTED', min(started_at, now)))
+        elif status != last:
+            if status == 'EXPIRED':
+                ended_at = min(max(valid_until, last_at or valid_until), now) if valid_until is not None else now
+                # A grant that started and ended between two sweeps was never logged as GRANTED
+                if last == 'APPROVED' and valid_from is not None and started_at < ended_at:
+                    kinds.append(('GRANTED', started_at))
+                kinds.append(('EXPIRED', ended_at))
+            else:
+                kinds.append((status, now))
+        rows.extend({"occurred_at": occurred_at, "request_id": request_id, "user_id": user_id, "role_id": role_id,
+                     "actor_id": None if kind == 'EXPIRED' else deciders.get(request_id, actor_id), "kind": kind}
+                    for kind, occurred_at in kinds)
+    if rows:
+        session.execute(events.insert(), rows)
+
+
+# Forget the changes noted in a transaction once it ends
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def clear_changes(session):
+    session.info.pop('changed_requests', None)
+    session.info.pop('approver_decisions', None)
+    session.info.pop('role_graph_changed', None)
+    session.info.pop('entitlement_version', None)
+
+
+# Recompute the whole closure table from role_parents. Used after deletes and to backfill existing databases.
+def rebuild_role_closure(connection=None):
+    connection = connection or db.session.connection()
+    connection.execute(role_closure.delete())
+    roles = select([Role.id.label('ancestor_id'), Role.id.label('descendant_id'), literal(0)])
+    connection.execute(role_closure.insert().from_select(['ancestor_id', 'descendant_id', 'depth'], roles))
+    depth = 0
+    while True:
+        # Extend every path of the current length by one edge, skipping pairs already reached by a shorter path
+        known = role_closure.alias('known')
+        paths = select([role_closure.c.ancestor_id, role_parents.c.role_id, literal(depth + 1)]) \
+            .select_from(role_closure.join(role_parents, role_parents.c.parent_id == role_closure.c.descendant_id)) \
+            .where(and_(role_closure.c.depth == depth,
+                        ~exists().where(and_(known.c.ancestor_id == role_closure.c.ancestor_id,
+                                             known.c.descendant_id == role_parents.c.role_id)))) \
+            .distinct()
+        if connection.execute(role_closure.insert().from_select(['ancestor_id', 'descendant_id', 'depth'],
+                                                                paths)).rowcount <= 0:
+            break
+        depth += 1
+
+
+# SEARCH INDEXES ===
+
+# Prefix search index over User names, used by the typeahead and browse searches
+register_search_index(User.name)
+# Prefix search index over Role names, used by the typeahead and browse searches
+register_search_index(Role.name)
@@ -0,0 +1,91 @@
+import time
+
+from flask import request, url_for
+
+# Cached row counts keyed by page and search query, each stored as (expires_at, count)
+_counts = {}
+# Largest number of cached counts to keep before the oldest are dropped
+MAX_CACHED_COUNTS = 1024
+
+
+# A page of results addressed by a cursor instead of an offset. Rows are ordered by a unique key and each page is
+# fetched with WHERE key > :after ORDER BY key LIMIT n, so deep pages cost the same as the first one. Mirrors the
+# attributes of a Flask-SQLAlchemy Pagination object that the templates use.
+class KeysetPage(object):
+    def __init__(self, query, key, per_page, after=None, before=None, total=None, params=None):
+        self.key = key
+        self.per_page = per_page
+        self.total = total
+        # Extra URL parameters carried over to the next and previous pages, such as a search query
+        self.params = params or {}
+        query = query.order_by(None)
+        if before is not None:
+            # Walk backwards from the cursor and flip the rows back into key order
+            rows = query.filter(key < before).order_by(key.desc()).limit(per_page + 1).all()
+            self.items = list(reversed(rows[:per_page]))
+            self.has_prev = len(rows) > per_page
+            self.has_next = True
+        else:
+            if after is not None:
+                query = query.filter(key > after)
+            rows = query.order_by(key).limit(per_page + 1).all()
+            self.items = rows[:per_page]
+            self.has_prev = after is not None
+            self.has_next = len(rows) > per_page
+
+    # Cursor of the page before this one
+    @property
+    def prev_cursor(self):
+        return getattr(self.items[0], self.key.key) if self.items else None
+
+    # Cursor of the page after this one
+    @property
+    def next_cursor(self):
+        return getattr(self.items[-1], self.key.key) if self.items else None
+
+
+# A page of results built on first use, so a template fragment served from the cache never runs its query
+class LazyPage(object):
+    def __init__(self, build):
+        self.build = build
+        self.page = None
+
+    # Get the page, building it if this is the first use
+    def resolve(self):
+        if self.page is None:
+            self.page = self.build()
+        return self.page
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+# Count the rows of a query, reusing the last count for the same key until it is ttl seconds old. Browsing a large
+# table then costs one COUNT(*) per ttl instead of one per click, at the price of a slightly stale total.
+def cached_count(key, query, ttl=60):
+    now = time.time()
+    entry = _counts.get(key)
+    if entry is None or entry[0] < now:
+        if key not in _counts and len(_counts) >= MAX_CACHED_COUNTS:
+            # Drop the oldest entry to keep the cache bounded
+            del _counts[next(iter(_counts))]
+        entry = (now + ttl, query.order_by(None).count())
+        _counts[key] = entry
+    return entry[1]
+
+
+# Build the URL of the page before ('prev') or after ('next') the given page for the current endpoint. Works for both
+# KeysetPage and Flask-SQLAlchemy Pagination objects.
+def page_url(page, direction):
+    if isinstance(page, LazyPage):
+        page = page.resolve()
+    args = dict(request.view_args)
+    args.update(getattr(page, 'params', {}))
+    if isinstance(page, KeysetPage):
+        if direction == 'next':
+            args['after'] = page.next_cursor
+        else:
+            args['before'] = page.prev_cursor
+    else:
+        args['page_num'] = page.next_num if direction == 'next' else page.prev_num
+    return url_for(request.endpoint, **args)
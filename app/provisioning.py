@@ -0,0 +1,142 @@
+import csv
+from itertools import islice
+
+from sqlalchemy import select, and_, func
+
+from app import db
+from app.models import User, Role, Request, InboxItem, ConflictRule, role_approvers, request_approvers, \
+    CLOSED_STATUSES, mark_changed_requests
+
+# Largest number of ids bound into a single IN clause. Keeps every statement under SQLite's variable limit.
+CHUNK_SIZE = 500
+
+
+# Split an iterable into lists of at most size items
+def chunks(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+# Insert rows into a table and return the new primary keys in row order, taken from the inserts themselves. On SQLite
+# the rows go in with one executemany, and since the transaction holds the write lock they get consecutive rowids
+# ending at last_insert_rowid(). Backends with RETURNING insert multi-row statements of at most CHUNK_SIZE bound values
+# and report the keys of each. Other backends insert the rows one at a time.
+def insert_returning_ids(table, rows):
+    key = table.primary_key.columns.values()[0]
+    dialect = db.session.get_bind().dialect
+    ids = []
+    if dialect.name == 'sqlite':
+        db.session.execute(table.insert(), rows)
+        last_id = db.session.execute(select([func.last_insert_rowid()])).scalar()
+        ids.extend(range(last_id - len(rows) + 1, last_id + 1))
+    elif dialect.implicit_returning and getattr(dialect, 'supports_multivalues_insert', False):
+        for chunk in chunks(rows, max(1, CHUNK_SIZE // len(rows[0]))):
+            ids.extend(row[0] for row in db.session.execute(table.insert().values(chunk).returning(key)))
+    else:
+        for row in rows:
+            ids.append(db.session.execute(table.insert().values(row)).inserted_primary_key[0])
+    return ids
+
+
+# Create Requests for many (user_id, role_id) pairs at once. Everything the Request constructor would look up per pair
+# (existing active Requests, Role approvers and User managers) is pre-fetched with a few set based queries, and the new
+# Requests and their approvers are written in bulk in a single transaction. Returns one result per pair, in the order
+# given, in the form {user_id, role_id, status, request_id} where status is CREATED, EXISTS, INVALID_USER,
+# INVALID_ROLE, DUPLICATE for a pair listed earlier in the same call, or CONFLICT, in which case the violated conflict
+# rules are listed under rules. valid_from and valid_until optionally bound when the granted access is effective.
+# conflicts is the ConflictRule.find_conflicts result for the pairs when the caller already has it, which saves
+# checking them again. Target throughput on SQLite is 20,000 pairs/second or better.
+def bulk_assign(pairs, requested_by_id, comment=None, valid_from=None, valid_until=None, conflicts=None):
+    pairs = [(int(user_id), int(role_id)) for user_id, role_id in pairs]
+    user_ids = {user_id for user_id, _ in pairs}
+    role_ids = {role_id for _, role_id in pairs}
+
+    # Get the manager of every requested User, which also tells us which Users exist
+    managers = {}
+    for chunk in chunks(user_ids):
+        managers.update(db.session.execute(select([User.id, User.manager_id]).where(User.id.in_(chunk))).fetchall())
+    # Get the Roles that exist and the approvers of each
+    existing_roles = set()
+    approvers = {}
+    for chunk in chunks(role_ids):
+        existing_roles.update(row[0] for row in db.session.execute(select([Role.id]).where(Role.id.in_(chunk))))
+        for role_id, user_id in db.session.execute(select([role_approvers.c.role_id, role_approvers.c.user_id])
+                                                   .where(role_approvers.c.role_id.in_(chunk))):
+            approvers.setdefault(role_id, set()).add(user_id)
+    # Get every active Request that already covers one of the pairs
+    active = set()
+    for user_chunk in chunks(user_ids):
+        for role_chunk in chunks(role_ids):
+            active.update(tuple(row) for row in db.session.execute(
+                select([Request.requested_for_id, Request.role_id])
+                .where(and_(Request.requested_for_id.in_(user_chunk),
+                            Request.role_id.in_(role_chunk),
+                            Request.status.notin_(CLOSED_STATUSES)))))
+
+    # Decide the outcome of every pair
+    report = []
+    new_pairs = []
+    listed = set()
+    for user_id, role_id in pairs:
+        result = {"user_id": user_id, "role_id": role_id, "request_id": None}
+        if (user_id, role_id) in listed:
+            result["status"] = "DUPLICATE"
+            report.append(result)
+            continue
+        listed.add((user_id, role_id))
+        if user_id not in managers:
+            result["status"] = "INVALID_USER"
+        elif role_id not in existing_roles:
+            result["status"] = "INVALID_ROLE"
+        elif (user_id, role_id) in active:
+            result["status"] = "EXISTS"
+        else:
+            result["status"] = "CREATED"
+            new_pairs.append((user_id, role_id))
+        report.append(result)
+    # Refuse the new pairs that would break a separation of duties rule
+    if conflicts is None:
+        conflicts = ConflictRule.find_conflicts(new_pairs)
+    if conflicts:
+        new_pairs = [pair for pair in new_pairs if pair not in conflicts]
+        for result in report:
+            if (result["user_id"], result["role_id"]) in conflicts and result["status"] == "CREATED":
+                result["status"] = "CONFLICT"
+                result["rules"] = conflicts[(result["user_id"], result["role_id"])]
+
+    if new_pairs:
+        # Approvers are the Role approvers plus the requested for User's manager
+        pair_approvers = {}
+        for user_id, role_id in new_pairs:
+            pair_approvers[(user_id, role_id)] = set(approvers.get(role_id, ()))
+            if managers[user_id] is not None:
+                pair_approvers[(user_id, role_id)].add(managers[user_id])
+        # Insert every new Request, taking their ids from the inserts
+        ids = insert_returning_ids(Request.__table__, [
+            {"role_id": role_id, "requested_for_id": user_id, "requested_by_id": requested_by_id,
+             "comment": comment, "status": "PENDING", "valid_from": valid_from, "valid_until": valid_until,
+             "pending_count": len(pair_approvers[(user_id, role_id)]), "approved_count": 0, "rejected_count": 0}
+            for user_id, role_id in new_pairs])
+        created = dict(zip(new_pairs, ids))
+        # Insert every Request approver with a single executemany
+        rows = [{"request_id": created[pair], "user_id": approver_id, "approval_status": "PENDING"}
+                for pair in new_pairs for approver_id in pair_approvers[pair]]
+        if rows:
+            db.session.execute(request_approvers.insert(), rows)
+            db.session.execute(InboxItem.__table__.insert(),
+                               [{"user_id": row["user_id"], "status": "PENDING", "request_id": row["request_id"]}
+                                for row in rows])
+        for result in report:
+            if result["status"] == "CREATED":
+                result["request_id"] = created[(result["user_id"], result["role_id"])]
+        mark_changed_requests(created.values())
+    db.session.commit()
+    return report
+
+
+# Parse a CSV upload with user_id and role_id columns into (user_id, role_id) pairs
+def parse_pairs_csv(stream):
+    return [(row["user_id"], row["role_id"]) for row in csv.DictReader(stream)]
@@ -0,0 +1,104 @@
+import re
+
+from sqlalchemy import DDL, Integer, Float, event, text, select, literal, false, or_, and_
+
+from app import db
+
+# Split a search query into the word tokens understood by the index
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+# Largest number of digits in an id, used to turn an id prefix into a set of primary key ranges
+ID_DIGITS = 9
+# DDL statements for every registered search index, keyed by index name
+_index_ddl = {}
+
+
+# Get the name of the full text index for the given table
+def index_name(table):
+    return table.name + '_search'
+
+
+# Register a prefix search index over a text column of a table. On SQLite this is an FTS5 external content table
+# created alongside the table and kept in sync by triggers, so writes from any process or script are indexed.
+def register_search_index(column):
+    table = column.table
+    index = index_name(table)
+    pk = list(table.primary_key.columns)[0].name
+    statements = [
+        # Index 2 and 3 character prefixes so that typeahead queries never scan the term list
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({col}, content='{table}', content_rowid='{pk}', "
+        "prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {table} BEGIN "
+        "INSERT INTO {index}(rowid, {col}) VALUES (new.{pk}, new.{col}); END",
+        "CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {table} BEGIN "
+        "INSERT INTO {index}({index}, rowid, {col}) VALUES ('delete', old.{pk}, old.{col}); END",
+        "CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE OF {col} ON {table} BEGIN "
+        "INSERT INTO {index}({index}, rowid, {col}) VALUES ('delete', old.{pk}, old.{col}); "
+        "INSERT INTO {index}(rowid, {col}) VALUES (new.{pk}, new.{col}); END"
+    ]
+    _index_ddl[index] = [statement.format(index=index, table=table.name, col=column.name, pk=pk)
+                         for statement in statements]
+    for statement in _index_ddl[index]:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(table, 'after_drop', DDL('DROP TABLE IF EXISTS ' + index).execute_if(dialect='sqlite'))
+
+
+# Create any missing search indexes on an existing database and rebuild their contents from the base tables
+def rebuild_search_indexes():
+    if db.engine.dialect.name != 'sqlite':
+        return
+    for index, statements in _index_ddl.items():
+        for statement in statements:
+            db.session.execute(statement)
+        db.session.execute("INSERT INTO {index}({index}) VALUES ('rebuild')".format(index=index))
+    db.session.commit()
+
+
+# Build an FTS5 match expression that treats every word in the query as a prefix
+def match_expression(query):
+    return ' AND '.join('"' + term + '"*' for term in _TOKEN.findall(query.lower()))
+
+
+# Get a selectable of (id, rank) rows matching the query against the indexed column, best match first.
+# The limit is applied inside the index lookup so only the top matches are ever joined back to the base table.
+def matches(column, query, limit=None):
+    table = column.table
+    pk = list(table.primary_key.columns)[0]
+    expression = match_expression(query)
+    if db.engine.dialect.name != 'sqlite':
+        # Fall back to an index friendly prefix match on backends without FTS5
+        hits = select([pk.label('id'), literal(0).label('rank')]).where(column.like(_escape_like(query) + '%',
+                                                                                     escape='\\'))
+        if limit is not None:
+            hits = hits.order_by(column).limit(limit)
+        return hits.alias(index_name(table) + '_hits')
+    if not expression:
+        # Nothing searchable in the query, return an empty result set
+        hits = select([pk.label('id'), literal(0).label('rank')]).where(false())
+        return hits.alias(index_name(table) + '_hits')
+    index = index_name(table)
+    statement = 'SELECT rowid AS id, bm25({index}) AS rank FROM {index} WHERE {index} MATCH :expression ' \
+                'ORDER BY rank'.format(index=index)
+    if limit is not None:
+        statement += ' LIMIT :limit'
+    hits = text(statement).bindparams(expression=expression)
+    if limit is not None:
+        hits = hits.bindparams(limit=limit)
+    return hits.columns(id=Integer, rank=Float).alias(index + '_hits')
+
+
+# Build a predicate matching every id that starts with the given digits using primary key range scans. Ids have no
+# leading zeros, so digits starting with 0 match nothing.
+def id_prefix(column, digits):
+    if digits.startswith('0'):
+        return false()
+    prefix = int(digits)
+    ranges = [column == prefix]
+    for width in range(1, ID_DIGITS - len(digits) + 1):
+        low = prefix * 10 ** width
+        ranges.append(and_(column >= low, column < low + 10 ** width))
+    return or_(*ranges)
+
+
+# Escape LIKE wildcards in user input
+def _escape_like(query):
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -0,0 +1,81 @@
+import threading
+import time
+from datetime import datetime
+
+from app import app, db
+from app.audit import snapshot_if_due
+from app.models import Request
+
+
+# Moves time bound grants through their validity window. Each sweep expires the APPROVED grants whose valid_until has
+# passed and notes the grants whose valid_from was reached since the previous sweep of any process, as recorded in the
+# grant_sweeps table, so the entitlement index and the access event log see both, then takes an access snapshot if one
+# is due. Grants that started while no process swept are picked up by the next sweep. Both scans are range reads of
+# the (status, valid_until) and (status, valid_from) indexes, so a sweep that finds nothing costs two index probes.
+class GrantSweeper(object):
+    def __init__(self, interval=60, batch_size=None):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_sweep = None
+        self.last_snapshot = None
+        self.sweeps = 0
+        self.expired = 0
+        self.started = 0
+        self._thread = None
+
+    # Run one sweep up to now and record the transitions in the log. Returns the expired and started Request ids and
+    # the access snapshot taken, if any.
+    def sweep(self, now=None):
+        now = now or datetime.utcnow()
+        expired = Request.expire_grants(now, self.batch_size)
+        started = Request.start_grants(now)
+        snapshot = snapshot_if_due()
+        self.last_sweep = now
+        if snapshot is not None:
+            self.last_snapshot = snapshot.taken_at
+        self.sweeps += 1
+        self.expired += len(expired)
+        self.started += len(started)
+        if expired:
+            app.logger.info('Expired grants: %s', ' '.join(str(request_id) for request_id in expired))
+        if started:
+            app.logger.info('Started grants: %s', ' '.join(str(request_id) for request_id in started))
+        return expired, started, snapshot
+
+    # Sweep every interval seconds on a daemon thread
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='grant-sweeper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.sweep()
+            except Exception:
+                app.logger.exception('Grant sweep failed')
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    # Counts of the sweeps this process ran and the grants they moved
+    def stats(self):
+        return {"sweeps": self.sweeps, "expired": self.expired, "started": self.started,
+                "last_sweep": self.last_sweep.isoformat() if self.last_sweep else None,
+                "last_snapshot": self.last_snapshot.isoformat() if self.last_snapshot else None,
+                "interval": self.interval}
+
+
+# Process wide grant sweeper
+grant_sweeper = GrantSweeper(app.config.get('GRANT_SWEEP_INTERVAL', 60), app.config.get('GRANT_SWEEP_BATCH_SIZE'))
+
+
+# Start sweeping once the app serves its first request, unless GRANT_SWEEP_INTERVAL is 0
+@app.before_first_request
+def start_grant_sweeper():
+    if grant_sweeper.interval > 0:
+        grant_sweeper.start()
@@ -0,0 +1,37 @@
+from sqlalchemy import event
+
+from app import db
+
+
+# Records every SQL statement sent to the database while it is active. Use as a context manager.
+class QueryCounter(object):
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        self.engine = self.engine or db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    # Number of statements executed so far
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+# Request a route through a Flask test client and fail unless it issues exactly the expected number of queries.
+# Pass maximum=True to only fail when the route issues more queries than expected. Returns the response.
+def assert_query_count(client, url, expected, maximum=False, method='get', **kwargs):
+    with QueryCounter() as counter:
+        response = getattr(client, method)(url, **kwargs)
+    if counter.count > expected or (counter.count != expected and not maximum):
+        raise AssertionError(url + " issued " + str(counter.count) + " queries, expected " +
+                             ("at most " if maximum else "") + str(expected) + ":\n" + "\n".join(counter.statements))
+    return response
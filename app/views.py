@@ -1,156 +1,280 @@
+import io
 import json
+from functools import wraps
 
-from flask import render_template, redirect, abort, url_for, request, g
-from flask_login import logout_user, current_user, login_required
+from flask import Blueprint, current_app, render_template, redirect, abort, url_for, request, g, Response, \
+    stream_with_context
+from flask_login import LoginManager, logout_user, current_user, login_required
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from wtforms import ValidationError
 
-from app import app, lm
 from config import *
 from .forms import *
 from .models import *
+from .credentials import credential_service
+from .audit import holders_at, roles_at, changes_statement
+from .catalog import CatalogError, parse_catalog, import_catalog, stream_catalog, encode_catalog
+from .catalog import FORMATS as CATALOG_FORMATS
+from .entitlements import entitlement_index
+from .fragments import ROLES, USERS, REQUESTS, conditional, fragment_key, fragment_cache, conditional_stats
+from .export import FORMATS, export_statement, stream_rows, parse_date
+from .metrics import configure_metrics, format_metric
+from .identity import CurrentUser, get_snapshot, identity_cache
+from .pagination import KeysetPage, LazyPage, cached_count, page_url
+from .provisioning import bulk_assign, parse_pairs_csv
+from .sweeper import grant_sweeper
+
+
+# Blueprint holding every page and endpoint of the web application
+main = Blueprint('main', __name__)
+# Create login app
+lm = LoginManager()
+lm.login_view = 'main.login'
+# Request latency and SQL metrics, set up when the blueprint is registered
+metrics = None
+
+
+# Set up the app wide parts of the web application when the blueprint is registered
+@main.record_once
+def setup_app(state):
+    global metrics
+    # Instrument request latency and SQL statements
+    metrics = configure_metrics(state.app)
+    lm.init_app(state.app)
+    # Let templates build links to the next and previous page of results
+    state.app.jinja_env.globals['page_url'] = page_url
+    # Let pages hand the CSRF token to scripts calling the JSON endpoints
+    state.app.jinja_env.globals['csrf_token'] = generate_csrf
 
 
 # Set up our global user variable
-@app.before_request
+@main.before_app_request
 def before_request():
     g.user = current_user
 
 
-# Loads a user from the database. Used by Flask-Login.
+# Abort with 400 unless the request carries the session's CSRF token in an X-CSRFToken header or a csrf_token form
+# field, so other sites cannot make a logged in User's browser call an endpoint that changes data. Pages expose the
+# token in their csrf-token meta tag. Skipped when WTF_CSRF_ENABLED is off, as it is for the forms.
+def check_csrf():
+    if not current_app.config.get('WTF_CSRF_ENABLED', True):
+        return
+    token = request.headers.get('X-CSRFToken') or request.form.get('csrf_token')
+    try:
+        valid = validate_csrf(token)
+    except ValidationError:
+        valid = False
+    if valid is False:
+        abort(400)
+
+
+# Abort with 403 unless the logged in User holds ADMIN_ROLE. Apply below login_required, for the administrative
+# endpoints.
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        admin_role = Role.get_by_name(ADMIN_ROLE)
+        if admin_role is None or not g.user.has_role(admin_role):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+# Get the JSON object sent as the body of a request. Aborts with 415 unless it is sent as application/json, which a
+# cross-site form cannot do, and with 400 unless it is a JSON object.
+def json_body():
+    if not request.is_json:
+        abort(415)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    return body
+
+
+# Loads a user from the identity cache, falling back to the database. Used by Flask-Login.
 @lm.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    snapshot = get_snapshot(int(id))
+    return CurrentUser(snapshot) if snapshot is not None else None
 
 
 # Handle the login page
-@app.route('/login/', methods=['GET', 'POST'])
+@main.route('/login/', methods=['GET', 'POST'])
 def login():
     # Check if g.user is set to an authenticated user
     if g.user is not None and g.user.is_authenticated:
         # Redirect to the index page
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     # Create login form
     form = LoginForm()
 
     if form.submit.data and form.validate_on_submit():
         # Redirect to the index or the next page
-        return redirect(request.args.get('next') or url_for('index'))
+        return redirect(request.args.get('next') or url_for('.index'))
     else:
         # If the user has not logged in, send to the login page
         return render_template('login.html', form=form)
 
 
 # Handle the index page
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index/', methods=['GET', 'POST'])
+@main.route('/', methods=['GET', 'POST'])
+@main.route('/index/', methods=['GET', 'POST'])
 @login_required
 def index():
     if request.method == 'POST':
+        check_csrf()
         if 'Approve' in request.form:
             # If an approval was submitted, set approval_status to approved
             g.user.update_approval(int(request.form['Approve']), "APPROVED")
         elif 'Reject' in request.form:
             # If a rejection was submitted, set approval_status to rejected
             g.user.update_approval(int(request.form['Reject']), "REJECTED")
-    # Get first five active incoming Requests for the current User
-    incoming = g.user.active_approvals.limit(5).all()
+        elif 'ApproveSelected' in request.form or 'RejectSelected' in request.form:
+            # If several Requests were selected, decide all of them in one transaction
+            decision = "APPROVED" if 'ApproveSelected' in request.form else "REJECTED"
+            g.user.update_approvals([(int(request_id), decision) for request_id in request.form.getlist('selected')])
+    # Get the first active incoming Requests for the current User and the number pending in total
+    incoming, incoming_total = InboxItem.pending(g.user.id, INBOX_SIZE)
     # Get first five outgoing Requests for the current User
-    outgoing = g.user.requests_by.limit(5).all()
-    return render_template('index.html', incoming=incoming, outgoing=outgoing)
+    outgoing = Request.with_details(Request.query.filter(Request.requested_by_id == g.user.id)) \
+        .order_by(desc(Request.id)).limit(5).all()
+    return render_template('index.html', incoming=incoming, incoming_total=incoming_total, outgoing=outgoing)
+
+
+# Version keys of the user pages that can be answered with 304 Not Modified
+def user_page_versions(user_id, subpage='', page_num=1):
+    if subpage == 'roles':
+        return [('user', user_id), ('grants', user_id), ROLES]
+    elif subpage == '':
+        return [('user', user_id), USERS]
+    return None
 
 
 # Handle all of the user pages
-@app.route('/user/<int:user_id>/')
-@app.route('/user/<int:user_id>/<subpage>/')
+@main.route('/user/<int:user_id>/')
+@main.route('/user/<int:user_id>/<subpage>/')
+@main.route('/user/<int:user_id>/<subpage>/<int:page_num>/')
 @login_required
-def user_page(user_id, subpage=''):
+@conditional(user_page_versions)
+def user_page(user_id, subpage='', page_num=1):
     # Find the User or throw a 404 if they do not exist
     user = User.query.get_or_404(user_id)
 
     if subpage == 'roles':
         # Visit the user's active roles page
-        data = user.active_roles.all()
+        data = LazyPage(lambda: Request.with_details(Request.query.with_parent(user, 'active_roles'))
+                        .paginate(page_num, RESULTS_PER_PAGE, True))
         headers = ["Name", "Description"]
-        return render_template('user_roles.html', headers=headers, data=data, user=user)
+        return render_template('user_roles.html', headers=headers, data=data, user=user,
+                               fragment_key=fragment_key('user_roles', [user_id, page_num],
+                                                         user_page_versions(user_id, subpage)))
     elif subpage == 'requests':
-        # Visit the user's active roles page
-        data = user.requests_by.all()
+        # Visit the user's requests page
+        data = Request.with_details(Request.query.with_parent(user, 'requests_by')).order_by(desc(Request.id)) \
+            .paginate(page_num, RESULTS_PER_PAGE, True)
         headers = ["Status", "Role", "Requested For", "Comment"]
         return render_template('user_requests.html', headers=headers, data=data, user=user)
+    elif subpage == 'org':
+        # Visit the page of everyone reporting to the user, directly or indirectly
+        data = User.with_manager(user.reports(transitive=True, with_depth=True)) \
+            .paginate(page_num, RESULTS_PER_PAGE, True)
+        headers = ["ID", "Name", "Manager", "Level"]
+        return render_template('user_org.html', headers=headers, data=data, user=user)
     elif subpage == '':
-        # Load the default user page
-        return render_template('user.html', user=user)
+        # Load the default user page with the user's management chain
+        return render_template('user.html', user=user, chain=user.management_chain().all())
     else:
         # Trying to visit an invalid user page, throw 404
         abort('404')
 
 
+# Version keys of a role page: the Role itself, the names of its parents and children and the names of its approvers
+def role_page_versions(role_id):
+    return [('role', role_id), ROLES, USERS]
+
+
 # Handle all of the user pages
-@app.route('/role/<int:role_id>/')
+@main.route('/role/<int:role_id>/')
 @login_required
+@conditional(role_page_versions)
 def role_page(role_id):
     # Find the Role or throw a 404 if it doesn't exist
     role = Role.query.get_or_404(role_id)
-    # Render the user page with the given role
-    return render_template('role.html', role=role)
+    # Render the user page with the given role. Its approvers, parents and children are loaded by the template only
+    # when the rendered fragment is not cached.
+    return render_template('role.html', role=role,
+                           fragment_key=fragment_key('role', [role_id], role_page_versions(role_id)))
 
 
 # Handle the Browse page
-@app.route('/browse/<type>/<int:page_num>/', methods=['GET', 'POST'])
-@app.route('/browse/<type>/', methods=['GET', 'POST'])
+@main.route('/browse/<type>/<int:page_num>/', methods=['GET', 'POST'])
+@main.route('/browse/<type>/', methods=['GET', 'POST'])
 @login_required
-def browse(type, page_num=1):
+def browse(type, page_num=None):
     form = SearchForm()
+    if form.submit.data and form.validate_on_submit():
+        # A new search was submitted, start again from the first page
+        search = form.query.data
+        page_num = page_num and 1
+    else:
+        # Carry over the search from the previous page, if any
+        search = request.args.get('q')
     if type.lower() == 'users' or type.lower() == 'user':
         # Search User Page
         page = "browse_users.html"
         # Create column headers
         headers = ["Emp ID", "Name", "Manager"]
-
-        if form.submit.data and form.validate_on_submit():
-            # Search the id and name column
-            data = User.search(form.query.data)
-            page_num = 1
-        else:
-            # Render the full set of users as no search query was provided
-            data = User.query
+        # Search the id and name column, or render the full set of users if no search query was provided
+        data = User.with_manager(User.search(search) if search else User.query)
+        key = User.id
+        versions = [USERS]
     elif type.lower() == 'roles' or type.lower() == 'role':
         # Search Role Page
         page = "browse_roles.html"
         # Create column headers
         headers = ["Name", "Description"]
-
-        if form.submit.data and form.validate_on_submit():
-            # Search the role name column
-            data = Role.search(form.query.data)
-            page_num = 1
-        else:
-            # Render the full set of roles as no search query was provided
-            data = Role.query
+        # Search the role name column, or render the full set of roles if no search query was provided
+        data = Role.search(search) if search else Role.query
+        key = Role.id
+        versions = [ROLES]
     elif type.lower() == 'requests' or type.lower() == 'request':
         # Search Request Page
         page = "browse_requests.html"
         # Create column headers
         headers = ["Status", "Role", "Requested For", "Requested By", "Comment"]
-
-        if form.submit.data and form.validate_on_submit():
-            # Search by role name or requestor name/id
-            data = Request.search(form.query.data)
-            page_num = 1
-        else:
-            # Render the full set of roles as no search query was provided
-            data = Request.query
+        # Search by role name or requestor name/id, or render the full set of requests if no search query was provided
+        data = Request.with_details(Request.search(search) if search else Request.query)
+        key = Request.id
+        versions = [REQUESTS, ROLES, USERS]
     else:
         # Invalid request, send to error page
         abort(404)
-    # Handle pagination
-    data = data.paginate(page_num, RESULTS_PER_PAGE, True)
-    # Request the page
-    return render_template(page, form=form, headers=headers, data=data, type=type)
+    # Handle pagination. Pages are addressed by a cursor on the id unless a page number is given in the URL.
+    params = {'q': search} if search else {}
+    query = data
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    if page_num is None and BROWSE_PAGINATION == 'keyset':
+        data = LazyPage(lambda: KeysetPage(query, key, RESULTS_PER_PAGE, after, before,
+                                           cached_count((page, search), query, BROWSE_COUNT_TTL), params))
+    else:
+        data = LazyPage(lambda: offset_page(query, page_num or 1, params))
+    # Request the page. The results table is rendered from the fragment cache when nothing it shows has changed, in
+    # which case its queries never run.
+    return render_template(page, form=form, headers=headers, data=data, type=type,
+                           fragment_key=fragment_key(page, [search, after, before, page_num], versions))
+
+
+# Get a numbered page of a query carrying the given URL parameters
+def offset_page(query, page_num, params):
+    data = query.paginate(page_num, RESULTS_PER_PAGE, True)
+    data.params = params
+    return data
 
 
 # Handle the Role Create page
-@app.route('/rolecreate/', methods=['GET', 'POST'])
+@main.route('/rolecreate/', methods=['GET', 'POST'])
 @login_required
 def create_role():
     form = RoleCreateForm()
@@ -168,68 +292,299 @@ def create_role():
         # Commit the new role to the database
         db.session.commit()
         # Redirect back to the page
-        return redirect(url_for('role_page', role_id=new_role.id))
+        return redirect(url_for('.role_page', role_id=new_role.id))
     return render_template('create_role.html', form=form)
 
 
+# Import a role catalog upload in CSV, JSON or YAML, taking the format from the format argument or the file
+# extension. Every Role is created with its parents and approvers in one transaction, or none are if any problem is
+# found. The upload must carry the CSRF token, see check_csrf. Responds with the number of rows written or the list of
+# problems.
+@main.route('/rolecreate/import/', methods=['POST'])
+@login_required
+def import_roles():
+    check_csrf()
+    if 'file' not in request.files:
+        abort(400)
+    upload = request.files['file']
+    catalog_format = request.form.get('format') or upload.filename.rsplit('.', 1)[-1].lower().replace('yml', 'yaml')
+    try:
+        result = import_catalog(parse_catalog(io.StringIO(upload.read().decode('utf-8')), catalog_format))
+    except UnicodeDecodeError:
+        return json.dumps({"errors": ['The catalog is not UTF-8 text']}), 400
+    except CatalogError as error:
+        return json.dumps({"errors": error.errors}), 400
+    return json.dumps(result)
+
+
+# Stream the whole role catalog in CSV, JSON or YAML in the form accepted by the importer
+@main.route('/rolecreate/export/', methods=['GET'])
+@login_required
+def export_roles():
+    catalog_format = request.args.get('format', 'csv')
+    if catalog_format not in CATALOG_FORMATS:
+        abort(400)
+    mimetypes = {'csv': 'text/csv', 'json': 'application/json', 'yaml': 'application/x-yaml'}
+    return Response(stream_with_context(encode_catalog(stream_catalog(), catalog_format)),
+                    mimetype=mimetypes[catalog_format],
+                    headers={'Content-Disposition': 'attachment; filename=roles.' + catalog_format})
+
+
 # Handle the Assign Access page
-@app.route('/assign/', methods=['GET', 'POST'])
+@main.route('/assign/', methods=['GET', 'POST'])
 @login_required
 def assign():
     form = AssignAccessForm()
     if form.submit.data and form.validate_on_submit():
-        # Create a new Request and add it to the database for each Role assigned to each User
-        for user in form.users.data:
-            for role in form.roles.data:
-                # If there is not an existing, identical, and active Request, create a new one
-                if Request.get_active_request(role, user) is None:
-                    # Add the new Request to the database
-                    db.session.add(Request(role, user, g.user.id, form.comment.data))
-                    # Save database changes
-                    db.session.commit()
+        # Create a new Request for each Role assigned to each User unless an identical active Request exists
+        bulk_assign([(user, role) for user in form.users.data for role in form.roles.data],
+                    g.user.id, form.comment.data, form.valid_from.data, form.valid_until.data, form.conflicts)
         # Redirect back to the page
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     return render_template('assign_access.html', form=form)
 
 
+# Handle bulk access assignment. Needs the CSRF token, see check_csrf. Accepts either an application/json body of the
+# form {"users": [...], "roles": [...]} or {"pairs": [[user_id, role_id], ...]} with an optional "comment",
+# "valid_from" and "valid_until", or a CSV file upload with user_id and role_id columns. Responds with the outcome of
+# every (user, role) pair.
+@main.route('/assign/bulk/', methods=['POST'])
+@login_required
+def assign_bulk():
+    check_csrf()
+    comment = request.form.get('comment')
+    valid_from = request.form.get('valid_from')
+    valid_until = request.form.get('valid_until')
+    if 'file' not in request.files:
+        body = json_body()
+        comment = body.get('comment')
+        valid_from = body.get('valid_from')
+        valid_until = body.get('valid_until')
+    try:
+        if 'file' in request.files:
+            # Parse the uploaded CSV file
+            pairs = parse_pairs_csv(io.StringIO(request.files['file'].read().decode('utf-8')))
+        elif 'pairs' in body:
+            pairs = body['pairs']
+        else:
+            pairs = [(user, role) for user in body.get('users', []) for role in body.get('roles', [])]
+        valid_from = parse_date(valid_from) if valid_from else None
+        valid_until = parse_date(valid_until) if valid_until else None
+        if valid_from is not None and valid_until is not None and valid_until <= valid_from:
+            abort(400)
+        results = bulk_assign(pairs, g.user.id, comment, valid_from, valid_until)
+    except (TypeError, ValueError, KeyError):
+        # Malformed ids or dates, missing CSV columns or an upload that is not UTF-8
+        abort(400)
+    return json.dumps({"results": results})
+
+
+# Decide a batch of Requests awaiting the current User in one transaction. Accepts an application/json body, sent
+# with the CSRF token, of the form {"decisions": [{"request_id": 1, "decision": "APPROVED"}, ...]}. Responds with the
+# outcome of every decision.
+@main.route('/approvals/', methods=['POST'])
+@login_required
+def approvals():
+    check_csrf()
+    body = json_body()
+    try:
+        results = g.user.update_approvals([(item['request_id'], item['decision']) for item in body['decisions']])
+    except (TypeError, ValueError, KeyError):
+        # Malformed ids or missing fields
+        abort(400)
+    return json.dumps({"results": results})
+
+
+# Revoke grants as an administrator. Accepts an application/json body, sent with the CSRF token, of the form
+# {"users": [user_id, ...], "roles": [role_id, ...]} revoking every grant of the Users and every grant of the Roles and
+# their descendants, and rejecting their open Requests. With "deactivate": true the Users are also deactivated.
+# Responds with the number of grants revoked for each User and Role.
+@main.route('/revoke/', methods=['POST'])
+@login_required
+@admin_required
+def revoke():
+    check_csrf()
+    body = json_body()
+    try:
+        users = [User.query.get_or_404(int(user_id)) for user_id in body.get('users', [])]
+        roles = [Role.query.get_or_404(int(role_id)) for role_id in body.get('roles', [])]
+    except (TypeError, ValueError):
+        # Malformed ids
+        abort(400)
+    results = {"users": {}, "roles": {}}
+    for user in users:
+        results["users"][user.id] = user.deactivate() if body.get('deactivate') else user.revoke_grants()
+    for role in roles:
+        results["roles"][role.id] = role.revoke_grants()
+    return json.dumps(results)
+
+
+# Answer who held access when from the access event log, as an administrator. With role and at query arguments
+# responds with the ids of the Users directly granted the Role at that time, with user and at with the ids of the Roles
+# directly granted to the User.
+@main.route('/audit/access/', methods=['GET'])
+@login_required
+@admin_required
+def audit_access():
+    try:
+        at = parse_date(request.args['at'])
+    except (KeyError, ValueError):
+        abort(400)
+    role_id = request.args.get('role', type=int)
+    user_id = request.args.get('user', type=int)
+    if role_id is not None:
+        return json.dumps({"role": role_id, "at": at.isoformat(), "users": holders_at(role_id, at)})
+    if user_id is not None:
+        return json.dumps({"user": user_id, "at": at.isoformat(), "roles": roles_at(user_id, at)})
+    abort(400)
+
+
+# Stream the access events that occurred after since and up to until as CSV or NDJSON, as an administrator.
+# Optionally limited to one role or user.
+@main.route('/audit/changes/', methods=['GET'])
+@login_required
+@admin_required
+def audit_changes():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in FORMATS:
+        abort(400)
+    try:
+        since = parse_date(request.args['since'])
+        until = parse_date(request.args['until'])
+    except (KeyError, ValueError):
+        abort(400)
+    statement = changes_statement(since, until, request.args.get('role', type=int),
+                                  request.args.get('user', type=int))
+    encoder, mimetype = FORMATS[export_format]
+    return Response(stream_with_context(encoder(stream_rows(statement))), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=changes.' + export_format})
+
+
+# Check whether Users effectively hold Roles, directly or through inheritance. Accepts either user and role query
+# arguments, or an application/json body, sent with the CSRF token, of the form {"checks": [[user_id, role_id], ...]}
+# answered with a list of booleans.
+@main.route('/check/', methods=['GET', 'POST'])
+@login_required
+def check():
+    try:
+        if request.method == 'GET':
+            return json.dumps({"result": entitlement_index.check(int(request.args['user']), int(request.args['role']))})
+        check_csrf()
+        pairs = [(int(user_id), int(role_id)) for user_id, role_id in json_body()['checks']]
+    except (TypeError, ValueError, KeyError):
+        # Malformed ids or missing fields
+        abort(400)
+    return json.dumps({"results": entitlement_index.check_many(pairs)})
+
+
 # Handle requests to look up a User
-@app.route("/finduser/", methods=['GET'])
+@main.route("/finduser/", methods=['GET'])
 def find_user():
-    # Search for the User with the given query
-    users = User.search(request.args.get('user')).all()
+    # Search for the first five Users matching the given query
+    users = User.search(request.args.get('user'), limit=5).all()
     # Results found, get needed information
     results = []
     for user in users:
         # Make a list in the form (id, text) for Select2 to parse
         results.append({"id": user.id, "text": user.name + " (" + str(user.id) + ")"})
-    # Convert the first five results to JSON
-    return json.dumps(results[:5])
+    # Convert the results to JSON
+    return json.dumps(results)
 
 
 # Handle requests to look up a Role
-@app.route("/findrole/", methods=['GET'])
+@main.route("/findrole/", methods=['GET'])
 def find_role():
-    # Search for the Role with the given query
-    roles = Role.search(request.args.get('role')).all()
+    # Search for the first ten Roles matching the given query
+    roles = Role.search(request.args.get('role'), limit=10).all()
     # Results found, get needed information
     results = []
     for role in roles:
         # Make a list in the form (id, text) for Select2 to parse
         results.append({"id": role.id, "text": role.name})
-    # Convert the first ten results to JSON
-    return json.dumps(results[:10])
+    # Convert the results to JSON
+    return json.dumps(results)
+
+
+# Stream an export of requests, grants or approval decisions as CSV or NDJSON, as an administrator. Filters are given
+# as query arguments: status, role (with descendants=1 to include its descendant Roles), since and until.
+@main.route("/export/<any(requests, grants, decisions):kind>/", methods=['GET'])
+@login_required
+@admin_required
+def export(kind):
+    export_format = request.args.get('format', 'csv')
+    status = request.args.get('status') or None
+    if export_format not in FORMATS or status not in (None, 'PENDING', 'APPROVED', 'REJECTED', 'REVOKED',
+                                                                 'EXPIRED'):
+        abort(400)
+    try:
+        since = parse_date(request.args['since']) if request.args.get('since') else None
+        until = parse_date(request.args['until']) if request.args.get('until') else None
+    except ValueError:
+        abort(400)
+    statement = export_statement(kind, status, request.args.get('role', type=int),
+                                 request.args.get('descendants') in ('1', 'true'), since, until)
+    encoder, mimetype = FORMATS[export_format]
+    return Response(stream_with_context(encoder(stream_rows(statement))), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=' + kind + '.' + export_format})
+
+
+# Report hit and miss counts of the in-process caches
+@main.route("/stats/cache/", methods=['GET'])
+@login_required
+def cache_stats():
+    return json.dumps({"identity": identity_cache.stats(), "entitlements": entitlement_index.stats(),
+                       "fragments": fragment_cache.stats(), "conditional": conditional_stats})
+
 
+# Report password verification counts and hashing latency, used to size PASSWORD_WORKERS
+@main.route("/stats/credentials/", methods=['GET'])
+@login_required
+def credential_stats():
+    return json.dumps(credential_service.stats())
 
-@app.route("/logout/")
+
+# Report the most recent slow SQL statements with their literals removed
+@main.route("/stats/queries/", methods=['GET'])
+@login_required
+def query_stats():
+    return json.dumps({"threshold_ms": metrics.slow_query_ms, "slow_queries": list(metrics.slow_queries)})
+
+
+# Expose request, database, cache and password metrics to Prometheus
+@main.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    caches = [("identity", identity_cache.stats()), ("fragments", fragment_cache.stats())]
+    credentials = credential_service.stats()
+    sweeps = grant_sweeper.stats()
+    text = metrics.render() + \
+        format_metric("ups_cache_lookups_total", "counter", "In-process cache lookups by result.",
+                      [("", {"cache": name, "result": result}, stats[result])
+                       for name, stats in caches for result in ("hits", "misses")]) + \
+        format_metric("ups_cache_entries", "gauge", "Entries held by each in-process cache.",
+                      [("", {"cache": name}, stats["size"]) for name, stats in caches]) + \
+        format_metric("ups_password_verifications_total", "counter", "Password verifications by outcome.",
+                      [("", {"outcome": outcome}, credentials[outcome])
+                       for outcome in ("verified", "rejected", "rehashed")]) + \
+        format_metric("ups_password_hash_seconds", "gauge", "Recent password hashing latency percentiles.",
+                      [("", {"quantile": quantile}, credentials[key] / 1000)
+                       for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms"))]) + \
+        format_metric("ups_conditional_requests_total", "counter", "Conditional page requests by outcome.",
+                      [("", {"outcome": outcome}, count) for outcome, count in sorted(conditional_stats.items())]) + \
+        format_metric("ups_grant_transitions_total", "counter", "Time bound grants moved by the grant sweeper.",
+                      [("", {"transition": transition}, sweeps[transition]) for transition in ("expired", "started")])
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@main.route("/logout/")
 @login_required
 def logout():
     # Log the user out
     logout_user()
     # Redirect back to the login page
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 
 # Handle any 404 errors
-@app.errorhandler(404)
+@main.app_errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
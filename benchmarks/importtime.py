@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Measure the cold start import time of the web app and of the models-only entry point used by scripts and workers,
+# each in fresh interpreters run with python -X importtime (Python 3.7+), and report the median total and the slowest
+# modules. Usage: python -m benchmarks.importtime [--runs N] [--top N] [--record history.jsonl]
+
+# Statement run for each entry point
+ENTRY_POINTS = [
+    ("web", "from app import create_app; create_app()"),
+    ("scripts", "import app.models"),
+]
+# A line of -X importtime output: self and cumulative microseconds, then the module indented by its nesting level
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+# Root of the repository, which must be the working directory so config and app are importable
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Import the entry point in a fresh interpreter. Returns the total import time in seconds and the cumulative seconds
+# spent importing each module.
+def measure(statement, python=sys.executable):
+    result = subprocess.run([python, "-X", "importtime", "-c", statement], cwd=ROOT, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("Importing failed: " + statement + "\n" + result.stderr)
+    total = 0
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group(2)) / 1e6
+        modules[match.group(4)] = modules.get(match.group(4), 0) + cumulative
+        # Top level imports are indented by a single space and include everything they import
+        if len(match.group(3)) == 1:
+            total += cumulative
+    return total, modules
+
+
+# Get the median of a list of numbers
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start import time of the app entry points")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per entry point")
+    parser.add_argument("--top", type=int, default=10, help="slowest modules to list per entry point")
+    parser.add_argument("--record", help="JSON lines file to append the medians to, for tracking over time")
+    args = parser.parse_args()
+
+    results = {}
+    for name, statement in ENTRY_POINTS:
+        runs = [measure(statement) for _ in range(args.runs)]
+        total = median([seconds for seconds, _ in runs])
+        modules = {module: median([run[1].get(module, 0) for run in runs]) for module in runs[0][1]}
+        results[name] = total
+        print("%-8s %8.1f ms  (%s)" % (name, total * 1000, statement))
+        for module, seconds in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+            print("    %8.1f ms  %s" % (seconds * 1000, module))
+    if args.record:
+        with open(args.record, "a") as history:
+            history.write(json.dumps({"time": time.time(), "python": sys.version.split()[0],
+                                      "ms": {name: round(seconds * 1000, 1) for name, seconds in results.items()}})
+                          + "\n")
+
+
+if __name__ == "__main__":
+    main()
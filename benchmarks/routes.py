@@ -0,0 +1,175 @@
+import argparse
+import io
+import json
+import os
+import random
+import tempfile
+import time
+
+from app import create_app, db
+from app.models import InboxItem, Role, Request
+from app.testing import QueryCounter, assert_query_count
+from benchmarks import synthetic
+from config import ADMIN_ROLE
+
+# Drive every route in app/views.py through the Flask test client against a synthetic organisation and report latency
+# percentiles and queries per request. With --check-queries every call is instead checked against the query budget of
+# its route, failing on the first route that issues more queries, so N+1 regressions are caught.
+# Usage: python -m benchmarks.routes [--users N] [--requests N] [--runs N] [--check-queries]
+
+# Time asked about by the audit routes
+AUDIT_AT = "2030-01-01T00:00:00"
+# Queries the identity cache adds on top of a route's budget when it reloads the logged in User, after its entry
+# expired or a write invalidated it
+IDENTITY_QUERIES = 2
+
+
+# Get the value at the given percentile of a sorted list
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# Build the list of (name, budget, call) route calls to benchmark, where budget is the most queries a call may issue
+# whatever the size of the organisation and call is a function of the random source returning (method, url, data),
+# so every run hits different rows.
+def route_calls(sizes):
+    users = list(range(100000, 100000 + sizes["users"]))
+    roles = list(range(1, sizes["roles"] + 1))
+    requests = list(range(1, sizes["requests"] + 1))
+    return [
+        ("index", 4, lambda rng: ("get", "/", None)),
+        ("user", 2, lambda rng: ("get", "/user/%d/" % rng.choice(users), None)),
+        ("user roles", 2, lambda rng: ("get", "/user/%d/roles/" % rng.choice(users), None)),
+        ("user requests", 3, lambda rng: ("get", "/user/%d/requests/" % rng.choice(users), None)),
+        ("role", 4, lambda rng: ("get", "/role/%d/" % rng.choice(roles), None)),
+        ("browse users", 2, lambda rng: ("get", "/browse/users/?after=%d" % rng.choice(users), None)),
+        ("browse roles", 2, lambda rng: ("get", "/browse/roles/?after=%d" % rng.choice(roles), None)),
+        ("browse requests", 2, lambda rng: ("get", "/browse/requests/?after=%d" % rng.choice(requests), None)),
+        ("browse users back", 2, lambda rng: ("get", "/browse/users/?before=%d" % rng.choice(users), None)),
+        ("browse roles first", 2, lambda rng: ("get", "/browse/roles/", None)),
+        ("browse requests back", 2, lambda rng: ("get", "/browse/requests/?before=%d" % rng.choice(requests), None)),
+        ("browse users search page", 2, lambda rng: ("get", "/browse/users/?q=%s&after=%d" % (
+            rng.choice(synthetic.LAST_NAMES), rng.choice(users)), None)),
+        ("browse requests offset", 2, lambda rng: ("get", "/browse/requests/%d/" % rng.randint(1, 50), None)),
+        ("browse search", 2, lambda rng: ("post", "/browse/users/",
+                                          {"query": rng.choice(synthetic.LAST_NAMES), "submit": "Search"})),
+        ("find user", 1, lambda rng: ("get", "/finduser/?user=" + rng.choice(synthetic.FIRST_NAMES)[:3], None)),
+        ("find role", 1, lambda rng: ("get", "/findrole/?role=" + rng.choice(synthetic.APPLICATIONS)[:3], None)),
+        ("role create form", 0, lambda rng: ("get", "/rolecreate/", None)),
+        ("assign form", 0, lambda rng: ("get", "/assign/", None)),
+        ("assign bulk", 18, lambda rng: ("post_json", "/assign/bulk/",
+                                         {"users": rng.sample(users, 5), "roles": rng.sample(roles, 2)})),
+        ("approve", 14, lambda rng: ("post", "/", {"Approve": str(rng.choice(requests))})),
+        ("approvals", 18, lambda rng: ("post_json", "/approvals/", {"decisions": [
+            {"request_id": request_id, "decision": rng.choice(["APPROVED", "REJECTED"])}
+            for request_id in rng.sample(requests, 5)]})),
+        ("check", 1, lambda rng: ("get", "/check/?user=%d&role=%d" % (rng.choice(users), rng.choice(roles)), None)),
+        ("check batch", 1, lambda rng: ("post_json", "/check/", {"checks": [
+            [rng.choice(users), rng.choice(roles)] for _ in range(100)]})),
+        ("role catalog export", 4, lambda rng: ("get", "/rolecreate/export/?format=" + rng.choice(["csv", "json"]),
+                                                None)),
+        ("role catalog import", 10, lambda rng: ("post", "/rolecreate/import/", {"file": (io.BytesIO(json.dumps([
+            {"name": "Imported role %d" % rng.getrandbits(48), "parents": [], "approvers": [rng.choice(users)]}])
+            .encode("utf-8")), "roles.json")})),
+        ("export requests", 4, lambda rng: ("get", "/export/requests/?format=ndjson&role=%d" % rng.choice(roles),
+                                            None)),
+        ("export grants", 4, lambda rng: ("get", "/export/grants/?role=%d&descendants=1" % rng.choice(roles), None)),
+        ("export decisions", 4, lambda rng: ("get", "/export/decisions/?format=ndjson&role=%d" % rng.choice(roles),
+                                             None)),
+        ("audit access", 6, lambda rng: ("get", "/audit/access/?role=%d&at=%s" % (rng.choice(roles), AUDIT_AT),
+                                         None)),
+        ("audit user access", 6, lambda rng: ("get", "/audit/access/?user=%d&at=%s" % (rng.choice(users), AUDIT_AT),
+                                              None)),
+        ("audit changes", 4, lambda rng: ("get", "/audit/changes/?since=2000-01-01&until=%s&role=%d" % (
+            AUDIT_AT, rng.choice(roles)), None)),
+        ("cache stats", 0, lambda rng: ("get", "/stats/cache/", None)),
+        ("credential stats", 0, lambda rng: ("get", "/stats/credentials/", None)),
+        ("query stats", 0, lambda rng: ("get", "/stats/queries/", None)),
+        ("metrics", 0, lambda rng: ("get", "/metrics", None)),
+    ]
+
+
+# Call every route runs times, reading streamed responses in full, and raise AssertionError, listing the statements,
+# on the first call that issues more queries than the budget of its route
+def check_queries(client, calls, rng, runs):
+    for name, budget, call in calls:
+        budget += IDENTITY_QUERIES
+        for _ in range(runs):
+            method, url, data = call(rng)
+            if method == "post_json":
+                response = assert_query_count(client, url, budget, maximum=True, method="post", data=json.dumps(data),
+                                              content_type="application/json", buffered=True)
+            else:
+                response = assert_query_count(client, url, budget, maximum=True, method=method, data=data,
+                                              buffered=True)
+            if response.status_code >= 400:
+                raise RuntimeError(name + " returned " + str(response.status_code) + " for " + url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every route against a synthetic organisation")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--roles", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--runs", type=int, default=100, help="calls per route")
+    parser.add_argument("--database", help="SQLite file to use instead of a temporary one")
+    parser.add_argument("--check-queries", action="store_true",
+                        help="fail if a call issues more queries than its route's budget instead of timing the calls")
+    args = parser.parse_args()
+
+    # Point the app at a fresh database before anything touches the engine
+    app = create_app()
+    path = args.database or os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    app.config["WTF_CSRF_ENABLED"] = False
+    db.drop_all()
+    db.create_all()
+    start = time.time()
+    with db.engine.begin() as connection:
+        sizes = synthetic.generate(connection, users=args.users, roles=args.roles, requests=args.requests)
+    print("Generated %s in %.1fs" % (json.dumps(sizes), time.time() - start))
+
+    # Log in as the busiest approver so the dashboard has work on it
+    approver_id = db.session.query(InboxItem.user_id).filter(InboxItem.status == "PENDING") \
+        .group_by(InboxItem.user_id).order_by(db.func.count().desc()).limit(1).scalar() or 100000
+    # and make them an administrator so the export and audit routes can be called too
+    admin_role = Role(ADMIN_ROLE, "Benchmark administrators")
+    db.session.add(admin_role)
+    db.session.flush()
+    db.session.add(Request(admin_role.id, approver_id, approver_id, "Benchmark", status="APPROVED"))
+    db.session.commit()
+    client = app.test_client()
+    client.post("/login/", data={"username": str(approver_id), "password": "test", "submit": "Sign In"})
+
+    rng = random.Random(604048)
+    if args.check_queries:
+        check_queries(client, route_calls(sizes), rng, args.runs)
+        print("Every route stayed within its query budget")
+        return
+    print("%-24s %8s %8s %8s %8s %10s %10s" % ("route", "p50 ms", "p95 ms", "p99 ms", "max ms", "queries", "max q"))
+    for name, _, call in route_calls(sizes):
+        timings = []
+        queries = []
+        for _ in range(args.runs):
+            method, url, data = call(rng)
+            with QueryCounter() as counter:
+                started = time.time()
+                if method == "post_json":
+                    response = client.post(url, data=json.dumps(data), content_type="application/json",
+                                           buffered=True)
+                else:
+                    response = getattr(client, method)(url, data=data, buffered=True)
+                timings.append((time.time() - started) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError(name + " returned " + str(response.status_code) + " for " + url)
+            queries.append(counter.count)
+        timings.sort()
+        print("%-24s %8.2f %8.2f %8.2f %8.2f %10.1f %10d" % (
+            name, percentile(timings, 0.5), percentile(timings, 0.95), percentile(timings, 0.99), timings[-1],
+            float(sum(queries)) / len(queries), max(queries)))
+    if not args.database:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import json
+import random
+import time
+
+from sqlalchemy_utils import Password
+
+from app import db
+from app.models import User, Role, Request, InboxItem, role_parents, role_approvers, request_approvers, \
+    rebuild_role_closure
+
+# Name parts used to build realistic, searchable User names
+FIRST_NAMES = ["James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda", "William", "Elizabeth",
+               "David", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen",
+               "Steve", "Regan", "Jacob", "Shawn", "Priya", "Wei", "Fatima", "Carlos", "Aiko", "Olga"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+              "Taylor", "Yee", "McCarthy", "Vingerhoet", "Anderson", "Thomas", "Moore", "Jackson", "Martin", "Lee",
+              "Patel", "Chen", "Khan", "Lopez", "Tanaka", "Ivanova", "Nguyen", "Kim", "Singh", "Walker"]
+# Name parts used to build Role names
+APPLICATIONS = ["UPS", "Payroll", "Ledger", "CRM", "Warehouse", "Billing", "Intranet", "Analytics", "Mail", "VPN"]
+FUNCTIONS = ["User", "Admin", "Read", "Write", "Approve", "Audit", "Report", "Maintenance", "Support", "Export"]
+# Relative frequency of each Request status
+STATUS_WEIGHTS = [("PENDING", 2), ("APPROVED", 6), ("REJECTED", 1), ("REVOKED", 1)]
+# Rows written per executemany batch
+BATCH_SIZE = 10000
+
+
+# Delete every row from the application tables in dependency order with one statement per table
+def clear(connection):
+    for table in reversed(db.metadata.sorted_tables):
+        connection.execute(table.delete())
+
+
+# Generate a synthetic organisation through the given connection using Core executemany:
+#   users       Users in a manager tree where every manager has span direct reports
+#   roles       Roles split over role_levels levels, each Role below the top level having one or two parents above it
+#   requests    Requests in every status with their approvers, approver counters and inbox items
+# User ids are consecutive from first_user_id and every User's password is "test". Returns a dict of the row counts.
+def generate(connection, users=10000, span=8, roles=500, role_levels=4, requests=50000, seed=604048,
+             first_user_id=100000):
+    rng = random.Random(seed)
+    # Hash the shared password once instead of once per row
+    password = Password(User.password.type.context.hash("test"))
+
+    # Users, where User i reports to User (i - 1) // span --------
+    user_ids = list(range(first_user_id, first_user_id + users))
+    managers = {}
+    for index, user_id in enumerate(user_ids):
+        managers[user_id] = user_ids[(index - 1) // span] if index > 0 else None
+    _insert(connection, User.__table__, ({"id": user_id, "password": password, "active_flag": True,
+                                          "name": rng.choice(FIRST_NAMES) + " " + rng.choice(LAST_NAMES),
+                                          "manager_id": managers[user_id]} for user_id in user_ids))
+    people_managers = user_ids[:max(1, (users - 1) // span)]
+
+    # Roles in levels, each Role below the top level inheriting from one or two Roles on the level above --------
+    role_ids = list(range(1, roles + 1))
+    levels = [role_ids[level::role_levels] for level in range(role_levels)]
+    _insert(connection, Role.__table__, ({"id": role_id, "desc": "Synthetic role " + str(role_id),
+                                          "name": rng.choice(APPLICATIONS) + " " + rng.choice(FUNCTIONS) + " " +
+                                          str(role_id)} for role_id in role_ids))
+    edges = []
+    for level in range(1, role_levels):
+        for role_id in levels[level]:
+            for parent_id in set(rng.choice(levels[level - 1]) for _ in range(rng.randint(1, 2))):
+                edges.append({"role_id": role_id, "parent_id": parent_id})
+    _insert(connection, role_parents, edges)
+    rebuild_role_closure(connection)
+    approvers = {role_id: set(rng.sample(people_managers, min(2, len(people_managers)))) for role_id in role_ids}
+    _insert(connection, role_approvers, ({"role_id": role_id, "user_id": user_id}
+                                         for role_id in role_ids for user_id in approvers[role_id]))
+
+    # Requests in every status, never more than one active Request per User and Role --------
+    statuses = [status for status, weight in STATUS_WEIGHTS for _ in range(weight)]
+    pairs = set()
+    request_rows = []
+    approver_rows = []
+    inbox_rows = []
+    while len(request_rows) < requests and len(pairs) < users * roles:
+        user_id = rng.choice(user_ids)
+        role_id = rng.choice(role_ids)
+        if (user_id, role_id) in pairs:
+            continue
+        pairs.add((user_id, role_id))
+        request_id = len(request_rows) + 1
+        status = rng.choice(statuses)
+        request_approver_ids = set(approvers[role_id])
+        if managers[user_id] is not None:
+            request_approver_ids.add(managers[user_id])
+        decisions = _decisions(rng, status, sorted(request_approver_ids))
+        request_rows.append({"id": request_id, "role_id": role_id, "requested_for_id": user_id,
+                             "requested_by_id": managers[user_id] or user_id, "comment": "Synthetic request",
+                             "status": status,
+                             "pending_count": sum(1 for decision in decisions.values() if decision == "PENDING"),
+                             "approved_count": sum(1 for decision in decisions.values() if decision == "APPROVED"),
+                             "rejected_count": sum(1 for decision in decisions.values() if decision == "REJECTED")})
+        for approver_id, decision in decisions.items():
+            approver_rows.append({"request_id": request_id, "user_id": approver_id, "approval_status": decision})
+            inbox_status = decision if decision != "PENDING" or status == "PENDING" else "CLOSED"
+            inbox_rows.append({"user_id": approver_id, "status": inbox_status, "request_id": request_id})
+    _insert(connection, Request.__table__, request_rows)
+    _insert(connection, request_approvers, approver_rows)
+    _insert(connection, InboxItem.__table__, inbox_rows)
+    return {"users": users, "roles": roles, "role_parents": len(edges), "requests": len(request_rows),
+            "request_approvers": len(approver_rows)}
+
+
+# Pick an approval decision for every approver that is consistent with the Request status
+def _decisions(rng, status, approver_ids):
+    if status in ("APPROVED", "REVOKED"):
+        return {approver_id: "APPROVED" for approver_id in approver_ids}
+    decisions = {approver_id: rng.choice(["PENDING", "APPROVED"]) for approver_id in approver_ids}
+    if status == "REJECTED" and approver_ids:
+        decisions[rng.choice(approver_ids)] = "REJECTED"
+    elif status == "PENDING" and approver_ids and "PENDING" not in decisions.values():
+        decisions[rng.choice(approver_ids)] = "PENDING"
+    return decisions
+
+
+# Insert rows into a table in executemany batches
+def _insert(connection, table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            connection.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+
+
+# Replace the data of the configured database with a synthetic organisation, for measuring the application at scale.
+# Usage: python -m benchmarks.synthetic [--users N] [--roles N] [--requests N]
+def main():
+    parser = argparse.ArgumentParser(description="Replace the database contents with a synthetic organisation")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--span", type=int, default=8, help="direct reports per manager")
+    parser.add_argument("--roles", type=int, default=500)
+    parser.add_argument("--role-levels", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=604048)
+    args = parser.parse_args()
+
+    start = time.time()
+    with db.engine.begin() as connection:
+        clear(connection)
+        sizes = generate(connection, users=args.users, span=args.span, roles=args.roles,
+                         role_levels=args.role_levels, requests=args.requests, seed=args.seed)
+    print("Generated %s in %.1fs" % (json.dumps(sizes), time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,94 @@ DEBUG = True
 WTF_CSRF_ENABLED = True
 SECRET_KEY = 'ups_development_key'
 
-# Database configuration
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+# Database configuration. Set DATABASE_URL to use a server database such as PostgreSQL or MySQL.
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'app.db'))
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
 SQLALCHEMY_TRACK_MODIFICATIONS = True
 
+# PRAGMAs applied to every new SQLite connection. WAL lets readers proceed while an approver holds the write lock.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'busy_timeout': 5000,
+}
+# Connection pool settings for server databases. Ignored for SQLite.
+DATABASE_POOL_SIZE = 10
+DATABASE_MAX_OVERFLOW = 20
+DATABASE_POOL_RECYCLE = 1800
+DATABASE_POOL_TIMEOUT = 30
+
+# Number of logged in User snapshots kept in memory and the seconds each may be reused before reloading
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 300
+# Rendered page fragments kept in memory, and the seconds before a fragment or ETag is considered stale even if no
+# change was seen. Changes committed by this process invalidate fragments at once, changes made by other processes
+# within this many seconds.
+FRAGMENT_CACHE_SIZE = 2048
+FRAGMENT_CACHE_TTL = 60
+
+# PBKDF2 rounds for new password hashes. Stored hashes with other rounds are rehashed on the next successful login.
+PASSWORD_ROUNDS = 25000
+# Password verification pool: threads hashing at once, extra logins allowed to wait and seconds a login may wait
+PASSWORD_WORKERS = 4
+PASSWORD_QUEUE_SIZE = 32
+PASSWORD_TIMEOUT = 10
+
+# Fraction of requests whose latency and SQL statements are recorded for /metrics
+METRICS_SAMPLE_RATE = 1.0
+# Add a Server-Timing header with database and total time to sampled responses
+METRICS_SERVER_TIMING = False
+# Statements slower than this many milliseconds are kept in the slow query log, which holds the most recent ones
+SLOW_QUERY_MS = 100
+SLOW_QUERY_LOG_SIZE = 100
+
+# Number of incoming Requests shown on the dashboard, which can all be approved or rejected at once
+INBOX_SIZE = 25
+
+# Grants revoked per transaction when a User is offboarded or a Role is retired
+REVOKE_BATCH_SIZE = 1000
+# Holders of this Role may use the administrative endpoints
+ADMIN_ROLE = 'UPS Admin'
+
+# Seconds before the in-memory entitlement index is rebuilt even though the entitlement version did not change, which
+# picks up grants whose validity window opened or closed without a sweep
+ENTITLEMENT_MAX_AGE = 300
+# Milliseconds the entitlement version read from the database is reused before it is read again, which bounds how long
+# entitlement checks miss the changes committed by other processes and scripts
+ENTITLEMENT_VERSION_TTL = 1000
+
+# Seconds between sweeps that expire time bound grants past their valid_until. 0 disables the background sweeper, in
+# which case scripts/db_expire_grants.py can be run on a schedule instead.
+GRANT_SWEEP_INTERVAL = 60
+# Grants expired per transaction by a sweep
+GRANT_SWEEP_BATCH_SIZE = 1000
+
+# Membership events recorded before the grant sweeper takes a new access snapshot. Point-in-time access queries replay
+# at most about this many events on top of the latest snapshot before the queried time.
+AUDIT_SNAPSHOT_EVENTS = 100000
+# Seconds a snapshot lags behind the time it is taken, so transactions still open then have committed their events
+AUDIT_SNAPSHOT_LAG = 60
+
 # Number of table rows to show per page
 RESULTS_PER_PAGE = 10
+# Browse page pagination mode. 'keyset' pages by an id cursor, 'offset' pages by page number.
+BROWSE_PAGINATION = 'keyset'
+# Seconds to reuse the total row count shown on browse pages before counting again
+BROWSE_COUNT_TTL = 60
+
+# Online migrations run by scripts/db_online_migrate.py. Rows per chunk transaction to start with and the bounds the
+# runner adapts it within, the seconds a chunk may take and may wait for its locks before the runner halves the chunk
+# size and backs off, and the seconds to pause between chunks regardless.
+MIGRATION_CHUNK_SIZE = 1000
+MIGRATION_MIN_CHUNK_SIZE = 100
+MIGRATION_MAX_CHUNK_SIZE = 20000
+MIGRATION_TARGET_LATENCY = 0.2
+MIGRATION_MAX_LOCK_WAIT = 0.05
+MIGRATION_PAUSE = 0
+
+# Users written per transaction by the HR feed sync (scripts/db_hr_sync.py). Also bounds the IN lists of a batch.
+HR_FEED_BATCH_SIZE = 500
+# Initial password of the Users created by the HR feed sync. None gives each run's new Users a random password that
+# nobody knows, for deployments where passwords are set another way.
+HR_FEED_PASSWORD = None
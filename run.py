@@ -1,4 +1,6 @@
-from app import app
+from app import create_app
+
+app = create_app()
 
 # Simple startup script for the application
 if __name__ == '__main__':
@@ -0,0 +1,7 @@
+from app.models import InboxItem
+from app import db
+
+# Recompute the approval inbox from request_approvers
+InboxItem.rebuild()
+db.session.commit()
+print('Rebuilt approval inbox: ' + str(InboxItem.query.count()) + ' items')
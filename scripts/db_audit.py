@@ -0,0 +1,37 @@
+import argparse
+import sys
+
+from app.audit import holders_at, roles_at, changes_statement, take_snapshot
+from app.export import FORMATS, stream_rows, parse_date
+
+# Query the access event log, or take an access snapshot.
+# Usage: python scripts/db_audit.py holders --role 3 --at 2026-03-01
+#        python scripts/db_audit.py roles --user 604050 --at 2026-03-01
+#        python scripts/db_audit.py changes --since 2026-03-01 --until 2026-04-01 [--role 3] [--format ndjson]
+#        python scripts/db_audit.py snapshot
+parser = argparse.ArgumentParser(description='Query who had access when')
+parser.add_argument('command', choices=['holders', 'roles', 'changes', 'snapshot'])
+parser.add_argument('--role', type=int)
+parser.add_argument('--user', type=int)
+parser.add_argument('--at', type=parse_date, help='point in time for holders and roles, in UTC')
+parser.add_argument('--since', type=parse_date, help='start of the changes, exclusive')
+parser.add_argument('--until', type=parse_date, help='end of the changes, inclusive')
+parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+args = parser.parse_args()
+
+if args.command == 'holders' and args.role is not None and args.at is not None:
+    for user_id in holders_at(args.role, args.at):
+        sys.stdout.write(str(user_id) + '\n')
+elif args.command == 'roles' and args.user is not None and args.at is not None:
+    for role_id in roles_at(args.user, args.at):
+        sys.stdout.write(str(role_id) + '\n')
+elif args.command == 'changes' and args.since is not None and args.until is not None:
+    encoder = FORMATS[args.format][0]
+    for chunk in encoder(stream_rows(changes_statement(args.since, args.until, args.role, args.user))):
+        sys.stdout.write(chunk)
+elif args.command == 'snapshot':
+    snapshot = take_snapshot()
+    sys.stderr.write(('Took snapshot of ' + str(snapshot.grant_count) + ' grants at ' + str(snapshot.taken_at)
+                      if snapshot is not None else 'The latest snapshot is recent enough') + '\n')
+else:
+    parser.error('holders needs --role and --at, roles needs --user and --at, changes needs --since and --until')
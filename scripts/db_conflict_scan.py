@@ -0,0 +1,13 @@
+import csv
+import sys
+
+from app.conflicts import scan_conflicts
+
+# Scan every User for separation of duties violations and write them to standard output as CSV
+violations, seconds = scan_conflicts()
+writer = csv.writer(sys.stdout)
+writer.writerow(['user_id', 'rule', 'role_ids'])
+for violation in violations:
+    writer.writerow([violation['user_id'], violation['rule'],
+                     ' '.join(str(role_id) for role_id in violation['role_ids'])])
+sys.stderr.write('Found ' + str(len(violations)) + ' violations in ' + '%.2f' % seconds + ' seconds\n')
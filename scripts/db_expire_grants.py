@@ -0,0 +1,30 @@
+import argparse
+import sys
+from datetime import datetime
+
+from app.export import parse_date
+from app.sweeper import GrantSweeper
+
+# Run one grant sweep, for deployments that sweep on a schedule with GRANT_SWEEP_INTERVAL = 0 instead of in the web
+# process: expire the time bound grants whose valid_until has passed, note the grants whose valid_from was reached
+# since the last sweep of any process, and take an access snapshot if one is due. Prints the expired and started
+# Request ids.
+# Usage: python scripts/db_expire_grants.py [--now 2017-06-01T00:00:00] [--batch-size 1000]
+parser = argparse.ArgumentParser(description='Move time bound grants through their validity window')
+parser.add_argument('--now', type=parse_date, default=None, help='sweep as of this time, in UTC')
+parser.add_argument('--batch-size', type=int, default=None, help='grants expired per transaction')
+args = parser.parse_args()
+
+start = datetime.utcnow()
+# The sweep moves the shared watermark up to --now, while grants are recorded as started by the current time, so a
+# sweep into the future would skip the grants starting until then
+if args.now is not None and args.now > start:
+    parser.error('--now must not be in the future')
+expired, started, snapshot = GrantSweeper(interval=0, batch_size=args.batch_size).sweep(args.now or start)
+for request_id in expired:
+    sys.stdout.write('expired ' + str(request_id) + '\n')
+for request_id in started:
+    sys.stdout.write('started ' + str(request_id) + '\n')
+sys.stderr.write('Expired ' + str(len(expired)) + ' and started ' + str(len(started)) + ' grants' +
+                 (', took the access snapshot of ' + snapshot.taken_at.isoformat() if snapshot is not None else '') +
+                 ' in ' + '%.2f' % (datetime.utcnow() - start).total_seconds() + ' seconds\n')
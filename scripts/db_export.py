@@ -0,0 +1,27 @@
+import argparse
+import sys
+
+from app.export import FORMATS, export_statement, stream_rows, parse_date
+
+# Stream an export of requests, grants or approval decisions to standard output or a file.
+# Usage: python scripts/db_export.py grants --format ndjson --role 3 --descendants --since 2017-01-01 -o grants.ndjson
+parser = argparse.ArgumentParser(description='Export requests, grants or approval decisions')
+parser.add_argument('kind', choices=['requests', 'grants', 'decisions'])
+parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+parser.add_argument('--status', choices=['PENDING', 'APPROVED', 'REJECTED', 'REVOKED', 'EXPIRED'])
+parser.add_argument('--role', type=int, help='only Requests for this Role id')
+parser.add_argument('--descendants', action='store_true', help='also include the descendants of --role')
+parser.add_argument('--since', type=parse_date, help='only Requests made on or after this date')
+parser.add_argument('--until', type=parse_date, help='only Requests made before this date')
+parser.add_argument('-o', '--output', help='file to write instead of standard output')
+args = parser.parse_args()
+
+encoder = FORMATS[args.format][0]
+statement = export_statement(args.kind, args.status, args.role, args.descendants, args.since, args.until)
+output = open(args.output, 'w', newline='') if args.output else sys.stdout
+try:
+    for chunk in encoder(stream_rows(statement)):
+        output.write(chunk)
+finally:
+    if args.output:
+        output.close()
@@ -0,0 +1,33 @@
+import argparse
+import json
+import sys
+
+from app.hrfeed import FORMATS, FeedError, parse_feed, sync_feed
+
+# Apply the differences between an HR extract and the users table: new hires, name and manager changes and
+# terminations. The extract is CSV with id, name, manager_id and optionally active columns, or NDJSON with the same
+# keys.
+# Prints a JSON report of the Users inserted, updated and deactivated, the grants revoked and the rows rejected.
+# Usage: python scripts/db_hr_sync.py users.csv [--full] [--dry-run] [--batch-size 500]
+parser = argparse.ArgumentParser(description='Sync the users table with an HR extract')
+parser.add_argument('file', help='extract file, or - for standard input')
+parser.add_argument('--format', choices=FORMATS, help='file format, taken from the file extension by default')
+parser.add_argument('--full', action='store_true', help='the extract lists every employee, so deactivate the active '
+                                                        'users missing from it')
+parser.add_argument('--dry-run', action='store_true', help='report the differences without applying them')
+parser.add_argument('--batch-size', type=int, default=None, help='users written per transaction')
+args = parser.parse_args()
+
+feed_format = args.format or args.file.rsplit('.', 1)[-1].lower().replace('jsonl', 'ndjson')
+if feed_format not in FORMATS:
+    parser.error('cannot tell the format of ' + args.file + ', use --format')
+
+stream = sys.stdin if args.file == '-' else open(args.file, newline='')
+try:
+    report = sync_feed(parse_feed(stream, feed_format), args.full, args.dry_run, args.batch_size)
+except FeedError as error:
+    sys.exit('Feed not synced: ' + str(error))
+finally:
+    if stream is not sys.stdin:
+        stream.close()
+print(json.dumps(report, indent=2))
@@ -0,0 +1,108 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select, and_, desc
+from sqlalchemy_utils import Password
+
+from app import db
+from app.models import User, Role, Request, role_approvers, request_approvers, role_parents
+
+# Benchmark the hot lookup queries against a synthetic SQLite database, first without and then with the indexes
+# declared on the models. Usage: python scripts/db_index_benchmark.py [users] [requests]
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+REQUESTS = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+ROLES = 1000
+# Number of times each query is run per measurement
+RUNS = 200
+# Indexes that exist only to support a constraint are never dropped
+KEEP = {'ix_roles_name'}
+
+random.seed(604048)
+path = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+engine = create_engine('sqlite:///' + path)
+db.metadata.create_all(engine)
+indexes = [index for table in db.metadata.sorted_tables for index in table.indexes if index.name not in KEEP]
+for index in indexes:
+    index.drop(engine)
+
+# Load the synthetic data ----------------
+first_id = 100000
+user_ids = list(range(first_id, first_id + USERS))
+# Hash the shared password once instead of once per row
+password = Password(User.password.type.context.hash('benchmark'))
+with engine.begin() as connection:
+    connection.execute(User.__table__.insert(), [
+        {"id": user_id, "name": "User " + str(user_id), "password": password, "active_flag": True,
+         "manager_id": first_id + (user_id - first_id - 1) // 10 if user_id > first_id else None}
+        for user_id in user_ids])
+    connection.execute(Role.__table__.insert(), [{"id": role_id, "name": "Role " + str(role_id), "desc": ""}
+                                                 for role_id in range(1, ROLES + 1)])
+    connection.execute(role_parents.insert(), [{"role_id": role_id, "parent_id": role_id // 2}
+                                               for role_id in range(2, ROLES + 1)])
+    connection.execute(role_approvers.insert(), [{"role_id": role_id, "user_id": random.choice(user_ids[:USERS // 10])}
+                                                 for role_id in range(1, ROLES + 1)])
+    statuses = ["PENDING", "APPROVED", "APPROVED", "APPROVED", "REJECTED"]
+    connection.execute(Request.__table__.insert(), [
+        {"id": request_id, "role_id": random.randint(1, ROLES), "requested_for_id": random.choice(user_ids),
+         "requested_by_id": random.choice(user_ids), "status": random.choice(statuses)}
+        for request_id in range(1, REQUESTS + 1)])
+    connection.execute(request_approvers.insert(), [
+        {"request_id": request_id, "user_id": random.choice(user_ids[:USERS // 10]),
+         "approval_status": random.choice(statuses[:3])}
+        for request_id in range(1, REQUESTS + 1)])
+
+# The benchmarked queries, each paired with a function producing random parameters ----------------
+requests = Request.__table__
+queries = [
+    ("get_active_request",
+     lambda: select([requests]).where(and_(requests.c.role_id == random.randint(1, ROLES),
+                                            requests.c.requested_for_id == random.choice(user_ids),
+                                            requests.c.status != 'REJECTED')).limit(1)),
+    ("active_roles",
+     lambda: select([requests]).where(and_(requests.c.requested_for_id == random.choice(user_ids),
+                                            requests.c.status == 'APPROVED'))),
+    ("requests_by",
+     lambda: select([requests]).where(requests.c.requested_by_id == random.choice(user_ids))
+     .order_by(desc(requests.c.id)).limit(5)),
+    ("subordinates",
+     lambda: select([User.__table__]).where(User.__table__.c.manager_id == random.choice(user_ids))),
+    ("active_approvals",
+     lambda: select([requests]).select_from(requests.join(request_approvers,
+                                                          request_approvers.c.request_id == requests.c.id))
+     .where(and_(request_approvers.c.user_id == random.choice(user_ids[:USERS // 10]),
+                 request_approvers.c.approval_status == 'PENDING',
+                 requests.c.status == 'PENDING')).limit(5)),
+    ("approver_for",
+     lambda: select([role_approvers]).where(role_approvers.c.user_id == random.choice(user_ids[:USERS // 10]))),
+    ("role_children",
+     lambda: select([role_parents]).where(role_parents.c.parent_id == random.randint(1, ROLES))),
+]
+
+
+# Get the average time in milliseconds of each query
+def measure():
+    timings = {}
+    with engine.connect() as connection:
+        for name, query in queries:
+            statements = [query() for _ in range(RUNS)]
+            start = time.time()
+            for statement in statements:
+                connection.execute(statement).fetchall()
+            timings[name] = (time.time() - start) * 1000 / RUNS
+    return timings
+
+
+before = measure()
+for index in indexes:
+    index.create(engine)
+engine.execute('ANALYZE')
+after = measure()
+
+print('%d users, %d roles, %d requests, %d runs per query' % (USERS, ROLES, REQUESTS, RUNS))
+print('%-20s %12s %12s %10s' % ('query', 'before (ms)', 'after (ms)', 'speedup'))
+for name, _ in queries:
+    print('%-20s %12.3f %12.3f %9.1fx' % (name, before[name], after[name], before[name] / max(after[name], 1e-6)))
+os.remove(path)
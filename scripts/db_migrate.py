@@ -1,6 +1,7 @@
 import imp
 from migrate.versioning import api
-from app import db
+from app.models import db
+from app.engine import create_missing_indexes
 from config import SQLALCHEMY_DATABASE_URI
 from config import SQLALCHEMY_MIGRATE_REPO
 v = api.db_version(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
@@ -11,6 +12,8 @@ exec(old_model, tmp_module.__dict__)
 script = api.make_update_script_for_model(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO, tmp_module.meta, db.metadata)
 open(migration, "wt").write(script)
 api.upgrade(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
+indexes = create_missing_indexes(db.engine, db.metadata)
 v = api.db_version(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
 print('New migration saved as ' + migration)
+print('Created indexes: ' + (', '.join(indexes) or 'none'))
 print('Current database version: ' + str(v))
\ No newline at end of file
@@ -0,0 +1,40 @@
+import argparse
+import sys
+
+from app import db
+from app.migrations import MIGRATIONS, MigrationRunner, format_status
+
+# Run the online migrations in app/migrations.py against a live database in small, throttled, checkpointed chunks.
+# Interrupting a run loses at most the chunk in progress, and running the script again resumes where it stopped.
+# Usage: python scripts/db_online_migrate.py [recount_approvals ...] [--list] [--reset NAME] [--chunk-size 1000]
+parser = argparse.ArgumentParser(description='Run online migrations in throttled, resumable chunks')
+parser.add_argument('names', nargs='*', help='migrations to run, all unfinished ones by default')
+parser.add_argument('--list', action='store_true', help='list the migrations and their progress')
+parser.add_argument('--reset', metavar='NAME', help='forget the progress of a migration so it starts over')
+parser.add_argument('--chunk-size', type=int, default=None, help='rows per chunk to start with')
+parser.add_argument('--target-latency', type=float, default=None, help='seconds a chunk may take')
+parser.add_argument('--max-lock-wait', type=float, default=None, help='seconds a chunk may wait for its locks')
+parser.add_argument('--pause', type=float, default=None, help='seconds to pause between chunks')
+args = parser.parse_args()
+
+runner = MigrationRunner(db.engine, chunk_size=args.chunk_size, target_latency=args.target_latency,
+                         max_lock_wait=args.max_lock_wait, pause=args.pause)
+migrations = {migration.name: migration for migration in MIGRATIONS}
+unknown = [name for name in args.names + [args.reset] if name is not None and name not in migrations]
+if unknown:
+    parser.error('unknown migrations: ' + ', '.join(unknown) + ' (known: ' + ', '.join(migrations) + ')')
+
+if args.list:
+    for migration in MIGRATIONS:
+        checkpoint = runner.checkpoint(migration.name)
+        print(migration.name + ': ' + ('PENDING' if checkpoint is None else
+                                       checkpoint.state + ' ' + str(checkpoint.rows_done) + ' rows'))
+elif args.reset:
+    runner.reset(args.reset)
+    print('Reset ' + args.reset)
+else:
+    for migration in MIGRATIONS:
+        if args.names and migration.name not in args.names:
+            continue
+        status = runner.run(migration, progress=lambda status: sys.stderr.write(format_status(status) + '\n'))
+        print(migration.name + ': ' + status["state"] + ' ' + str(status["rows_done"]) + ' rows')
@@ -0,0 +1,7 @@
+from app.models import Request
+from app import db
+
+# Recompute the approver counters of every Request from request_approvers
+Request.recount_approvals()
+db.session.commit()
+print('Recounted approvals for ' + str(Request.query.count()) + ' requests')
@@ -0,0 +1,31 @@
+import argparse
+import sys
+
+from app.catalog import FORMATS, CatalogError, parse_catalog, import_catalog, stream_catalog, encode_catalog
+
+# Import or export the role catalog: Roles with their parents and approvers.
+# Usage: python scripts/db_role_catalog.py import roles.yaml
+#        python scripts/db_role_catalog.py export roles.csv
+parser = argparse.ArgumentParser(description='Import or export the role catalog')
+parser.add_argument('action', choices=['import', 'export'])
+parser.add_argument('file', help='catalog file, or - for standard input or output')
+parser.add_argument('--format', choices=FORMATS, help='file format, taken from the file extension by default')
+args = parser.parse_args()
+
+catalog_format = args.format or args.file.rsplit('.', 1)[-1].lower().replace('yml', 'yaml')
+if catalog_format not in FORMATS:
+    parser.error('cannot tell the format of ' + args.file + ', use --format')
+
+if args.action == 'import':
+    stream = sys.stdin if args.file == '-' else open(args.file, newline='')
+    try:
+        result = import_catalog(parse_catalog(stream, catalog_format))
+    except CatalogError as error:
+        sys.exit('Catalog not imported:\n' + '\n'.join(error.errors))
+    print('Imported ' + ', '.join(str(count) + ' ' + table for table, count in sorted(result.items())))
+else:
+    output = sys.stdout if args.file == '-' else open(args.file, 'w', newline='')
+    for chunk in encode_catalog(stream_catalog(), catalog_format):
+        output.write(chunk)
+    if output is not sys.stdout:
+        output.close()
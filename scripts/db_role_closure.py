@@ -0,0 +1,7 @@
+from app.models import rebuild_role_closure, role_closure
+from app import db
+
+# Recompute the role_closure table from role_parents
+rebuild_role_closure()
+db.session.commit()
+print('Rebuilt role closure: ' + str(db.session.execute(role_closure.count()).scalar()) + ' rows')
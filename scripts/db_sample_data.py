@@ -1,20 +1,12 @@
 from app.models import *
 from app import db
+from benchmarks.synthetic import clear
 
-# Delete existing data ----------------
-with db.session.no_autoflush:
-    for user in User.query.all():
-        db.session.delete(user)
-
-    for role in Role.query.all():
-        db.session.delete(role)
-
-    for request in Request.query.all():
-        db.session.delete(request)
-
-    # Commit changes
-    db.session.commit()
+# Delete existing data with one statement per table ----------------
+with db.engine.begin() as connection:
+    clear(connection)
 
+with db.session.no_autoflush:
     # Create some test users -------
     user1 = User(604048, "Shawn McCarthy")
     user2 = User(604049, "Steve Vingerhoet", 604048)
@@ -0,0 +1,7 @@
+from app.search import rebuild_search_indexes
+from app.models import db
+
+# Create the User and Role search indexes if they are missing and rebuild them from the existing rows
+rebuild_search_indexes()
+print('Rebuilt search indexes: ' + str(db.session.execute("SELECT count(*) FROM users_search").scalar()) + ' users, ' +
+      str(db.session.execute("SELECT count(*) FROM roles_search").scalar()) + ' roles')